@@ -23,6 +23,18 @@ class Agent3(object):
     Änderungen:
     - backward() hat als zusätzliches Argument observation_1;
     - Außerdem Änderung des Ende-der-Episode Codes in fit(), welcher nun den RingBuffer der State-Action-Paare leert.
+    - fit_vectorized(): dieselbe Schleife für mehrere Environments (VecEnv), deren Observations gemeinsam in einem
+      Forward-Pass verarbeitet werden. Benötigt zusätzlich `reset_env_states`, `select_env` und `forward_batch`.
+    - test_vectorized(): Test-Episoden verteilt auf mehrere Environments, ebenfalls mit forward_batch().
+    - resume=True in fit()/fit_vectorized() setzt mit self.step und self.episode fort, statt bei 0 zu beginnen
+      (z.B. nach checkpoint.load_training_state()). self.episode ist in beiden die Anzahl der begonnenen Episoden,
+      also die Nummer der nächsten; es wird zu Beginn jeder Episode gesetzt.
+    - Observations werden nicht mehr mit deepcopy kopiert: das Environment muss bei jedem step()/reset() eigene,
+      neue Arrays zurückgeben (z.B. schreibgeschützt, siehe Sc2Env2Outputs), da sie ohne Kopie im RingBuffer und
+      im Replay Memory landen.
+    - Alle Zähler sind Python ints (kein Überlauf bei Läufen über Millionen Schritte). Die step_logs von
+      on_step_end() enthalten zusätzlich `nb_steps`, die Anzahl aller Trainingsschritte inklusive des aktuellen
+      (monoton, auch über resume hinweg), als globalen Schrittzähler für Callbacks.
 
     Anmerkung: Da der Code von Keras-rl stammt, habe ich ihn nicht weiter mit Kommentaren versehen abseits
     meiner Änderungen.
@@ -53,6 +65,7 @@ class Agent3(object):
         self.processor = processor
         self.training = False
         self.step = 0
+        self.episode = 0
 
     def get_config(self):
         """Configuration of the agent for serialization.
@@ -64,7 +77,7 @@ class Agent3(object):
 
     def fit(self, env, nb_steps, action_repetition=1, callbacks=None, verbose=1,
             visualize=False, nb_max_start_steps=0, start_step_policy=None, log_interval=10000,
-            nb_max_episode_steps=None):
+            nb_max_episode_steps=None, resume=False):
         """Trains the agent on the given environment.
         Modifiziert, siehe Text am Klassenanfang.
 
@@ -90,6 +103,8 @@ class Agent3(object):
             nb_max_episode_steps (integer): Number of steps per episode that the agent performs before
                 automatically resetting the environment. Set to `None` if each episode should run
                 (potentially indefinitely) until the environment signals a terminal state.
+            resume (boolean): If `True`, training continues at `self.step` and `self.episode` (e.g. restored by
+                `checkpoint.load_training_state`) instead of starting at 0; `nb_steps` stays the total number of steps.
 
         # Returns
             A `keras.callbacks.History` instance that recorded the entire training process.
@@ -127,8 +142,11 @@ class Agent3(object):
         self._on_train_begin()
         callbacks.on_train_begin()
 
-        episode = np.int16(0)
-        self.step = np.int16(0)
+        if not resume:
+            self.step = 0
+            self.episode = 0
+        self.step = int(self.step)
+        episode = int(self.episode)
         observation = None
         episode_reward = None
         episode_step = None
@@ -136,13 +154,14 @@ class Agent3(object):
         try:
             while self.step < nb_steps:
                 if observation is None:  # start of a new episode
+                    self.episode = episode + 1
                     callbacks.on_episode_begin(episode)
-                    episode_step = np.int16(0)
-                    episode_reward = np.float32(0)
+                    episode_step = 0
+                    episode_reward = 0.
 
                     # Obtain the initial observation by resetting the environment.
                     self.reset_states()
-                    observation = deepcopy(env.reset())
+                    observation = env.reset()
                     if self.processor is not None:
                         observation = self.processor.process_observation(observation)
                     assert observation is not None
@@ -159,13 +178,12 @@ class Agent3(object):
                             action = self.processor.process_action(action)
                         callbacks.on_action_begin(action)
                         observation, reward, done, info = env.step(action)
-                        observation = deepcopy(observation)
                         if self.processor is not None:
                             observation, reward, done, info = self.processor.process_step(observation, reward, done, info)
                         callbacks.on_action_end(action)
                         if done:
                             warnings.warn('Env ended before {} random steps could be performed at the start. You should probably lower the `nb_max_start_steps` parameter.'.format(nb_random_start_steps))
-                            observation = deepcopy(env.reset())
+                            observation = env.reset()
                             if self.processor is not None:
                                 observation = self.processor.process_observation(observation)
                             break
@@ -182,13 +200,12 @@ class Agent3(object):
                 action = self.forward(observation)
                 if self.processor is not None:
                     action = self.processor.process_action(action)
-                reward = np.float32(0)
+                reward = 0.
                 accumulated_info = {}
                 done = False
                 for _ in range(action_repetition):
                     callbacks.on_action_begin(action)
                     observation, r, done, info = env.step(action)
-                    observation = deepcopy(observation)
                     if self.processor is not None:
                         observation, r, done, info = self.processor.process_step(observation, r, done, info)
                     for key, value in info.items():
@@ -215,6 +232,7 @@ class Agent3(object):
                     'metrics': metrics,
                     'episode': episode,
                     'info': accumulated_info,
+                    'nb_steps': self.step + 1,
                 }
                 callbacks.on_step_end(episode_step, step_logs)
                 episode_step += 1
@@ -256,9 +274,184 @@ class Agent3(object):
 
         return history
 
+    def fit_vectorized(self, vec_env, nb_steps, callbacks=None, verbose=1, log_interval=10000,
+                       nb_max_episode_steps=None, resume=False):
+        """Trains the agent on several environments at once.
+        Alle Environments machen ihre Schritte gleichzeitig, die Actions kommen aus einem gemeinsamen Forward-Pass
+        (forward_batch()). Danach wird backward() für jedes Environment einzeln mit dessen eigenem n-Step RingBuffer
+        aufgerufen (select_env()); alle Transitionen landen im selben Replay Memory. Jede Transition zählt als ein
+        Schritt, train_interval etc. verhalten sich also wie in fit().
+
+        # Arguments
+            vec_env: (`VecEnv` instance): Environments that the agent interacts with, see vecEnv.py.
+            nb_steps (integer): Number of training steps (transitions over all environments) to be performed.
+            callbacks (list of `keras.callbacks.Callback` or `rl.callbacks.Callback` instances):
+                List of callbacks to apply during training. See [callbacks](/callbacks) for details.
+            verbose (integer): 0 for no logging, 1 for interval logging (compare `log_interval`), 2 for episode logging
+            log_interval (integer): If `verbose` = 1, the number of steps that are considered to be an interval.
+            nb_max_episode_steps (integer): Number of steps per episode that the agent performs before
+                automatically resetting the environment. Set to `None` if each episode should run
+                (potentially indefinitely) until the environment signals a terminal state.
+            resume (boolean): If `True`, training continues at `self.step` and `self.episode`, see `fit`.
+
+        # Returns
+            A `keras.callbacks.History` instance that recorded the entire training process.
+        """
+        if not self.compiled:
+            raise RuntimeError('Your tried to fit your agent but it hasn\'t been compiled yet. Please call `compile()` before `fit()`.')
+
+        self.training = True
+        nb_envs = len(vec_env)
+
+        callbacks = [] if not callbacks else callbacks[:]
+
+        if verbose == 1:
+            callbacks += [TrainIntervalLogger(interval=log_interval)]
+        elif verbose > 1:
+            callbacks += [TrainEpisodeLogger()]
+        history = History()
+        callbacks += [history]
+        callbacks = CallbackList(callbacks)
+        if hasattr(callbacks, 'set_model'):
+            callbacks.set_model(self)
+        else:
+            callbacks._set_model(self)
+        callbacks._set_env(vec_env)
+        params = {
+            'nb_steps': nb_steps,
+        }
+        if hasattr(callbacks, 'set_params'):
+            callbacks.set_params(params)
+        else:
+            callbacks._set_params(params)
+        self._on_train_begin()
+        callbacks.on_train_begin()
+
+        # Pro Environment: laufende Episode, deren Schritte und Reward. Episoden-Nummern werden fortlaufend vergeben.
+        if not resume:
+            self.step = 0
+            self.episode = 0
+        self.step = int(self.step)
+        self.reset_states()
+        self.reset_env_states(nb_envs)
+        next_episode = int(self.episode)
+        episodes = [None] * nb_envs
+        episode_steps = [0] * nb_envs
+        episode_rewards = [0.] * nb_envs
+        did_abort = False
+
+        observations = vec_env.reset()
+        if self.processor is not None:
+            observations = [self.processor.process_observation(observation) for observation in observations]
+        try:
+            while self.step < nb_steps:
+                for i in range(nb_envs):
+                    if episodes[i] is None:  # start of a new episode
+                        episodes[i] = next_episode
+                        next_episode += 1
+                        self.episode = next_episode
+                        episode_steps[i] = 0
+                        episode_rewards[i] = 0.
+                        callbacks.on_episode_begin(episodes[i])
+                    callbacks.on_step_begin(episode_steps[i])
+
+                # Ein Forward-Pass für alle Environments.
+                actions = self.forward_batch(observations)
+                if self.processor is not None:
+                    actions = [self.processor.process_action(action) for action in actions]
+                for action in actions:
+                    callbacks.on_action_begin(action)
+                next_observations, rewards, dones, infos = vec_env.step(actions)
+                for action in actions:
+                    callbacks.on_action_end(action)
+
+                for i in range(nb_envs):
+                    done = bool(dones[i])
+                    if done and infos[i].get('worker_restarted'):
+                        # Neu gestarteter Worker (SubprocVecEnv): kein echtes Episodenende. Die angefangenen n-Step
+                        # Transitionen im RingBuffer werden verworfen, statt als Endzustand mit Reward 0 gespeichert
+                        # zu werden; next_observations[i] ist schon die erste Observation einer neuen Episode.
+                        if self.processor is not None:
+                            next_observations[i] = self.processor.process_observation(next_observations[i])
+                        self.select_env(i)
+                        for _ in range(self.recent.maxlen):
+                            self.recent.append(None)
+                        # Ohne Schritte läuft die Episode mit dem neuen Environment einfach weiter.
+                        if episode_steps[i] > 0:
+                            episode_logs = {
+                                'episode_reward': episode_rewards[i],
+                                'nb_episode_steps': episode_steps[i],
+                                'nb_steps': self.step,
+                            }
+                            callbacks.on_episode_end(episodes[i], episode_logs)
+                            episodes[i] = None
+                        continue
+
+                    # Bei done ist next_observations[i] schon die erste Observation der nächsten Episode.
+                    observation = infos[i].pop('terminal_observation') if done else next_observations[i]
+                    reward = rewards[i]
+                    info = infos[i]
+                    if self.processor is not None:
+                        observation, reward, done, info = self.processor.process_step(observation, reward, done, info)
+                    if nb_max_episode_steps and episode_steps[i] >= nb_max_episode_steps - 1 and not done:
+                        # Force a terminal state.
+                        done = True
+                        next_observations[i] = vec_env.reset_at(i)
+
+                    if not done:
+                        # dasselbe Objekt wie observation_1, damit das Replay Memory die Observation wiedererkennt
+                        next_observations[i] = observation
+                    elif self.processor is not None:
+                        next_observations[i] = self.processor.process_observation(next_observations[i])
+
+                    # backward mit dem RingBuffer dieses Environments
+                    self.select_env(i)
+                    metrics = self.backward(reward, terminal=done, observation_1=observation)
+                    episode_rewards[i] += reward
+
+                    step_logs = {
+                        'action': actions[i],
+                        'observation': observation,
+                        'reward': reward,
+                        'metrics': metrics,
+                        'episode': episodes[i],
+                        'info': {key: value for key, value in info.items() if np.isreal(value)},
+                        'nb_steps': self.step + 1,
+                    }
+                    callbacks.on_step_end(episode_steps[i], step_logs)
+                    episode_steps[i] += 1
+                    self.step += 1
+
+                    if done:
+                        # Wie in fit(): ein weiterer forward/backward Aufruf mit terminal=True, danach den
+                        # RingBuffer dieses Environments leeren.
+                        self.forward(observation)
+                        self.backward(0., terminal=True, observation_1=observation)
+
+                        episode_logs = {
+                            'episode_reward': episode_rewards[i],
+                            'nb_episode_steps': episode_steps[i],
+                            'nb_steps': self.step,
+                        }
+                        callbacks.on_episode_end(episodes[i], episode_logs)
+
+                        episodes[i] = None
+                        for _ in range(self.recent.maxlen):
+                            self.recent.append(None)
+
+                observations = next_observations
+        except KeyboardInterrupt:
+            # We catch keyboard interrupts here so that training can be be safely aborted.
+            did_abort = True
+        callbacks.on_train_end(logs={'did_abort': did_abort})
+        self._on_train_end()
+
+        return history
+
     # Änderungen, um die modifizierte Version von backward() zu ermöglichen, ansonsten unverändert.
     def test(self, env, nb_episodes=1, action_repetition=1, callbacks=None, visualize=True,
-             nb_max_episode_steps=None, nb_max_start_steps=0, start_step_policy=None, verbose=1):
+             nb_max_episode_steps=None, nb_max_start_steps=0, start_step_policy=None, verbose=1,
+             noise_mode='mean'):
         """Callback that is called before training begins.
 
         # Arguments
@@ -283,6 +476,8 @@ class Agent3(object):
             nb_max_episode_steps (integer): Number of steps per episode that the agent performs before
                 automatically resetting the environment. Set to `None` if each episode should run
                 (potentially indefinitely) until the environment signals a terminal state.
+            noise_mode (string): Noise mode of noisy layers during the test (see `set_noise_mode()`), restored
+                afterwards. `None` leaves it unchanged.
 
         # Returns
             A `keras.callbacks.History` instance that recorded the entire training process.
@@ -317,6 +512,8 @@ class Agent3(object):
         else:
             callbacks._set_params(params)
 
+        previous_noise_mode = self.set_noise_mode(noise_mode) if noise_mode is not None else None
+
         self._on_test_begin()
         callbacks.on_train_begin()
         for episode in range(nb_episodes):
@@ -326,7 +523,7 @@ class Agent3(object):
 
             # Obtain the initial observation by resetting the environment.
             self.reset_states()
-            observation = deepcopy(env.reset())
+            observation = env.reset()
             if self.processor is not None:
                 observation = self.processor.process_observation(observation)
             assert observation is not None
@@ -343,13 +540,12 @@ class Agent3(object):
                     action = self.processor.process_action(action)
                 callbacks.on_action_begin(action)
                 observation, r, done, info = env.step(action)
-                observation = deepcopy(observation)
                 if self.processor is not None:
                     observation, r, done, info = self.processor.process_step(observation, r, done, info)
                 callbacks.on_action_end(action)
                 if done:
                     warnings.warn('Env ended before {} random steps could be performed at the start. You should probably lower the `nb_max_start_steps` parameter.'.format(nb_random_start_steps))
-                    observation = deepcopy(env.reset())
+                    observation = env.reset()
                     if self.processor is not None:
                         observation = self.processor.process_observation(observation)
                     break
@@ -367,7 +563,6 @@ class Agent3(object):
                 for _ in range(action_repetition):
                     callbacks.on_action_begin(action)
                     observation, r, d, info = env.step(action)
-                    observation = deepcopy(observation)
                     if self.processor is not None:
                         observation, r, d, info = self.processor.process_step(observation, r, d, info)
                     callbacks.on_action_end(action)
@@ -414,6 +609,149 @@ class Agent3(object):
         callbacks.on_train_end()
         self._on_test_end()
 
+        if previous_noise_mode is not None:
+            self.set_noise_mode(previous_noise_mode)
+
+        return history
+
+    def test_vectorized(self, vec_env, nb_episodes=1, callbacks=None, verbose=1, nb_max_episode_steps=None,
+                        noise_mode='mean'):
+        """Tests the agent on several environments at once.
+        Die Episoden werden auf die Environments verteilt: jedes beginnt nach dem Ende seiner Episode die nächste, bis
+        nb_episodes Episoden begonnen wurden. Die Actions aller Environments kommen aus einem gemeinsamen
+        Forward-Pass (forward_batch()). backward() wird nicht aufgerufen, das Replay Memory bleibt also unverändert.
+        Environments ohne weitere Episode laufen bis zum Ende der letzten mit, ihre Schritte werden ignoriert.
+
+        # Arguments
+            vec_env: (`VecEnv` instance): Environments that the agent interacts with, see vecEnv.py.
+            nb_episodes (integer): Number of episodes to perform (over all environments).
+            callbacks (list of `keras.callbacks.Callback` or `rl.callbacks.Callback` instances):
+                List of callbacks to apply during testing. See [callbacks](/callbacks) for details.
+            verbose (integer): 0 for no logging, 1 for episode logging
+            nb_max_episode_steps (integer): Number of steps per episode that the agent performs before
+                automatically resetting the environment. Set to `None` if each episode should run
+                (potentially indefinitely) until the environment signals a terminal state.
+            noise_mode (string): Noise mode of noisy layers during the test (see `set_noise_mode()`), restored
+                afterwards. `None` leaves it unchanged.
+
+        # Returns
+            A `keras.callbacks.History` instance that recorded the entire testing process.
+        """
+        if not self.compiled:
+            raise RuntimeError('Your tried to test your agent but it hasn\'t been compiled yet. Please call `compile()` before `test()`.')
+
+        self.training = False
+        self.step = 0
+        nb_envs = len(vec_env)
+
+        callbacks = [] if not callbacks else callbacks[:]
+
+        if verbose >= 1:
+            callbacks += [TestLogger()]
+        history = History()
+        callbacks += [history]
+        callbacks = CallbackList(callbacks)
+        if hasattr(callbacks, 'set_model'):
+            callbacks.set_model(self)
+        else:
+            callbacks._set_model(self)
+        callbacks._set_env(vec_env)
+        params = {
+            'nb_episodes': nb_episodes,
+        }
+        if hasattr(callbacks, 'set_params'):
+            callbacks.set_params(params)
+        else:
+            callbacks._set_params(params)
+
+        previous_noise_mode = self.set_noise_mode(noise_mode) if noise_mode is not None else None
+
+        self._on_test_begin()
+        callbacks.on_train_begin()
+
+        self.reset_states()
+        self.reset_env_states(nb_envs)
+        next_episode = 0
+        episodes = [None] * nb_envs
+        episode_steps = [0] * nb_envs
+        episode_rewards = [0.] * nb_envs
+
+        observations = vec_env.reset()
+        if self.processor is not None:
+            observations = [self.processor.process_observation(observation) for observation in observations]
+        for i in range(nb_envs):
+            if next_episode < nb_episodes:
+                episodes[i] = next_episode
+                next_episode += 1
+                callbacks.on_episode_begin(episodes[i])
+
+        while any(episode is not None for episode in episodes):
+            for i in range(nb_envs):
+                if episodes[i] is not None:
+                    callbacks.on_step_begin(episode_steps[i])
+
+            # Ein Forward-Pass für alle Environments.
+            actions = self.forward_batch(observations)
+            if self.processor is not None:
+                actions = [self.processor.process_action(action) for action in actions]
+            next_observations, rewards, dones, infos = vec_env.step(actions)
+
+            for i in range(nb_envs):
+                done = bool(dones[i])
+                # Bei done ist next_observations[i] schon die erste Observation der nächsten Episode.
+                observation = infos[i].pop('terminal_observation') if done else next_observations[i]
+                reward = rewards[i]
+                info = infos[i]
+                if self.processor is not None:
+                    observation, reward, done, info = self.processor.process_step(observation, reward, done, info)
+                if nb_max_episode_steps and episode_steps[i] >= nb_max_episode_steps - 1 and not done:
+                    done = True
+                    next_observations[i] = vec_env.reset_at(i)
+
+                if not done:
+                    next_observations[i] = observation
+                elif self.processor is not None:
+                    next_observations[i] = self.processor.process_observation(next_observations[i])
+
+                if episodes[i] is None:
+                    continue
+
+                episode_rewards[i] += reward
+                step_logs = {
+                    'action': actions[i],
+                    'observation': observation,
+                    'reward': reward,
+                    'episode': episodes[i],
+                    'info': {key: value for key, value in info.items() if np.isreal(value)},
+                }
+                callbacks.on_step_end(episode_steps[i], step_logs)
+                episode_steps[i] += 1
+                self.step += 1
+
+                if done:
+                    episode_logs = {
+                        'episode_reward': episode_rewards[i],
+                        'nb_steps': episode_steps[i],
+                    }
+                    callbacks.on_episode_end(episodes[i], episode_logs)
+
+                    episode_steps[i] = 0
+                    episode_rewards[i] = 0.
+                    if next_episode < nb_episodes:
+                        episodes[i] = next_episode
+                        next_episode += 1
+                        callbacks.on_episode_begin(episodes[i])
+                    else:
+                        episodes[i] = None
+
+            observations = next_observations
+
+        callbacks.on_train_end()
+        self._on_test_end()
+
+        if previous_noise_mode is not None:
+            self.set_noise_mode(previous_noise_mode)
+
         return history
 
     def reset_states(self):
@@ -447,6 +785,30 @@ class Agent3(object):
         """
         raise NotImplementedError()
 
+    def reset_env_states(self, nb_envs):
+        """Creates the internally kept states (e.g. the n-step RingBuffers) for `nb_envs` environments,
+        see `fit_vectorized`.
+        """
+        raise NotImplementedError()
+
+    def select_env(self, env_idx):
+        """Makes the internally kept states of environment `env_idx` the current ones, so that the following
+        `forward`/`backward` calls belong to this environment.
+        """
+        raise NotImplementedError()
+
+    def forward_batch(self, observations):
+        """Takes one observation per environment and returns one action per environment, using a single
+        forward (inference) pass. The state-action pairs are stored for each environment separately.
+
+        # Argument
+            observations (list): The current observation of every environment.
+
+        # Returns
+            A list with the next action of every environment.
+        """
+        raise NotImplementedError()
+
     def compile(self, optimizer, metrics=[]):
         """Compiles an agent and the underlaying models to be used for training and testing.
 
@@ -495,6 +857,12 @@ class Agent3(object):
         """
         return []
 
+    def set_noise_mode(self, mode):
+        """Sets the noise mode of noisy layers (`resample`, `hold` or `mean`) and returns the previous one.
+        Agents without noise control return `None`.
+        """
+        return None
+
     def _on_train_begin(self):
         """Callback that is called before training begins."
         """
@@ -619,8 +987,8 @@ class Agent2(object):
         self._on_train_begin()
         callbacks.on_train_begin()
 
-        episode = np.int16(0)
-        self.step = np.int16(0)
+        episode = 0
+        self.step = 0
         observation = None
         episode_reward = None
         episode_step = None
@@ -629,8 +997,8 @@ class Agent2(object):
             while self.step < nb_steps:
                 if observation is None:  # start of a new episode
                     callbacks.on_episode_begin(episode)
-                    episode_step = np.int16(0)
-                    episode_reward = np.float32(0)
+                    episode_step = 0
+                    episode_reward = 0.
 
                     # Obtain the initial observation by resetting the environment.
                     self.reset_states()
@@ -674,7 +1042,7 @@ class Agent2(object):
                 action = self.forward(observation)
                 if self.processor is not None:
                     action = self.processor.process_action(action)
-                reward = np.float32(0)
+                reward = 0.
                 accumulated_info = {}
                 done = False
                 for _ in range(action_repetition):
@@ -0,0 +1,314 @@
+import multiprocessing
+import os
+import queue
+import time
+from collections import deque
+
+import numpy as np
+
+
+# Ape-X (Horgan et al., 2018, "Distributed Prioritized Experience Replay"): Acting und Lernen entkoppelt.
+# Mehrere Actor-Prozesse spielen mit einer Kopie des Netzwerks (eigenes Epsilon pro Actor), bilden n-Step Transitionen
+# und berechnen deren Start-Priorität mit ihren lokalen Q-Werten. Die Transitionen gehen gebündelt über eine Queue an
+# den Learner (Hauptprozess), der sie in das gemeinsame PrioritizedReplayBuffer einfügt, ununterbrochen
+# Sc2DqnAgent_v4.train_step() ausführt und den Actors regelmäßig die neuen Gewichte schickt.
+# Die Actors bekommen nur die Architektur des Netzwerks (JSON) und bauen es selbst; die Environments werden über
+# env_fn im Actor-Prozess erzeugt (muss picklebar sein, z.B. functools.partial(Sc2Env2Outputs, ...)).
+# Dieses Modul importiert Keras erst in _actor(), damit CUDA_VISIBLE_DEVICES vorher gesetzt werden kann (siehe
+# ApeXTrainer.fit()).
+
+
+def apex_epsilons(nb_actors, eps=0.4, alpha=7.):
+    # eps_i = eps ^ (1 + i / (N - 1) * alpha), siehe Ape-X Paper
+    if nb_actors == 1:
+        return [eps]
+    return [eps ** (1. + i / (nb_actors - 1.) * alpha) for i in range(nb_actors)]
+
+
+def _q_values(model, processor, observation):
+    # Wie AbstractSc2DQNAgent3.compute_q_values(), nur ohne Agent.
+    batch = np.asarray([observation])
+    if processor is not None:
+        batch = processor.process_state_batch(batch)
+    return model.predict_on_batch(batch)
+
+
+def _terminal_transitions(recent, recent_r, observation_1, gamma, skip_first):
+    # Die letzten Schritte einer Episode, für die keine n Rewards mehr folgen: Rewards bis zum Episodenende, Endzustand
+    # observation_1, Priorität ohne Bootstrap. skip_first, wenn recent[0] schon als volle n-Step Transition gesendet
+    # wurde.
+    rewards = list(recent_r)
+    transitions = []
+    for k in range(1 if skip_first else 0, len(recent)):
+        acc_r = sum(r * gamma ** i for i, r in enumerate(rewards[k:]))
+        obs_k, act_k, q_action_k, q_coords_k = recent[k]
+        td_error = (q_action_k - acc_r) + (q_coords_k - acc_r)
+        transitions.append((obs_k, act_k, acc_r, observation_1, True, abs(td_error)))
+    return transitions
+
+
+def _actor(actor_idx, actor_config, env_fn, eps, seed, transition_queue, weight_queue, stop_event):
+    # Läuft im Actor-Prozess. CUDA_VISIBLE_DEVICES hat ApeXTrainer.fit() schon beim Start des Prozesses gesetzt.
+    from keras.models import model_from_json
+    from sc2Policy import Sc2Policy
+
+    np.random.seed(seed)
+    env = env_fn()
+    env.seed(seed)
+
+    model = model_from_json(actor_config['model'], custom_objects=actor_config['custom_objects'])
+    model.set_weights(weight_queue.get())
+    processor = actor_config['processor']
+    policy = Sc2Policy(env, nb_actions=actor_config['nb_actions'], eps=eps)
+
+    gamma = actor_config['gamma']
+    multi_step_size = actor_config['multi_step_size']
+    send_interval = actor_config['send_interval']
+    weight_poll_interval = actor_config['weight_poll_interval']
+
+    # (observation, action, Q-Wert der Aktion, Q-Wert der Koordinate) sowie Rewards der letzten n Schritte
+    recent = deque(maxlen=multi_step_size)
+    recent_r = deque(maxlen=multi_step_size)
+    transitions = []
+    step = 0
+
+    try:
+        observation = env.reset()
+        if processor is not None:
+            observation = processor.process_observation(observation)
+        q_values = _q_values(model, processor, observation)
+        episode_reward = 0.
+        episode_step = 0
+
+        while not stop_event.is_set():
+            action = policy.select_action(q_values=q_values)
+            q_action = q_values[0][0, action.action]
+            q_coords = q_values[1][0, action.coords[0], action.coords[1], 0]
+
+            observation_1, reward, done, info = env.step(action)
+            if processor is not None:
+                observation_1, reward, done, info = processor.process_step(observation_1, reward, done, info)
+            # Die Q-Werte von s_t+1 werden sowohl für die nächste Aktion als auch für die Priorität gebraucht.
+            q_values = _q_values(model, processor, observation_1)
+
+            recent.append((observation, action, q_action, q_coords))
+            recent_r.append(reward)
+            episode_reward += reward
+            episode_step += 1
+
+            full = len(recent) == multi_step_size
+            if full:
+                # n-Step Transition wie in Sc2DqnAgent_v4.backward(), Priorität ist der TD-Fehler bzgl. der lokalen
+                # Q-Werte (ohne Target-Netzwerk).
+                acc_r = sum(r * gamma ** i for i, r in enumerate(recent_r))
+                discount = 0. if done else gamma ** multi_step_size
+                obs_0, act_0, q_action_0, q_coords_0 = recent[0]
+                td_error = (q_action_0 - (acc_r + discount * np.max(q_values[0]))) + \
+                           (q_coords_0 - (acc_r + discount * np.max(q_values[1])))
+                transitions.append((obs_0, act_0, acc_r, observation_1, done, abs(td_error)))
+
+            if done:
+                # Wie in Agent3.fit() gehen auch die letzten Schritte der Episode ins Memory, mit den Rewards bis zum
+                # Endzustand (auch bei Episoden kürzer als n).
+                transitions += _terminal_transitions(recent, recent_r, observation_1, gamma, skip_first=full)
+                transition_queue.put(('episode', actor_idx, episode_reward, episode_step))
+                recent.clear()
+                recent_r.clear()
+                observation = env.reset()
+                if processor is not None:
+                    observation = processor.process_observation(observation)
+                q_values = _q_values(model, processor, observation)
+                episode_reward = 0.
+                episode_step = 0
+            else:
+                observation = observation_1
+
+            # Gebündelt senden: innerhalb einer Nachricht bleiben gemeinsame Observations ein Objekt, das
+            # FrameReplayBuffer speichert sie dann nur einmal.
+            if len(transitions) >= send_interval:
+                transition_queue.put(('transitions', actor_idx, transitions))
+                transitions = []
+
+            step += 1
+            if step % weight_poll_interval == 0:
+                try:
+                    model.set_weights(weight_queue.get_nowait())
+                except queue.Empty:
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+
+
+class ApeXTrainer(object):
+    """Ape-X style training of a Sc2DqnAgent_v4 with several actor processes and one learner (this process).
+
+    # Arguments
+        agent: A compiled Sc2DqnAgent_v4 with a PrioritizedReplayBuffer (prio_replay=True), used as learner.
+        env_fn: A picklable function without arguments that creates one environment (called in every actor).
+        nb_actors: Number of actor processes.
+        actor_eps: List with the epsilon of every actor, defaults to `apex_epsilons(nb_actors)`.
+        seed: Seed of the first actor, the others get seed + i.
+        send_interval: Number of transitions an actor collects before sending them to the learner.
+        weight_sync_interval: Number of learner steps between two weight updates for the actors.
+        weight_poll_interval: Number of actor steps between two checks for new weights.
+        max_queue_size: Max number of messages waiting for the learner; actors block if it is full.
+        cpu_only: If `True`, actors do not use the GPU (`CUDA_VISIBLE_DEVICES` is empty when they start).
+    """
+
+    def __init__(self, agent, env_fn, nb_actors=4, actor_eps=None, seed=None, send_interval=50,
+                 weight_sync_interval=400, weight_poll_interval=400, max_queue_size=256, cpu_only=True):
+        if not agent.prio_replay:
+            raise ValueError('ApeXTrainer expects an agent with prio_replay=True.')
+        if actor_eps is not None and len(actor_eps) != nb_actors:
+            raise ValueError('actor_eps has {} values for {} actors.'.format(len(actor_eps), nb_actors))
+
+        self.agent = agent
+        self.env_fn = env_fn
+        self.nb_actors = nb_actors
+        self.actor_eps = apex_epsilons(nb_actors) if actor_eps is None else actor_eps
+        self.seed = np.random.randint(1, 2 ** 31 - nb_actors) if seed is None else seed
+        self.weight_sync_interval = weight_sync_interval
+        self.max_queue_size = max_queue_size
+        self.cpu_only = cpu_only
+
+        # Alles, was ein Actor außer den Gewichten braucht (picklebar).
+        self.actor_config = {
+            'model': agent.model.to_json(),
+            'custom_objects': agent.custom_model_objects,
+            'processor': agent.processor,
+            'nb_actions': agent.nb_actions,
+            'gamma': agent.gamma,
+            'multi_step_size': agent.multi_step_size,
+            'send_interval': send_interval,
+            'weight_poll_interval': weight_poll_interval,
+        }
+
+    def fit(self, nb_steps, verbose=1, log_interval=1000):
+        """Trains the agent for `nb_steps` learner steps (gradient updates).
+
+        # Returns
+            A dict with the lists `episode_reward`, `nb_episode_steps` and `actor` of all finished actor episodes.
+        """
+        agent = self.agent
+        memory = agent.memory
+
+        # spawn statt fork: der Learner hat bereits eine TensorFlow-Session.
+        context = multiprocessing.get_context('spawn')
+        transition_queue = context.Queue(self.max_queue_size)
+        weight_queues = [context.Queue(1) for _ in range(self.nb_actors)]
+        stop_event = context.Event()
+
+        weights = agent.model.get_weights()
+        for weight_queue in weight_queues:
+            weight_queue.put(weights)
+
+        # Die Actors rechnen auf der CPU, die GPU bleibt dem Learner. Die Variable muss schon in der Umgebung des
+        # neuen Prozesses stehen: beim Entpicklen der Argumente (Processor, env_fn) wird dort bereits Keras importiert.
+        # Der Learner selbst hat seine Session schon, für ihn ändert sich nichts.
+        cuda_visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES')
+        if self.cpu_only:
+            os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        actors = []
+        try:
+            for i in range(self.nb_actors):
+                actor = context.Process(target=_actor, args=(i, self.actor_config, self.env_fn, self.actor_eps[i],
+                                                             self.seed + i, transition_queue, weight_queues[i],
+                                                             stop_event))
+                actor.daemon = True
+                actor.start()
+                actors.append(actor)
+        finally:
+            if cuda_visible_devices is None:
+                os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+            else:
+                os.environ['CUDA_VISIBLE_DEVICES'] = cuda_visible_devices
+
+        # agent.step zählt die empfangenen Transitionen (Warm-Up, beta-Schedule), train_steps die Lernschritte.
+        agent.training = True
+        agent.step = 0
+        train_steps = 0
+        history = {'episode_reward': [], 'nb_episode_steps': [], 'actor': []}
+        interval_start = time.time()
+        logged_episodes = 0
+
+        try:
+            while train_steps < nb_steps:
+                # Vor dem Warm-Up auf die Actors warten, danach nur abholen, was schon da ist.
+                self._receive(transition_queue, history, block=agent.step <= agent.nb_steps_warmup)
+                if agent.step <= agent.nb_steps_warmup:
+                    continue
+
+                # Neuer Zufall der Noisy-Layers (Online- und Target-Netzwerk) für jeden Lernschritt. Im hold-Modus
+                # (noise_hold_steps) zieht sonst nur forward() neuen Zufall, und das ruft der Learner nie auf.
+                if agent.noise_control.mode == 'hold':
+                    agent.noise_control.resample()
+                agent.train_step()
+                train_steps += 1
+
+                if agent.target_model_update >= 1 and train_steps % agent.target_model_update == 0:
+                    agent.update_target_model_hard()
+
+                if train_steps % self.weight_sync_interval == 0:
+                    self._send_weights(weight_queues)
+
+                if verbose and train_steps % log_interval == 0:
+                    rewards = history['episode_reward'][logged_episodes:]
+                    logged_episodes = len(history['episode_reward'])
+                    print('{} learner steps, {} transitions, {} in memory, {:.1f} steps/s, '
+                          'mean episode reward: {}'.format(train_steps, agent.step, len(memory),
+                                                           log_interval / (time.time() - interval_start),
+                                                           np.mean(rewards) if rewards else '-'))
+                    interval_start = time.time()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop_event.set()
+            # Actors können in put() blockieren, solange die Queue voll ist.
+            deadline = time.time() + 10.
+            while any(actor.is_alive() for actor in actors) and time.time() < deadline:
+                try:
+                    transition_queue.get(timeout=.1)
+                except queue.Empty:
+                    pass
+            for actor in actors:
+                if actor.is_alive():
+                    actor.terminate()
+                actor.join()
+
+        return history
+
+    def _receive(self, transition_queue, history, block):
+        # Wartende Nachrichten abholen, höchstens max_queue_size pro Aufruf, damit der Learner weiter lernt.
+        for i in range(self.max_queue_size):
+            try:
+                if block and i == 0:
+                    message = transition_queue.get(timeout=1.)
+                else:
+                    message = transition_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            if message[0] == 'transitions':
+                for obs_t, action, reward, obs_tp1, done, priority in message[2]:
+                    self.agent.memory.add(obs_t, action, reward, obs_tp1, done, priority=priority)
+                    self.agent.step += 1
+            elif message[0] == 'episode':
+                _, actor_idx, episode_reward, episode_step = message
+                history['episode_reward'].append(episode_reward)
+                history['nb_episode_steps'].append(episode_step)
+                history['actor'].append(actor_idx)
+
+    def _send_weights(self, weight_queues):
+        # Veraltete, noch nicht abgeholte Gewichte durch die neuen ersetzen.
+        weights = self.agent.model.get_weights()
+        for weight_queue in weight_queues:
+            try:
+                weight_queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                weight_queue.put_nowait(weights)
+            except queue.Full:
+                pass
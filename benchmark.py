@@ -0,0 +1,43 @@
+import timeit
+from copy import deepcopy
+import numpy as np
+
+
+# Micro-Benchmarks für einzelne Teile der Trainingsschleife, ohne StarCraft II und ohne GPU.
+# Aufruf: python benchmark.py
+
+
+def _feature_screen(screen):
+    # pysc2 liefert pro Schritt alle Screen-Feature-Layers in einem neuen (17, screen, screen) int32 Array;
+    # player_relative ist Ebene 5, selected Ebene 7.
+    return np.random.randint(0, 5, (17, screen, screen)).astype(np.int32)
+
+
+def _observation_deepcopy(feature_screen):
+    # Bisher: Liste aus zwei Views vom Environment, Agent3.fit() kopierte sie mit deepcopy.
+    return deepcopy([feature_screen[5], feature_screen[7]])
+
+
+def _observation_planes(feature_screen):
+    # Jetzt: Sc2Env2Outputs._small_observation() kopiert nur die zwei Ebenen in ein neues, schreibgeschütztes Array
+    # (kein View, der die ganzen 17 Ebenen festhält), fit() kopiert nicht mehr.
+    observation = feature_screen[[5, 7]]
+    observation.flags.writeable = False
+    return observation
+
+
+def benchmark_observation_copy(screens=(16, 32, 64), number=20000):
+    """Zeit pro Schritt für die Observation in fit(): deepcopy der Liste gegen die Kopie der zwei Ebenen.
+    Das Speichern im Replay Memory (eine Kopie) ist in beiden Fällen gleich und nicht enthalten.
+    """
+    print('Observation pro Schritt (µs), {} Wiederholungen'.format(number))
+    print('{:>8} {:>10} {:>10} {:>10}'.format('screen', 'deepcopy', 'copy', 'gespart'))
+    for screen in screens:
+        feature_screen = _feature_screen(screen)
+        old = min(timeit.repeat(lambda: _observation_deepcopy(feature_screen), number=number, repeat=3)) / number
+        new = min(timeit.repeat(lambda: _observation_planes(feature_screen), number=number, repeat=3)) / number
+        print('{:>8} {:>10.2f} {:>10.2f} {:>10.2f}'.format(screen, old * 1e6, new * 1e6, (old - new) * 1e6))
+
+
+if __name__ == '__main__':
+    benchmark_observation_copy()
@@ -0,0 +1,256 @@
+import os
+import pickle
+import random
+import shutil
+import warnings
+
+import numpy as np
+import keras.backend as K
+from rl.callbacks import Callback
+
+
+# Checkpoint des kompletten Trainingszustands, damit ein abgebrochener Lauf (Absturz von StarCraft II, Neustart des
+# Rechners, ...) genau dort weitermacht, wo er war, statt mit leerem Replay Memory, step = 0, neuem Warm-Up und
+# wieder hohem Epsilon. Gespeichert werden:
+# - Gewichte von Model und Target-Model, Zustand des Optimizers (z.B. Adam Momente und Iterationen)
+# - Replay Memory inklusive Prioritäten (get_state()/observation_storages(), siehe prioReplayBuffer.py)
+# - agent.step und agent.episode; Epsilon (LinearAnnealedPolicy) und beta-Schedule hängen nur von agent.step ab
+# - Zustand der Zufallsgeneratoren von numpy und random sowie der festgehaltene Zufall der Noisy-Layers
+# Nicht gespeichert werden können der Zustand des Environments und die Zufallsgeneratoren im TensorFlow-Graph;
+# fortgesetzt wird deshalb immer mit einer neuen Episode.
+#
+# Ein Checkpoint beginnt am Anfang einer Episode, dann ist der n-Step RingBuffer leer und es geht keine angefangene
+# Transition verloren. Das gilt nur mit einem Environment: bei Agent3.fit_vectorized() mit mehreren sind die anderen
+# gerade mitten in ihren Episoden, deren RingBuffer stehen nicht im Checkpoint. TrainingCheckpoint verweigert dort
+# deshalb den Dienst. Gewichte, Zähler und die Metadaten des Memorys werden sofort geschrieben, die großen Observation-Arrays danach stückweise mit chunk_size
+# Zeilen pro Trainingsschritt, ohne sie vorher zu kopieren. Das geht, weil der Ring von der Stelle an geschrieben
+# wird, die das Memory als nächstes überschreibt: solange pro Schritt mehr Zeilen gesichert als neu eingefügt werden,
+# liegt jede gesicherte Zeile noch im Zustand vom Beginn des Checkpoints vor. Der Checkpoint wird in path + '.tmp'
+# aufgebaut und erst komplett an die Stelle des alten geschoben.
+
+_STATE_FILE = 'state.pkl'
+_MEMORY_FILE = 'memory.pkl'
+
+
+def _memory_of(agent):
+    # PrefetchingReplayBuffer hält das eigentliche Memory in _memory.
+    memory = agent.memory
+    return getattr(memory, '_memory', memory)
+
+
+def _optimizer(agent):
+    # AdditionalUpdatesOptimizer (soft target updates) hält den eigentlichen Optimizer in optimizer.
+    optimizer = agent.trainable_model.optimizer
+    return getattr(optimizer, 'optimizer', optimizer)
+
+
+def _noise_state(agent):
+    noise_control = getattr(agent, 'noise_control', None)
+    if noise_control is None:
+        return None
+    held = [variable for layer in noise_control.layers for variable in layer.held_epsilon]
+    return {'mode': noise_control.mode, 'steps': noise_control._steps, 'held_epsilon': K.batch_get_value(held)}
+
+
+def _set_noise_state(agent, noise_state):
+    noise_control = getattr(agent, 'noise_control', None)
+    if noise_control is None or noise_state is None:
+        return
+    noise_control.set_mode(noise_state['mode'])
+    held = [variable for layer in noise_control.layers for variable in layer.held_epsilon]
+    K.batch_set_value(list(zip(held, noise_state['held_epsilon'])))
+    noise_control._steps = noise_state['steps']
+
+
+def _storage_file(directory, name, key):
+    return os.path.join(directory, 'obs_{}_{}.npy'.format(name, key))
+
+
+def checkpoint_path(path):
+    """Returns the directory of the latest complete checkpoint at `path` or `None`.
+    """
+    # path + '.old' existiert nur, wenn der Prozess genau beim Austauschen abgebrochen ist.
+    for candidate in (path, path + '.old'):
+        if os.path.exists(os.path.join(candidate, _STATE_FILE)):
+            return candidate
+    return None
+
+
+def load_training_state(agent, path):
+    """Restores a checkpoint written by `TrainingCheckpoint` into a compiled agent.
+
+    Continue training with `agent.fit(..., resume=True)` (or `fit_vectorized`), which keeps `agent.step` and
+    `agent.episode` instead of starting at 0.
+
+    # Arguments
+        agent: The compiled agent (same model and memory configuration as the checkpointed one).
+        path: Path of the checkpoint (as given to `TrainingCheckpoint`).
+
+    # Returns
+        A dict with the restored `step` and `episode`.
+    """
+    directory = checkpoint_path(path)
+    if directory is None:
+        raise IOError('No complete checkpoint found at "{}".'.format(path))
+
+    with open(os.path.join(directory, _STATE_FILE), 'rb') as f:
+        state = pickle.load(f)
+
+    agent.model.load_weights(os.path.join(directory, 'model.h5f'))
+    agent.target_model.load_weights(os.path.join(directory, 'target_model.h5f'))
+    if state['optimizer']:
+        optimizer = _optimizer(agent)
+        if len(optimizer.weights) != len(state['optimizer']):
+            # Die Variablen des Optimizers entstehen erst mit der Train-Funktion. Mit fused_td_errors gibt es sie
+            # schon seit compile(), eine zweite Train-Funktion bekäme eigene Variablen.
+            agent.trainable_model._make_train_function()
+        K.batch_set_value(list(zip(optimizer.weights, state['optimizer'])))
+
+    memory = _memory_of(agent)
+    with open(os.path.join(directory, _MEMORY_FILE), 'rb') as f:
+        memory.set_state(pickle.load(f))
+    if state['storages']:
+        # Observation-Arrays anhand einer leeren Beispiel-Observation anlegen und stückweise einlesen.
+        memory._allocate_observations(np.zeros(state['obs_shape'], dtype=state['obs_dtype']))
+        for name, storage, _ in memory.observation_storages():
+            for key, array in storage.arrays().items():
+                saved = np.load(_storage_file(directory, name, key), mmap_mode='r')
+                for start in range(0, len(array), 65536):
+                    array[start:start + 65536] = saved[start:start + 65536]
+                del saved
+
+    np.random.set_state(state['np_random'])
+    random.setstate(state['random'])
+    _set_noise_state(agent, state['noise'])
+
+    agent.step = state['step']
+    agent.episode = state['episode']
+    return {'step': state['step'], 'episode': state['episode']}
+
+
+class TrainingCheckpoint(Callback):
+    """Writes the full training state every `interval` steps, see `load_training_state`.
+    Only for training with one environment (`fit`, or `fit_vectorized` with a single environment).
+
+    # Arguments
+        path: Directory of the checkpoint (replaced by every new checkpoint).
+        interval: Number of steps between two checkpoints; a checkpoint starts with the next episode.
+        chunk_size: Number of observations per storage written per step.
+    """
+
+    def __init__(self, path, interval=100000, chunk_size=4096):
+        super(TrainingCheckpoint, self).__init__()
+        self.path = path
+        self.interval = interval
+        self.chunk_size = chunk_size
+
+        self._last_step = 0
+        self._jobs = None
+        self._state = None
+
+    @property
+    def writing(self):
+        return self._jobs is not None
+
+    def on_train_begin(self, logs=None):
+        if hasattr(self.env, '__len__') and len(self.env) > 1:
+            raise ValueError('TrainingCheckpoint only supports training with one environment.')
+        self._last_step = self.model.step
+
+    def on_episode_begin(self, episode, logs=None):
+        if not self.writing and self.model.step - self._last_step >= self.interval:
+            self._begin(episode)
+
+    def on_step_end(self, step, logs=None):
+        if self.writing:
+            self._write_chunks()
+
+    def on_train_end(self, logs=None):
+        # Angefangenen Checkpoint noch fertig schreiben.
+        while self.writing:
+            self._write_chunks()
+
+    def _begin(self, episode):
+        agent = self.model
+        memory = _memory_of(agent)
+        directory = self.path + '.tmp'
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+
+        # Alles außer den Observations sofort.
+        agent.model.save_weights(os.path.join(directory, 'model.h5f'), overwrite=True)
+        agent.target_model.save_weights(os.path.join(directory, 'target_model.h5f'), overwrite=True)
+        with open(os.path.join(directory, _MEMORY_FILE), 'wb') as f:
+            pickle.dump(memory.get_state(), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        storages = memory.observation_storages()
+        self._state = {
+            'step': int(agent.step),
+            'episode': int(episode),
+            'optimizer': K.batch_get_value(_optimizer(agent).weights),
+            'np_random': np.random.get_state(),
+            'random': random.getstate(),
+            'noise': _noise_state(agent),
+            'storages': [name for name, _, _ in storages],
+            'obs_shape': storages[0][1].shape if storages else None,
+            'obs_dtype': storages[0][1].dtype if storages else None,
+        }
+
+        # Pro Observation-Storage: Ziel-Dateien, Startzeile (die als nächstes überschriebene) und Anzahl der bis
+        # zum Beginn geschriebenen Zeilen, um später Überholen zu erkennen.
+        self._jobs = []
+        for name, storage, nb_written in storages:
+            outputs = {key: np.lib.format.open_memmap(_storage_file(directory, name, key), mode='w+',
+                                                      dtype=array.dtype, shape=array.shape)
+                       for key, array in storage.arrays().items()}
+            self._jobs.append({'name': name, 'storage': storage, 'outputs': outputs, 'nb_written': nb_written,
+                               'start': nb_written % len(storage), 'done': 0})
+        self._last_step = agent.step
+        # Der erste Chunk sofort: die Zeilen an der Startposition werden schon mit dem nächsten add() überschrieben.
+        self._write_chunks()
+
+    def _write_chunks(self):
+        nb_written = {name: n for name, _, n in _memory_of(self.model).observation_storages()}
+
+        for job in self._jobs:
+            size = len(job['storage'])
+            if job['done'] == size:
+                continue
+            if nb_written[job['name']] - job['nb_written'] > job['done']:
+                # Das Memory hat eine noch nicht gesicherte Zeile überschrieben (chunk_size zu klein).
+                warnings.warn('Replay memory overtook the checkpoint, it is discarded. Increase chunk_size.')
+                self._abort()
+                return
+
+            rows = (job['start'] + job['done'] + np.arange(min(self.chunk_size, size - job['done']))) % size
+            for key, array in job['storage'].arrays().items():
+                job['outputs'][key][rows] = array[rows]
+            job['done'] += len(rows)
+
+        if all(job['done'] == len(job['storage']) for job in self._jobs):
+            # (auch ohne Observation-Storages, z.B. bei leerem Memory)
+            self._finish()
+
+    def _finish(self):
+        directory = self.path + '.tmp'
+        for job in self._jobs:
+            for output in job['outputs'].values():
+                output.flush()
+        self._jobs = None
+
+        # state.pkl zuletzt: erst damit ist der Checkpoint vollständig.
+        with open(os.path.join(directory, _STATE_FILE), 'wb') as f:
+            pickle.dump(self._state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._state = None
+
+        if os.path.exists(self.path):
+            os.rename(self.path, self.path + '.old')
+        os.rename(directory, self.path)
+        if os.path.exists(self.path + '.old'):
+            shutil.rmtree(self.path + '.old')
+
+    def _abort(self):
+        self._jobs = None
+        self._state = None
+        shutil.rmtree(self.path + '.tmp', ignore_errors=True)
@@ -1,5 +1,9 @@
 from rl.callbacks import Callback
 import json
+import queue
+import threading
+import timeit
+import warnings
 import numpy as np
 from subprocess import Popen, PIPE, STDOUT
 import psutil as ps
@@ -32,23 +36,153 @@ def gpu_mon():
     return real_values
 
 
+# Hängt Einträge (dicts) als je eine JSON-Zeile an eine Datei an. Serialisieren und Schreiben passieren in einem
+# Hintergrund-Thread alle flush_interval Sekunden, die Trainingsschleife legt die Einträge nur in eine Queue.
+# Jede Zeile wird komplett geschrieben, bevor geflusht wird; Leser (plot.read_log_lines) verarbeiten nur Zeilen, die
+# mit einem Zeilenumbruch enden, und können die Datei deshalb jederzeit lesen, auch während des Trainings.
+class JsonLinesWriter(object):
+    def __init__(self, filepath, flush_interval=5.):
+        self.filepath = filepath
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._file = None
+        self._thread = None
+
+    def start(self):
+        self._file = open(self.filepath, 'a')
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def append(self, record):
+        self._queue.put(record)
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self._write_pending()
+        self._write_pending()
+
+    def _write_pending(self):
+        lines = []
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            lines.append(json.dumps(record, default=_native) + '\n')
+        if lines:
+            self._file.write(''.join(lines))
+            self._file.flush()
+
+
+def _native(value):
+    # json kann z.B. np.float32 nicht serialisieren
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+class StreamingLogger(Callback):
+    """Append-only training log: one JSON line per episode, written from a background thread.
+
+    Each line contains the same values as one episode of keras-rl's `FileLogger` (`episode`, `duration`, the mean of
+    every metric over the episode and the episode logs, e.g. `episode_reward`, `nb_episode_steps` and `nb_steps`).
+    Unlike `FileLogger`, the file is never rewritten; see `plot.load_log` and `plot.read_log_lines` for reading it.
+
+    # Arguments
+        filepath: Path of the log file (`.jsonl`); an existing file is appended to.
+        flush_interval: Seconds between two writes of the background thread.
+    """
+
+    def __init__(self, filepath, flush_interval=5.):
+        super(StreamingLogger, self).__init__()
+        self.filepath = filepath
+        self.writer = JsonLinesWriter(filepath, flush_interval=flush_interval)
+
+        self.metrics_names = []
+        self.metrics = {}
+        self.starts = {}
+
+    def on_train_begin(self, logs=None):
+        self.metrics_names = self.model.metrics_names
+        self.writer.start()
+
+    def on_train_end(self, logs=None):
+        self.writer.close()
+
+    def on_episode_begin(self, episode, logs=None):
+        self.metrics[episode] = []
+        self.starts[episode] = timeit.default_timer()
+
+    def on_step_end(self, step, logs=None):
+        # (mit fit_vectorized() laufen mehrere Episoden gleichzeitig)
+        if 'metrics' in logs:
+            self.metrics[logs['episode']].append(logs['metrics'])
+
+    def on_episode_end(self, episode, logs=None):
+        record = {
+            'episode': episode,
+            'duration': timeit.default_timer() - self.starts.pop(episode),
+        }
+
+        metrics = np.array(self.metrics.pop(episode), dtype=np.float64).reshape(-1, len(self.metrics_names))
+        with warnings.catch_warnings():
+            # Episoden ohne Lernschritt (Warm-Up) haben nur NaN-Metriken.
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            for idx, name in enumerate(self.metrics_names):
+                record[name] = float(np.nanmean(metrics[:, idx])) if len(metrics) else float('nan')
+
+        record.update(logs or {})
+        self.writer.append(record)
+
+
 class GpuLogger(Callback):
+    """Logs GPU, CPU and memory usage at the end of every episode.
+
+    With a `.jsonl` filepath every episode is appended as one JSON line (see `JsonLinesWriter`), otherwise the whole
+    history is written as one JSON object every `interval` episodes.
+    """
+
     def __init__(self, filepath, interval=None, printing=False):
         self.filepath = filepath
         self.interval = interval
         self.printing = printing
 
         self.data = {}
+        self.writer = JsonLinesWriter(filepath) if filepath.endswith('.jsonl') else None
+
+    def on_train_begin(self, logs=None):
+        if self.writer is not None:
+            self.writer.start()
 
     def on_train_end(self, logs=None):
         """ Save model at the end of training """
-        self.save_data()
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self.save_data()
 
     def on_episode_end(self, episode, logs={}):
         """Called at end of each episode"""
         data = gpu_mon()
         data["episode"] = episode
 
+        if self.writer is not None:
+            self.writer.append(data)
+            if self.printing and self.interval is not None and episode % self.interval == 0:
+                print(data)
+            return
+
         for key, value in data.items():
             if key not in self.data:
                 self.data[key] = []
@@ -5,16 +5,44 @@ from pysc2.lib import actions
 import numpy as np
 
 FUNCTIONS = actions.FUNCTIONS
+_PLAYER_RELATIVE = features.SCREEN_FEATURES.player_relative.index
+_SELECTED = features.SCREEN_FEATURES.selected.index
+_MOVE_SCREEN = FUNCTIONS.Move_screen.id
+
+
+def _action_table(screen):
+    # Alle pysc2 FunctionCalls, die Sc2Env2Outputs erzeugen kann, einmal vorab gebaut: table[action, y, x].
+    # FunctionCalls sind unveränderliche namedtuples, dürfen also für jeden Schritt wiederverwendet werden.
+    # (einzeln zuweisen, sonst würde numpy das namedtuple als Sequenz broadcasten)
+    table = np.empty((3, screen, screen), dtype=object)
+    no_op = FUNCTIONS.no_op()
+    for y in range(screen):
+        for x in range(screen):
+            table[0, y, x] = no_op
+            table[1, y, x] = FUNCTIONS.Move_screen("now", (x, y))
+            table[2, y, x] = FUNCTIONS.select_point("toggle", (x, y))
+    return table
+
+
+def available_actions_mask(timestep):
+    # Bitmaske der in diesem Schritt verfügbaren pysc2 Funktionen (Index = Funktions-Id).
+    mask = np.zeros(len(FUNCTIONS), dtype=bool)
+    mask[timestep.observation.available_actions] = True
+    return mask
 
 
 # Environment Wrapper für StarCraft2 (pysc2 Bibliothek)
 # Erwartet als Action das Output-Format der FullyConv Netzwerk Architektur: ein Tupel bestehend aus zwei Arrays:
 # - einem linearen, welches Q-Werte für jede unterschiedliche Aktion enthält
 # - einem zweidimensionalen, welches Q-Werte für jede Koordinate auf dem Screen enthält
-# Die Methode action_to_sc2 wandelt dabei diesen Output in für pysc2 verwendbare Actions um.
+# Die Methode action_to_sc2 wandelt dabei diesen Output in für pysc2 verwendbare Actions um. Die FunctionCalls kommen
+# aus einer vorab gebauten Tabelle, die verfügbaren Aktionen aus einer Bitmaske (available_actions_mask).
 # Außerdem wird die Art der Observation definiert; hier werden aktuell zwei Feature-Layers übergeben:
 # - feature_screen.player_relative (Ganzzahlige Klassen 0-3 für (Nichts, Spieler, Gegner, Neutral))
 # - feature_screen.selected (1 für selektierte Einheit, 0 für rest)
+# Beide Ebenen werden in ein neues, schreibgeschütztes (2, screen, screen) Array kopiert (kein View, der alle 17
+# Feature-Layers festhalten würde). Das Array gehört allein dem Aufrufer; Agent3 übernimmt die Observations ohne weitere
+# Kopie in RingBuffer und Replay Memory (siehe Agent3.fit()).
 # Die Klasse implementiert das Interface Keras-rl/core/Env.
 class Sc2Env2Outputs(Env):
     last_obs = None
@@ -43,26 +71,19 @@ class Sc2Env2Outputs(Env):
             visualize=self._VISUALIZE
         )
 
-    def action_to_sc2(self, act):
-
-        real_action = FUNCTIONS.no_op()
-
-        if act.action == 1:
-            if 331 in self.last_obs.observation.available_actions:
-
-                real_action = FUNCTIONS.Move_screen("now", (act.coords[1], act.coords[0]))
-
-        elif act.action == 2:
+        self._action_table = _action_table(self._SCREEN)
+        self.available_actions = np.zeros(len(FUNCTIONS), dtype=bool)
 
-            real_action = FUNCTIONS.select_point("toggle", (act.coords[1], act.coords[0]))
+    def action_to_sc2(self, act):
+        action = act.action
 
-        elif act.action == 0:
-            pass
-        else:
+        if action == 1 and not self.available_actions[_MOVE_SCREEN]:
+            action = 0
+        elif not 0 <= action <= 2:
             print(act.action, "wtf")
             assert False
 
-        return real_action
+        return self._action_table[action, act.coords[0], act.coords[1]]
 
     def step(self, action):
         # print(action, " ACTION")
@@ -71,28 +92,38 @@ class Sc2Env2Outputs(Env):
 
         observation = self.env.step(actions=(real_action,))
         self.last_obs = observation[0]
+        self.available_actions = available_actions_mask(self.last_obs)
 
         # small_observation = observation[0].observation.feature_screen.unit_density
-        small_observation = [observation[0].observation.feature_screen.player_relative,
-                             observation[0].observation.feature_screen.selected]
+        small_observation = self._small_observation(observation[0])
 
         return small_observation, observation[0].reward, observation[0].last(), {}
 
     def reset(self):
         observation = self.env.reset()
 
-        if self._TRAINING and np.random.random_integers(0, 1) == 4:
+        if self._TRAINING and np.random.randint(0, 2) == 4:
             ys, xs = np.where(observation[0].observation.feature_screen.player_relative == 1)
             observation = self.env.step(actions=(FUNCTIONS.select_point("toggle", (xs[0], ys[0])),))
 
         observation = self.env.step(actions=(FUNCTIONS.select_army(0),))
 
         self.last_obs = observation[0]
+        self.available_actions = available_actions_mask(self.last_obs)
 
         # small_observation = observation[0].observation.feature_screen.unit_density
-        small_observation = [observation[0].observation.feature_screen.player_relative,
-                             observation[0].observation.feature_screen.selected]
+        small_observation = self._small_observation(observation[0])
+
+        return small_observation
 
+    @staticmethod
+    def _small_observation(timestep):
+        # Ebenen player_relative und selected als neues, zusammenhängendes Array (Fancy Indexing kopiert). Kein View auf
+        # feature_screen: der würde alle 17 Ebenen im Speicher halten, solange die Observation (z.B. im Replay Memory)
+        # lebt.
+        feature_screen = np.asarray(timestep.observation.feature_screen)
+        small_observation = feature_screen[[_PLAYER_RELATIVE, _SELECTED]]
+        small_observation.flags.writeable = False
         return small_observation
 
     def render(self, mode: str = 'human', close: bool = False):
@@ -325,7 +356,7 @@ class Sc2Env1Output(Env):
     def reset(self):
         observation = self.env.reset()
 
-        if self._TRAINING and np.random.random_integers(1, 1) == 1:
+        if self._TRAINING and np.random.randint(1, 2) == 1:
             ys, xs = np.where(observation[0].observation.feature_screen.player_relative == 1)
             observation = self.env.step(actions=(FUNCTIONS.select_point("toggle", (xs[0], ys[0])),))
 
@@ -0,0 +1,90 @@
+import json
+import os
+import re
+
+import numpy as np
+
+
+# Auswertung vieler Gewichte eines Laufs in einem Aufruf, z.B. aller dqn_weights_{step}.h5f, die ModelIntervalCheckpoint
+# während des Trainings schreibt. Pro Checkpoint werden nb_episodes Test-Episoden gespielt, verteilt auf die
+# Environments eines VecEnv (z.B. SubprocVecEnv mit einer StarCraft II Instanz pro Worker) und mit einem gemeinsamen
+# Forward-Pass pro Schritt (siehe Agent3.test_vectorized()). Die Statistik jedes Checkpoints (mean/std/max wie
+# plot.test_plot) landet in einer einzigen JSON-Datei, die nach jedem Checkpoint neu geschrieben wird; ein erneuter
+# Aufruf überspringt bereits ausgewertete Checkpoints.
+
+_WEIGHTS_PATTERN = re.compile(r'^dqn_weights_(\d+)\.h5f$')
+
+
+def checkpoint_weight_files(directory):
+    """Returns the weight files `dqn_weights_{step}.h5f` in `directory` as a list of `(step, path)`, sorted by step.
+    """
+    weight_files = []
+    for filename in os.listdir(directory):
+        match = _WEIGHTS_PATTERN.match(filename)
+        if match:
+            weight_files.append((int(match.group(1)), os.path.join(directory, filename)))
+    return sorted(weight_files)
+
+
+def load_results(results_filename):
+    """Returns the list of results written by `evaluate_checkpoints` (empty if the file does not exist).
+    """
+    if not os.path.exists(results_filename):
+        return []
+    with open(results_filename) as f:
+        return json.load(f)
+
+
+def _save_results(results_filename, results):
+    # Erst vollständig schreiben, dann ersetzen: ein Abbruch hinterlässt nie eine halbe Datei.
+    with open(results_filename + '.tmp', 'w') as f:
+        json.dump(results, f)
+    os.replace(results_filename + '.tmp', results_filename)
+
+
+def evaluate_checkpoints(agent, vec_env, weight_files, results_filename, nb_episodes=100, nb_max_episode_steps=None,
+                         verbose=1):
+    """Tests the agent with every weight file and writes the reward statistics of all of them to one file.
+
+    # Arguments
+        agent: A compiled agent supporting `test_vectorized` (e.g. Sc2DqnAgent_v4).
+        vec_env: (`VecEnv` instance): Environments the test episodes are spread over, see vecEnv.py.
+        weight_files: List of `(step, path)`, e.g. from `checkpoint_weight_files`.
+        results_filename: JSON file with one entry per checkpoint: `step`, `weights`, `mean`, `std`, `max` and all
+            `episode_reward`s. Checkpoints already contained in it are skipped.
+        nb_episodes: Number of test episodes per checkpoint.
+        nb_max_episode_steps: See `Agent3.test_vectorized`.
+        verbose: 1 prints the statistics of every checkpoint.
+
+    # Returns
+        The list of results of all checkpoints in the file.
+    """
+    results = load_results(results_filename)
+    done = {result['weights'] for result in results}
+
+    for step, path in weight_files:
+        if path in done:
+            continue
+
+        agent.load_weights(path)
+        history = agent.test_vectorized(vec_env, nb_episodes=nb_episodes, verbose=0,
+                                        nb_max_episode_steps=nb_max_episode_steps)
+        rewards = [float(reward) for reward in history.history['episode_reward']]
+
+        result = {
+            'step': step,
+            'weights': path,
+            'mean': float(np.mean(rewards)),
+            'std': float(np.std(rewards)),
+            'max': float(np.max(rewards)),
+            'episode_reward': rewards,
+        }
+        results.append(result)
+        results.sort(key=lambda r: r['step'])
+        _save_results(results_filename, results)
+
+        if verbose:
+            print('step {}: mean {:.3f}, std {:.3f}, max {:.3f} ({} episodes)'.format(
+                step, result['mean'], result['std'], result['max'], len(rewards)))
+
+    return results
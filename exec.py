@@ -3,17 +3,23 @@ import traceback
 import os
 import json
 import random
+import functools
+import multiprocessing
 from absl import app
 
 # own classes
 from env import Sc2Env1Output, Sc2Env2Outputs
 from sc2Processor import Sc2Processor
+from vecEnv import SerialVecEnv, SubprocVecEnv
+from apex import ApeXTrainer
 from sc2Policy import Sc2Policy, Sc2PolicyD
 from sc2DqnAgent import SC2DQNAgent, Sc2DqnAgent_v2, Sc2DqnAgent_v3, Sc2DqnAgent_v4, Sc2DqnAgent_v5
 from noisyNetLayers import NoisyDense, NoisyConv2D
-from prioReplayBuffer import PrioritizedReplayBuffer, ReplayBuffer
-from customCallbacks import GpuLogger
-from plot import test_plot
+from prioReplayBuffer import PrioritizedReplayBuffer, ReplayBuffer, PrioritizedFrameReplayBuffer, FrameReplayBuffer, \
+    PrefetchingReplayBuffer
+from customCallbacks import GpuLogger, StreamingLogger
+from checkpoint import TrainingCheckpoint, load_training_state, checkpoint_path
+from evaluation import checkpoint_weight_files, evaluate_checkpoints
 
 # framework classes
 from pysc2.env import sc2_env
@@ -64,6 +70,9 @@ def extensive_testing():
 
     for i in range(1, 3):
         results_dir = "weights/{}/{}/{}".format(_ENV_NAME, name, i)
+        # Nach einem Abbruch: fertige Läufe überspringen, der abgebrochene setzt am letzten Checkpoint fort.
+        if os.path.exists(results_dir + '/dqn_weights.h5f'):
+            continue
         fully_conf_v_10(results_dir)
         K.clear_session()
 
@@ -99,20 +108,70 @@ def fully_conf_v_10(a_dir):
         dueling = True
         prio_replay = True
         noisy_nets = True
+        # factorized_noise = True  zieht in den Noisy-Layers nur Input- und Output-Zufallsvektoren statt einer
+        # Zufallsmatrix in Kernel-Größe. Ändert auch die Initialisierung von sigma (0.5 / sqrt(fan_in) statt 0.017),
+        # noch nicht in einem Trainingslauf mit den bisherigen Ergebnissen verglichen, deshalb aus.
+        factorized_noise = False
+        # noise_hold_steps: Zufall der Noisy-Layers für so viele Schritte festhalten (None: neuer Zufall je Aufruf).
+        # Ändert die Exploration, noch nicht in einem Trainingslauf mit den bisherigen Ergebnissen verglichen.
+        noise_hold_steps = None
         multi_step_size = 3
 
         # weitere HyperParameter
         action_repetition = 1
+        # nb_envs > 1 trainiert mit mehreren StarCraft II Instanzen gleichzeitig (ein Forward-Pass für alle,
+        # siehe Agent3.fit_vectorized()); action_repetition wird dabei nicht unterstützt.
+        nb_envs = 1
+        # subprocess_envs = True  startet jede Instanz in einem eigenen Prozess (Observations über Shared Memory).
+        subprocess_envs = True
+        # apex = True  trennt Acting und Lernen (Ape-X): nb_actors Prozesse spielen, dieser Prozess lernt nur noch,
+        # siehe apex.py. Benötigt prio_replay.
+        apex = False
+        nb_actors = 4
         gamma = .99
+        batch_size = 32
         memory_size = 200000
+        # compact_memory = True speichert die Observations im Replay Memory bitweise gepackt: player_relative in 3 Bits,
+        # selected in einem (bei _SCREEN = 32 512 statt 8192 Byte, das Netzwerk bekommt weiterhin die gleichen Werte).
+        # Noch nicht in einem Trainingslauf mit den bisherigen Ergebnissen verglichen, deshalb aus.
+        compact_memory = False
+        # memory_on_disk = True  legt die Observations des Replay Memorys als np.memmap in den Ergebnisordner
+        # (für sehr große memory_size), nur Metadaten und Prioritäten bleiben im RAM.
+        memory_on_disk = False
+        # prefetch_batches = True  zieht und dekodiert die Batches in einem Hintergrund-Thread, während trainiert wird.
+        # Die Prioritäten stimmen mit denen ohne Prefetching überein (siehe tests/test_prioReplayBuffer.py), die Batches
+        # stammen aber aus einem bis zu queue_size + 1 Batches älteren Memory. Noch nicht in einem Trainingslauf
+        # verglichen, deshalb aus.
+        prefetch_batches = False
         learning_rate = .0001
         warm_up_steps = 4000
         train_interval = 4
+        # checkpoint_interval: alle so vielen Schritte den kompletten Trainingszustand (Gewichte, Optimizer, Replay
+        # Memory, Zähler, Zufallsgeneratoren) im Ergebnisordner sichern; ein neuer Start im selben Ordner setzt
+        # dort fort (siehe checkpoint.py). None schaltet das ab, mit Ape-X oder nb_envs > 1 wird nicht gesichert.
+        checkpoint_interval = 100000
 
         # Einstellungen für das Prioritized Experience Replay
         # bad_prio_replay = True  schaltet Benutzen der fachlich falschen, aber besser/gleichwertig
         # performenden Implementierung ein.
         bad_prio_replay = True
+        # fused_td_errors = True  berechnet die neuen Prioritäten im Lernschritt selbst (kein zweiter Forward-Pass).
+        # Achtung, das ändert auch die Prioritäten: es sind die TD-Fehler vor dem Update statt danach, und mit
+        # bad_prio_replay die jedes einzelnen Samples statt Target und Maske des letzten Samples für alle. Deshalb aus,
+        # bis das in einem Trainingslauf verglichen ist.
+        fused_td_errors = False
+        # fused_targets = True  berechnet die (Double-DQN-)Targets in einem Graph-Aufruf statt zwei predict_on_batch().
+        # Gleiche Targets wie mit predict_on_batch() (siehe tests/test_sc2DqnAgent.py).
+        fused_targets = False
+        # fast_act = True  bestimmt die greedy Aktion in forward() direkt im Graph (ein Funktionsaufruf pro Schritt).
+        # Gleiche Aktionen wie argmax/unravel_index in Sc2Policy.select_action() (siehe tests/test_sc2DqnAgent.py),
+        # im Trainingslauf noch nicht gemessen, deshalb aus.
+        fast_act = False
+        # sparse_targets = True  übergibt dem Lernschritt nur Indizes, Targets und IS-Gewichte der gewählten Aktionen
+        # statt dichter (screen, screen, 1) Target- und Masken-Arrays. Gleicher Lernschritt, gleiche Metriken und
+        # Prioritäten wie der dichte Loss mit Masken (siehe tests/test_sc2DqnAgent.py), im Trainingslauf noch nicht
+        # gemessen, deshalb aus.
+        sparse_targets = False
         prio_replay_alpha = 0.6
         prio_replay_beta = (0.5, 1.0, 200000)   # (beta_start, beta_end, number_of_steps_to_go_from_start_to_end)
 
@@ -135,17 +194,29 @@ def fully_conf_v_10(a_dir):
 
         weights_filename = directory + '/dqn_weights.h5f'
         checkpoint_weights_filename = directory + '/dqn_weights_{step}.h5f'
-        log_filename = directory + '/dqn_log.json'
-        log_filename_gpu = directory + '/dqn_log_gpu.json'
+        log_filename = directory + '/dqn_log.jsonl'
+        log_filename_gpu = directory + '/dqn_log_gpu.jsonl'
+        training_state_path = directory + '/training_state'
         log_interval = 8000
 
         agent_hyper_params = {"SEED": seed, "NB_ACTIONS": nb_actions, "DUELING": dueling, "DOUBLE": double,
                               "PRIO_REPLAY": prio_replay, "NOISY_NETS": noisy_nets, "MULTI_STEP_SIZE": multi_step_size,
-                              "ACTION_REPETITION": action_repetition, "GAMMA": gamma, "MEMORY_SIZE": memory_size,
-                              "LEARNING_RATE": learning_rate, "WARM_UP_STEPS": warm_up_steps,
+                              "FACTORIZED_NOISE": factorized_noise, "NOISE_HOLD_STEPS": noise_hold_steps,
+                              "ACTION_REPETITION": action_repetition, "GAMMA": gamma, "BATCH_SIZE": batch_size,
+                              "MEMORY_SIZE": memory_size,
+                              "NB_ENVS": nb_envs, "SUBPROCESS_ENVS": subprocess_envs,
+                              "APEX": apex, "NB_ACTORS": nb_actors,
+                              "COMPACT_MEMORY": compact_memory, "LEARNING_RATE": learning_rate,
+                              "MEMORY_ON_DISK": memory_on_disk,
+                              "PREFETCH_BATCHES": prefetch_batches,
+                              "CHECKPOINT_INTERVAL": checkpoint_interval,
+                              "WARM_UP_STEPS": warm_up_steps,
                               "TRAIN_INTERVAL": train_interval, "LOG_INTERVAL": log_interval,
                               "PRIO_REPLAY_ALPHA": prio_replay_alpha, "PRIO_REPLAY_BETA": prio_replay_beta,
-                              "BAD_PRIO_REPLAY": bad_prio_replay, "EPS_START": eps_start, "EPS_END": eps_end,
+                              "BAD_PRIO_REPLAY": bad_prio_replay, "FUSED_TD_ERRORS": fused_td_errors,
+                              "FUSED_TARGETS": fused_targets, "FAST_ACT": fast_act,
+                              "SPARSE_TARGETS": sparse_targets,
+                              "EPS_START": eps_start, "EPS_END": eps_end,
                               "EPS_STEPS": eps_steps}
 
         # Definition des neuralen Netzwerks!
@@ -159,7 +230,7 @@ def fully_conf_v_10(a_dir):
         branch = Conv2D(32, (3, 3), padding='same', activation='relu')(x)
 
         if noisy_nets:
-            coord_out = NoisyConv2D(1, (1, 1), padding='same', activation='linear',
+            coord_out = NoisyConv2D(1, (1, 1), padding='same', activation='linear', factorized=factorized_noise,
                                     kernel_initializer='lecun_uniform',
                                     bias_initializer='lecun_uniform')(branch)
         else:
@@ -169,9 +240,9 @@ def fully_conf_v_10(a_dir):
 
         if noisy_nets:
             act_out = NoisyDense(256, activation='relu', kernel_initializer='lecun_uniform',
-                                 bias_initializer='lecun_uniform')(act_out)
+                                 bias_initializer='lecun_uniform', factorized=factorized_noise)(act_out)
             act_out = NoisyDense(nb_actions, activation='linear', kernel_initializer='lecun_uniform',
-                                 bias_initializer='lecun_uniform')(act_out)
+                                 bias_initializer='lecun_uniform', factorized=factorized_noise)(act_out)
         else:
             act_out = Dense(256, activation='relu')(act_out)
             act_out = Dense(nb_actions, activation='linear')(act_out)
@@ -181,11 +252,20 @@ def fully_conf_v_10(a_dir):
         # Speichern aller HyperParameter und der Netzwerkstruktur.
         save_hyper_parameters(full_conv_sc2, env, directory, agent_hyper_params)
 
-        # Erzeugung des Experience Replay Memorys (modifizierte Version der OpenAI/baselines Klasse gleichen Namens).
+        # Erzeugung des Experience Replay Memorys (modifizierte Version der OpenAI/baselines Klasse gleichen Namens,
+        # welche die Transitionen in vorallokierten numpy Arrays speichert und jede Observation nur einmal ablegt).
+        # Ebene 0 ist player_relative (Werte 0-4), Ebene 1 selected (0/1), siehe Sc2Env2Outputs.
+        memory_encoding = {'bit_planes': {0: 3, 1: 1}} if compact_memory else {}
+        if memory_on_disk:
+            memory_encoding['obs_path'] = directory + '/replay'
+        # Mit Ape-X kommen die Transitionen von nb_actors Actors.
+        nb_sources = nb_actors if apex else nb_envs
         if prio_replay:
-            memory = PrioritizedReplayBuffer(memory_size, prio_replay_alpha)
+            memory = PrioritizedFrameReplayBuffer(memory_size, prio_replay_alpha, multi_step_size=multi_step_size,
+                                                  nb_envs=nb_sources, **memory_encoding)
         else:
-            memory = ReplayBuffer(memory_size)
+            memory = FrameReplayBuffer(memory_size, multi_step_size=multi_step_size, nb_envs=nb_sources,
+                                       **memory_encoding)
 
         # Erzeugung einer Policy aus gegebenen Parametern, Sc2Policy verarbeitet beide Outputs des Netzwerks.
         policy = LinearAnnealedPolicy(Sc2Policy(env=env), attr='eps', value_max=eps_start, value_min=eps_end,
@@ -195,6 +275,9 @@ def fully_conf_v_10(a_dir):
         # Erzeugen eines Prozessors - dieser prüft nur die Dimension des Inputs (Observation) und macht sonst nichts.
         processor = Sc2Processor(screen=env._SCREEN)
 
+        if prefetch_batches:
+            memory = PrefetchingReplayBuffer(memory, batch_size=batch_size, processor=processor)
+
         # Erzeugung des eigentlichen Agents.
         # Dieser enthält die Implementierung des Lernalgorithmus.
         dqn = Sc2DqnAgent_v4(model=full_conv_sc2, nb_actions=nb_actions, screen_size=env._SCREEN,
@@ -205,7 +288,13 @@ def fully_conf_v_10(a_dir):
                              prio_replay_beta=prio_replay_beta,
                              bad_prio_replay=bad_prio_replay,
                              multi_step_size=multi_step_size,
-                             policy=policy, test_policy=test_policy, gamma=gamma, target_model_update=10000,
+                             fused_td_errors=fused_td_errors,
+                             fused_targets=fused_targets,
+                             noise_hold_steps=noise_hold_steps,
+                             fast_act=fast_act,
+                             sparse_targets=sparse_targets,
+                             policy=policy, test_policy=test_policy, gamma=gamma, batch_size=batch_size,
+                             target_model_update=10000,
                              train_interval=train_interval, delta_clip=1., custom_model_objects={
                                 'NoisyDense': NoisyDense,
                                 'NoisyConv2D': NoisyConv2D})
@@ -213,24 +302,42 @@ def fully_conf_v_10(a_dir):
         dqn.compile(Adam(lr=learning_rate), metrics=['mae'])
 
         if _TEST:
-            h = []
-            for i in range(1, 2):
-                # Hier die entsprechenden Gewichte laden, um einen Testlauf durchzuführen.
-                # Die Schleife kann benutzt werden, um eine Serie von Testläufen zusammen auszuführen.
-                dqn.load_weights('/pathToProjectFolder/dqn/weights/MoveToBeacon/my_first_run/' + i.__str__() + '/dqn_weights_3000000.h5f')
-
-                # Anzahl der Testläufe festlegen durch den nb_episodes Parameter.
-                history = dqn.test(env, nb_episodes=100, visualize=_VISUALIZE)
-                h.append(history.history['episode_reward'])
-
-            for his in h:
-                # Schreibt Standardabweichung, Maximalwert und Durchschnitt in die Kommandozeile.
-                test_plot(his)
+            # Alle Gewichte (dqn_weights_{step}.h5f) der hier angegebenen Läufe auswerten, je nb_episodes Testläufe
+            # verteilt auf nb_test_envs StarCraft II Instanzen. Durchschnitt, Standardabweichung und Maximalwert jedes
+            # Checkpoints stehen danach in test_results.json des jeweiligen Laufs (siehe evaluation.py).
+            test_dirs = ['/pathToProjectFolder/dqn/weights/MoveToBeacon/my_first_run/' + str(i) for i in range(1, 2)]
+            nb_test_envs = 8
+            env.close()
+
+            # Die TensorFlow-Session existiert hier schon: die Worker werden mit spawn statt fork gestartet
+            # (SubprocVecEnv), env_fn muss deshalb picklebar sein, die Seeds setzt vec_env.seed().
+            test_env_fn = functools.partial(Sc2Env2Outputs, screen=_SCREEN, visualize=False, env_name=_ENV_NAME,
+                                            training=False)
+            vec_env = SubprocVecEnv([test_env_fn] * nb_test_envs, observation_shape=(2, _SCREEN, _SCREEN),
+                                    timeout=600, context=multiprocessing.get_context('spawn'))
+            vec_env.seed(seed)
+            for test_dir in test_dirs:
+                evaluate_checkpoints(dqn, vec_env, checkpoint_weight_files(test_dir),
+                                     test_dir + '/test_results.json', nb_episodes=100)
+            vec_env.close()
 
         else:
-
-            callbacks = [ModelIntervalCheckpoint(checkpoint_weights_filename, interval=50000)]
-            callbacks += [FileLogger(log_filename, interval=100)]
+            # Abgebrochenen Lauf fortsetzen, falls im Ordner ein vollständiger Checkpoint liegt.
+            checkpointing = checkpoint_interval is not None and not apex and nb_envs == 1
+            resume = checkpointing and checkpoint_path(training_state_path) is not None
+            if resume:
+                restored = load_training_state(dqn, training_state_path)
+                print('Resuming training at step {}, episode {}.'.format(restored['step'], restored['episode']))
+                # Neue Log-Datei ab diesem Schritt, die bisherige bleibt erhalten.
+                log_filename = directory + '/dqn_log_{}.jsonl'.format(restored['step'])
+
+            model_checkpoint = ModelIntervalCheckpoint(checkpoint_weights_filename, interval=50000)
+            # Dateinamen der Gewichte zählen beim Fortsetzen weiter.
+            model_checkpoint.total_steps = int(dqn.step) if resume else 0
+            callbacks = [model_checkpoint]
+            callbacks += [StreamingLogger(log_filename)]
+            if checkpointing:
+                callbacks += [TrainingCheckpoint(training_state_path, interval=checkpoint_interval)]
 
             # Die folgende Zeile einkommentieren, falls eine NVidia-GPU verwendet wird, um GPU-Logging einzuschalten.
             # Das Kommandozeilentool nvidia-smi muss installiert sein.
@@ -239,8 +346,46 @@ def fully_conf_v_10(a_dir):
 
             # Startet den Lernprozess!
             # Festlegen der Anzahl an Schritten bis zum Ende des Lernprozesses durch nb_steps.
-            dqn.fit(env, nb_steps=3000000, nb_max_start_steps=0, callbacks=callbacks, log_interval=log_interval,
-                    action_repetition=action_repetition)
+            if apex:
+                # Jeder Actor startet seine eigene StarCraft II Instanz; gezählt werden hier Lernschritte.
+                env.close()
+                env_fn = functools.partial(Sc2Env2Outputs, screen=_SCREEN, visualize=False, env_name=_ENV_NAME,
+                                           training=True)
+                trainer = ApeXTrainer(dqn, env_fn, nb_actors=nb_actors, seed=seed)
+                trainer.fit(nb_steps=3000000 // train_interval, log_interval=log_interval)
+            elif nb_envs > 1 and subprocess_envs:
+                # Jeder Worker startet seine eigene StarCraft II Instanz, die Instanz im Hauptprozess wird
+                # vor dem Starten der Worker beendet. Die Worker werden mit spawn gestartet (die TensorFlow-Session
+                # existiert schon), env_fn muss deshalb picklebar sein; die Seeds (seed + i) setzt vec_env.seed().
+                env.close()
+                env_fn = functools.partial(Sc2Env2Outputs, screen=_SCREEN, visualize=False, env_name=_ENV_NAME,
+                                           training=True)
+                vec_env = SubprocVecEnv([env_fn] * nb_envs, observation_shape=(2, _SCREEN, _SCREEN), timeout=600)
+                vec_env.seed(seed)
+                dqn.fit_vectorized(vec_env, nb_steps=3000000, callbacks=callbacks, log_interval=log_interval,
+                                   resume=resume)
+                vec_env.close()
+            elif nb_envs > 1:
+                # Die erste Instanz (env) wird weiterverwendet, die weiteren bekommen eigene Seeds.
+                def make_env(i):
+                    def env_fn():
+                        if i == 0:
+                            return env
+                        new_env = Sc2Env2Outputs(screen=_SCREEN, visualize=False, env_name=_ENV_NAME, training=True)
+                        new_env.seed(seed + i)
+                        return new_env
+                    return env_fn
+
+                vec_env = SerialVecEnv([make_env(i) for i in range(nb_envs)])
+                dqn.fit_vectorized(vec_env, nb_steps=3000000, callbacks=callbacks, log_interval=log_interval,
+                                   resume=resume)
+                vec_env.close()
+            else:
+                dqn.fit(env, nb_steps=3000000, nb_max_start_steps=0, callbacks=callbacks, log_interval=log_interval,
+                        action_repetition=action_repetition, resume=resume)
+
+            if prefetch_batches:
+                memory.close()
 
             dqn.save_weights(weights_filename, overwrite=True)
 
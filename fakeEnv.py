@@ -0,0 +1,89 @@
+from rl.core import Env
+import numpy as np
+
+
+# Leichtgewichtiger Ersatz für Sc2Env2Outputs ohne StarCraft II, z.B. um Trainingsschleifen, VecEnvs und Replay
+# Memorys schnell durchlaufen zu lassen. Hält sich an denselben Vertrag wie Sc2Env2Outputs:
+# - Observation: neues, schreibgeschütztes (2, screen, screen) int32 Array [player_relative, selected]
+# - Action: Sc2Action mit action (0 NO_OP, 1 MOVE_SCREEN, 2 SELECT_POINT(toggle)) und coords (y, x)
+# - step() gibt (observation, reward, done, {}) zurück, reset() nur die Observation.
+# Das Spiel ist MoveToBeacon nachempfunden: die Einheit (player_relative 1) muss selektiert sein, um sich
+# zu bewegen; erreicht sie das Beacon (player_relative 3), gibt es Reward 1 und das Beacon springt weiter.
+class FakeSc2Env2Outputs(Env):
+
+    def __init__(self, screen=16, episode_length=120, seed=None):
+        self._SCREEN = screen
+        self._EPISODE_LENGTH = episode_length
+        self.random = np.random.RandomState(seed)
+
+        self.unit = None
+        self.beacon = None
+        self.selected = False
+        self.episode_step = 0
+
+    def _random_position(self):
+        return tuple(self.random.randint(0, self._SCREEN, 2))
+
+    def _observation(self):
+        player_relative = np.zeros((self._SCREEN, self._SCREEN), dtype=np.int32)
+        player_relative[self.beacon] = 3
+        player_relative[self.unit] = 1
+
+        selected = np.zeros((self._SCREEN, self._SCREEN), dtype=np.int32)
+        if self.selected:
+            selected[self.unit] = 1
+
+        observation = np.stack([player_relative, selected])
+        observation.flags.writeable = False
+        return observation
+
+    def step(self, action):
+        reward = 0
+
+        if action.action == 1:
+            if self.selected:
+                self.unit = (int(action.coords[0]), int(action.coords[1]))
+        elif action.action == 2:
+            if (int(action.coords[0]), int(action.coords[1])) == self.unit:
+                self.selected = not self.selected
+        elif action.action != 0:
+            print(action.action, "wtf")
+            assert False
+
+        if self.unit == self.beacon:
+            reward = 1
+            while self.beacon == self.unit:
+                self.beacon = self._random_position()
+
+        self.episode_step += 1
+        done = self.episode_step >= self._EPISODE_LENGTH
+
+        return self._observation(), reward, done, {}
+
+    def reset(self):
+        self.unit = self._random_position()
+        self.beacon = self._random_position()
+        while self.beacon == self.unit:
+            self.beacon = self._random_position()
+        # Wie Sc2Env2Outputs.reset(): die Armee ist zu Beginn selektiert.
+        self.selected = True
+        self.episode_step = 0
+
+        return self._observation()
+
+    def render(self, mode: str = 'human', close: bool = False):
+        pass
+
+    def close(self):
+        pass
+
+    def seed(self, seed=None):
+        if seed:
+            self.random = np.random.RandomState(seed)
+
+    def configure(self, *args, **kwargs):
+        pass
+
+    @property
+    def screen(self):
+        return self._SCREEN
@@ -1,3 +1,4 @@
+import numpy as np
 from keras import backend as K
 from keras.layers import Dense
 from keras.layers.convolutional import Conv2D
@@ -7,11 +8,74 @@ from keras import initializers
 
 # Eigene Implementierung einer NoisyDense Layer sowie einer NoisyConv2D Layer, welche modifizierte Versionen der
 # entsprechenden Keras-Layers sind, deren Implementierung als Grundlage benutzt wurde.
+# Mit factorized=True wird statt einer Zufallsmatrix in Kernel-Größe nur je ein Zufallsvektor für Input und Output
+# gezogen und der Kernel-Zufall als deren äußeres Produkt gebildet (Factorised Gaussian Noise, siehe Noisy Nets Paper).
+# Das reduziert die Zufallszahlen pro Forward-Pass von O(in*out) auf O(in+out).
+# Wann neuer Zufall gezogen wird, steuert NoiseControl: bei jedem Aufruf (resample), gehalten bis zum nächsten
+# resample() (hold) oder gar nicht, d.h. die Mittelwert-Gewichte (mean, z.B. für die Evaluation).
 
 
-class NoisyDense(Dense):
-    def __init__(self, units, **kwargs):
+def _scale_noise(x):
+    # f(x) = sgn(x) * sqrt(|x|), siehe Noisy Nets Paper
+    return K.sign(x) * K.sqrt(K.abs(x))
+
+
+def _sigma_initializer(factorized, fan_in):
+    # unabhängiger Zufall: 0.017, faktorisierter Zufall: 0.5 / sqrt(fan_in) (Werte aus dem Paper)
+    if factorized:
+        return initializers.Constant(0.5 / fan_in ** 0.5)
+    return initializers.Constant(0.017)
+
+
+class _NoiseMixin(object):
+    # Gemeinsame Zufallssteuerung beider Layers. Gehaltener Zufall und Modus sind bewusst keine Layer-Weights
+    # (kein add_weight), damit gespeicherte Gewichte unverändert geladen werden können.
+    def _build_noise(self, fan_in, fan_out, kernel_shape):
+        self.noise_fan_in = fan_in
+        self.noise_fan_out = fan_out
+        self.noise_kernel_shape = kernel_shape
+
+        # 1: neuer Zufall bei jedem Aufruf, 0: gehaltener Zufall
+        self.noise_resample = K.variable(1., name=self.name + '_noise_resample')
+        # 0: Mittelwert-Gewichte, der Zufall wird ausgeblendet
+        self.noise_scale = K.variable(1., name=self.name + '_noise_scale')
+
+        # faktorisiert werden nur die beiden Vektoren gehalten
+        if self.factorized:
+            shapes = [(fan_in, 1), (1, fan_out)]
+        else:
+            shapes = [kernel_shape, (fan_out,)]
+        self.held_epsilon = [K.zeros(shape, name=self.name + '_held_epsilon_' + str(i))
+                             for i, shape in enumerate(shapes)]
+
+    def _sample_epsilon(self):
+        if self.factorized:
+            return [_scale_noise(K.random_normal(shape=(self.noise_fan_in, 1))),
+                    _scale_noise(K.random_normal(shape=(1, self.noise_fan_out)))]
+        return [K.random_normal(shape=self.noise_kernel_shape),
+                K.random_normal(shape=(self.noise_fan_out,))]
+
+    def noise_updates(self):
+        # Assign-Ops, die neuen Zufall in die gehaltenen Variablen schreiben (von NoiseControl gesammelt).
+        return [K.update(held, epsilon) for held, epsilon in zip(self.held_epsilon, self._sample_epsilon())]
+
+    def _epsilon(self):
+        # Zufall für Kernel und Bias: der Zufall wird nur im gewählten Zweig erzeugt, gehalten/mean ziehen also
+        # keine Zufallszahlen.
+        epsilon = K.tf.cond(K.tf.greater(self.noise_resample, 0.), self._sample_epsilon,
+                            lambda: [K.identity(held) for held in self.held_epsilon])
+        if self.factorized:
+            kernel_epsilon = K.reshape(epsilon[0] * epsilon[1], self.noise_kernel_shape)
+            bias_epsilon = K.reshape(epsilon[1], (self.noise_fan_out,))
+        else:
+            kernel_epsilon, bias_epsilon = epsilon
+        return kernel_epsilon * self.noise_scale, bias_epsilon * self.noise_scale
+
+
+class NoisyDense(_NoiseMixin, Dense):
+    def __init__(self, units, factorized=False, **kwargs):
         self.output_dim = units
+        self.factorized = factorized
         super(NoisyDense, self).__init__(units, **kwargs)
 
     def build(self, input_shape):
@@ -26,7 +90,7 @@ class NoisyDense(Dense):
 
         # Zweiter Kernel (trainable weights) für Steuerung des Zufalls.
         self.kernel_sigma = self.add_weight(shape=(self.input_dim, self.units),
-                                      initializer=initializers.Constant(0.017),
+                                      initializer=_sigma_initializer(self.factorized, self.input_dim),
                                       name='sigma_kernel',
                                       regularizer=None,
                                       constraint=None)
@@ -40,37 +104,47 @@ class NoisyDense(Dense):
 
             # trainable, Steuerung des Zufalls des Bias.
             self.bias_sigma = self.add_weight(shape=(self.units,),
-                                        initializer=initializers.Constant(0.017),
+                                        initializer=_sigma_initializer(self.factorized, self.input_dim),
                                         name='bias_sigma',
                                         regularizer=None,
                                         constraint=None)
         else:
             self.bias = None
 
+        self._build_noise(self.input_dim, self.units, (self.input_dim, self.units))
+
         self.input_spec = InputSpec(min_ndim=2, axes={-1: self.input_dim})
         self.built = True
 
     def call(self, inputs):
-        # Erzeugen der Matrix mit Zufallszahlen (bei jedem Aufruf neu erzeugt) - Vektor-Version
-        # (siehe Noisy Nets Paper) wäre effizienter.
-        self.kernel_epsilon = K.random_normal(shape=(self.input_dim, self.units))
+        # Matrix mit Zufallszahlen, entweder unabhängig pro Gewicht oder faktorisiert aus zwei Vektoren
+        # (neu oder gehalten, siehe NoiseControl).
+        self.kernel_epsilon, self.bias_epsilon = self._epsilon()
 
         w = self.kernel + K.tf.multiply(self.kernel_sigma, self.kernel_epsilon)
         output = K.dot(inputs, w)
 
         if self.use_bias:
-            # Erzeugung Zufallsvektor für Bias-Zufall.
-            self.bias_epsilon = K.random_normal(shape=(self.units,))
-
+            # Bias-Zufall
             b = self.bias + K.tf.multiply(self.bias_sigma, self.bias_epsilon)
             output = output + b
         if self.activation is not None:
             output = self.activation(output)
         return output
 
+    def get_config(self):
+        config = super(NoisyDense, self).get_config()
+        config['factorized'] = self.factorized
+        return config
 
-class NoisyConv2D(Conv2D):
+
+class NoisyConv2D(_NoiseMixin, Conv2D):
     # Prinzip Identisch zur Dense-Layer, lediglich hat der (Filter-) Kernel sowie der Output eine Dimension mehr.
+    # Faktorisiert ist der Input-Vektor so lang wie das rezeptive Feld (kernel_size * Input-Channels).
+    def __init__(self, filters, kernel_size, factorized=False, **kwargs):
+        self.factorized = factorized
+        super(NoisyConv2D, self).__init__(filters, kernel_size, **kwargs)
+
     def build(self, input_shape):
         if self.data_format == 'channels_first':
             channel_axis = 1
@@ -81,6 +155,7 @@ class NoisyConv2D(Conv2D):
                              'should be defined. Found `None`.')
         self.input_dim = input_shape[channel_axis]
         self.kernel_shape = self.kernel_size + (self.input_dim, self.filters)
+        self.fan_in = int(np.prod(self.kernel_size)) * self.input_dim
 
         self.kernel = self.add_weight(shape=self.kernel_shape,
                                       initializer=self.kernel_initializer,
@@ -89,7 +164,7 @@ class NoisyConv2D(Conv2D):
                                       constraint=self.kernel_constraint)
 
         self.kernel_sigma = self.add_weight(shape=self.kernel_shape,
-                                      initializer=initializers.Constant(0.017),
+                                      initializer=_sigma_initializer(self.factorized, self.fan_in),
                                       name='kernel_sigma',
                                       regularizer=self.kernel_regularizer,
                                       constraint=self.kernel_constraint)
@@ -102,20 +177,22 @@ class NoisyConv2D(Conv2D):
                                         constraint=self.bias_constraint)
 
             self.bias_sigma = self.add_weight(shape=(self.filters,),
-                                        initializer=initializers.Constant(0.017),
+                                        initializer=_sigma_initializer(self.factorized, self.fan_in),
                                         name='bias_sigma',
                                         regularizer=self.bias_regularizer,
                                         constraint=self.bias_constraint)
         else:
             self.bias = None
 
+        self._build_noise(self.fan_in, self.filters, self.kernel_shape)
+
         self.input_spec = InputSpec(ndim=self.rank + 2,
                                     axes={channel_axis: self.input_dim})
         self.built = True
 
     def call(self, inputs):
         # add noise to kernel
-        self.kernel_epsilon = K.random_normal(shape=self.kernel_shape)
+        self.kernel_epsilon, self.bias_epsilon = self._epsilon()
 
         w = self.kernel + K.tf.multiply(self.kernel_sigma, self.kernel_epsilon)
 
@@ -129,8 +206,6 @@ class NoisyConv2D(Conv2D):
             dilation_rate=self.dilation_rate)
 
         if self.use_bias:
-            self.bias_epsilon = K.random_normal(shape=(self.filters,))
-
             b = self.bias + K.tf.multiply(self.bias_sigma, self.bias_epsilon)
             outputs = K.bias_add(
                 outputs,
@@ -140,3 +215,68 @@ class NoisyConv2D(Conv2D):
         if self.activation is not None:
             return self.activation(outputs)
         return outputs
+
+    def get_config(self):
+        config = super(NoisyConv2D, self).get_config()
+        config['factorized'] = self.factorized
+        return config
+
+
+def noisy_layers(model):
+    # Alle Noisy-Layers eines Models, auch in verschachtelten Models.
+    layers = []
+    for layer in model.layers:
+        if isinstance(layer, _NoiseMixin):
+            layers.append(layer)
+        elif hasattr(layer, 'layers'):
+            layers += noisy_layers(layer)
+    return layers
+
+
+class NoiseControl(object):
+    """Steuert den Zufall aller Noisy-Layers der übergebenen Models gemeinsam.
+
+    # Modes
+        `resample`: neuer Zufall bei jedem Aufruf des Models (Standard, bisheriges Verhalten).
+        `hold`: der Zufall bleibt fest, bis resample() aufgerufen wird; step() macht das alle hold_steps Aufrufe.
+        `mean`: kein Zufall, es werden nur die Mittelwert-Gewichte benutzt (Evaluation).
+    """
+    MODES = {'resample': (1., 1.), 'hold': (0., 1.), 'mean': (0., 0.)}
+
+    def __init__(self, models, hold_steps=1):
+        if hold_steps < 1:
+            raise ValueError('hold_steps must be >= 1, is {}'.format(hold_steps))
+        self.layers = [layer for model in models for layer in noisy_layers(model)]
+        self.hold_steps = hold_steps
+        self.mode = 'resample'
+        self._steps = 0
+
+        # Assign-Ops aller Layers, resample() führt sie in einem Session-Run aus.
+        self._resample_ops = [update for layer in self.layers for update in layer.noise_updates()]
+
+    def set_mode(self, mode):
+        """Setzt den Modus und gibt den vorherigen zurück. Beim Wechsel nach `hold` wird neuer Zufall gezogen.
+        """
+        if mode not in self.MODES:
+            raise ValueError('Unknown noise mode "{}", expected one of {}.'.format(mode, sorted(self.MODES)))
+        previous = self.mode
+        resample, scale = self.MODES[mode]
+        K.batch_set_value([(layer.noise_resample, resample) for layer in self.layers] +
+                          [(layer.noise_scale, scale) for layer in self.layers])
+        self.mode = mode
+        if mode == 'hold':
+            self.resample()
+        return previous
+
+    def resample(self):
+        if self._resample_ops:
+            K.get_session().run(self._resample_ops)
+        self._steps = 0
+
+    def step(self):
+        # Nur im hold-Modus: nach hold_steps Aufrufen wird neuer Zufall gezogen.
+        if self.mode != 'hold':
+            return
+        self._steps += 1
+        if self._steps >= self.hold_steps:
+            self.resample()
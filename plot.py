@@ -10,6 +10,33 @@ import numpy as np
 # Achtung: Erst nach 100 Episoden sind genug Daten in den Logfiles, um einen ersten Plot anzuzeigen.
 
 
+# Liest ein Logfile als dict von Listen (ein Eintrag pro Episode): JSON-Lines (.jsonl, StreamingLogger) oder ein
+# einzelnes JSON-Objekt (FileLogger und ältere Läufe).
+def load_log(path):
+    if path.endswith('.jsonl'):
+        data, _ = read_log_lines(path)
+        return data
+    with open(path) as f:
+        return json.load(f)
+
+
+# Inkrementelles Lesen eines JSON-Lines Logfiles: liest ab Byte offset alle vollständigen Zeilen, hängt sie an data an
+# und gibt (data, neuer offset) zurück. Mit dem zurückgegebenen offset liest der nächste Aufruf nur neue Episoden,
+# z.B. um ein laufendes Training zu verfolgen, ohne die ganze Datei jedes Mal neu zu lesen.
+def read_log_lines(path, offset=0, data=None):
+    data = {} if data is None else data
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Zeile wird gerade noch geschrieben
+                break
+            offset += len(line)
+            for key, value in json.loads(line.decode('utf-8')).items():
+                data.setdefault(key, []).append(value)
+    return data, offset
+
+
 # Standard Plot des Lernfortschritts eines Agents aus dessen LogFile (auch wärend dieser lernt zu verwenden).
 # paths ist eine list an pfaden(absolut) zu logfiles, welche normalerweise genau ein Element enthält.
 # Mehrere Einträge in paths sind möglich, um den Verlauf eines unterbrochenen Testlaufs zu plotten, von welchem
@@ -38,30 +65,27 @@ def multi_plot(paths: list, smoother: int = 100, zero_scale: int = 10, hw_stats=
     cmp_rew = []
 
     for path in paths:
-        with open(path) as f:
-            data = json.load(f)
-            loss += data["loss"]
-            rew += data["episode_reward"]
-            nb_steps += data["nb_steps"]
+        data = load_log(path)
+        loss += data["loss"]
+        rew += data["episode_reward"]
+        nb_steps += data["nb_steps"]
 
         if hw_stats:
-            gpu_path = path[:len(path)-5] + "_gpu.json"
-            with open(gpu_path) as f2:
-                data = json.load(f2)
-                fan_speed += data["fan_speed"]
-                gpu_util += data["gpu_util"]
-                mem_util += data["mem_util"]
-                gpu_temp += data["gpu_temp"]
-                gpu_power += data["gpu_power"]
-                cpu_util += data["cpu_util"]
-                ram_util += data["ram_util"]
-                swap_util += data["swap_util"]
+            base, ext = os.path.splitext(path)
+            data = load_log(base + "_gpu" + ext)
+            fan_speed += data["fan_speed"]
+            gpu_util += data["gpu_util"]
+            mem_util += data["mem_util"]
+            gpu_temp += data["gpu_temp"]
+            gpu_power += data["gpu_power"]
+            cpu_util += data["cpu_util"]
+            ram_util += data["ram_util"]
+            swap_util += data["swap_util"]
 
     if compare:
         for comp in compare:
-            with open(comp) as f:
-                data = json.load(f)
-                cmp_rew += data["episode_reward"]
+            data = load_log(comp)
+            cmp_rew += data["episode_reward"]
 
     smooth = []
     zero_rate = []
@@ -151,10 +175,9 @@ def std_plot(paths, smoother, std=True):
     loss = []
 
     for path in paths:
-        with open(path) as f:
-            data = json.load(f)
-            loss.append(data["loss"])
-            rew.append(data["episode_reward"])
+        data = load_log(path)
+        loss.append(data["loss"])
+        rew.append(data["episode_reward"])
 
     smooth_x = []
     zero_rate_x = []
@@ -218,14 +241,12 @@ def avg_std_plot(paths_a, paths_b, smoother, normalize=None, one=False):
     rew_b = []
 
     for path in paths_a:
-        with open(path) as f:
-            data = json.load(f)
-            rew_a.append(data["episode_reward"])
+        data = load_log(path)
+        rew_a.append(data["episode_reward"])
 
     for path in paths_b:
-        with open(path) as f:
-            data = json.load(f)
-            rew_b.append(data["episode_reward"])
+        data = load_log(path)
+        rew_b.append(data["episode_reward"])
 
     smooth_x_a = []
     sigmas_x_a = []
@@ -359,9 +380,8 @@ def avg_std_plot_2(paths_all, smoother, normalize=None):
     for paths in paths_all:
         rews = []
         for path in paths:
-            with open(path) as f:
-                data = json.load(f)
-                rews.append(data["episode_reward"])
+            data = load_log(path)
+            rews.append(data["episode_reward"])
         rew_all.append(rews)
 
     smooth_x_all = []
@@ -441,7 +461,7 @@ def avg_std_plot_2(paths_all, smoother, normalize=None):
 
 # Lernverlauf live plotten.
 # Erst nach den ersten 100 Episoden stehen genug Daten im Logfile, vorher crasht diese Methode!
-# multi_plot(["/PathToDqn/dqn/weights/CollectMineralShards/my_first_run/1/dqn_log.json"],
+# multi_plot(["/PathToDqn/dqn/weights/CollectMineralShards/my_first_run/1/dqn_log.jsonl"],
 #            zero_scale=20, smoother=100, hw_stats=False)
 
 # Vergleichen zweier Durchschnitte über jeweils zwei Testläufe.
@@ -1,12 +1,80 @@
 import numpy as np
 import random
-from baselines.common.segment_tree import SumSegmentTree, MinSegmentTree
+import queue
+import threading
+from collections import deque
 
 
 # Eine modifizierte Version des OpenAI baselines/ReplayBuffer. Einzige Änderung ist das Entfernen eines Typecasts
 # der Aktionen in _encode_sample() auf ein numpy Array; da die von mir verwendeten Aktionen Objekte sind,
 # verursachte dies Probleme. Ansonsten ist der Code unverändert, die Klasse PrioritizedReplayBuffer, welche hier auch
-# kopiert ist, erbt von der neuen Version des ReplayBuffer als einzige Änderung.
+# kopiert ist, erbt von der neuen Version des ReplayBuffer und fragt die Anzahl gespeicherter Transitionen über len(self)
+# ab, damit sie auch mit den Array-Varianten (ArrayReplayBuffer, FrameReplayBuffer, siehe unten) kombiniert werden kann;
+# zusätzliche Keyword-Argumente werden an deren __init__ durchgereicht.
+# Da im FrameReplayBuffer die gültigen Transitionen nicht zwingend am Anfang des Rings liegen, wird außerdem über den
+# ganzen Summenbaum gezogen (ungenutzte Einträge haben Priorität 0).
+# Für Checkpoints (siehe checkpoint.py) geben alle Buffer ihren Inhalt über get_state()/set_state() heraus, die großen
+# Observation-Arrays getrennt davon über observation_storages(), damit sie stückweise geschrieben werden können.
+# Statt der baselines SegmentTrees werden die SumTree/MinTree Klassen unten verwendet, mit denen das Ziehen, die
+# Berechnung der Importance-Sampling Gewichte und das Updaten der Prioritäten für den ganzen Batch auf einmal passiert.
+
+
+# Numpy-Version der baselines SegmentTrees. Die Knoten liegen wie dort in einem Array der Länge 2 * capacity (Wurzel an
+# Index 1, Blätter ab Index capacity), allerdings akzeptieren __setitem__, __getitem__ und find_prefixsum_idx ganze
+# Index-Arrays: die Blätter werden auf einmal gesetzt und die Elternknoten dann Ebene für Ebene neu berechnet.
+class ArraySegmentTree(object):
+    def __init__(self, capacity, operation, neutral_element):
+        assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
+        self._capacity = capacity
+        self._depth = capacity.bit_length() - 1
+        self._operation = operation
+        self._value = np.full(2 * capacity, neutral_element, dtype=np.float64)
+
+    def reduce(self, start=0, end=None):
+        if start == 0 and end is None:
+            return self._value[1]
+        if end is None:
+            end = self._capacity
+        return self._operation.reduce(self._value[self._capacity + start:self._capacity + end])
+
+    def __setitem__(self, idx, val):
+        idx = np.asarray(idx) + self._capacity
+        self._value[idx] = val
+
+        idx = np.unique(idx // 2)
+        for _ in range(self._depth):
+            self._value[idx] = self._operation(self._value[2 * idx], self._value[2 * idx + 1])
+            idx = np.unique(idx // 2)
+
+    def __getitem__(self, idx):
+        return self._value[self._capacity + np.asarray(idx)]
+
+
+class SumTree(ArraySegmentTree):
+    def __init__(self, capacity):
+        super(SumTree, self).__init__(capacity, np.add, 0.0)
+
+    def sum(self, start=0, end=None):
+        return self.reduce(start, end)
+
+    def find_prefixsum_idx(self, prefixsum):
+        # Abstieg für alle Werte in prefixsum gleichzeitig, siehe baselines SumSegmentTree.find_prefixsum_idx()
+        prefixsum = np.array(prefixsum, dtype=np.float64)
+        idx = np.ones(prefixsum.shape, dtype=np.int64)
+        for _ in range(self._depth):
+            left = self._value[2 * idx]
+            go_right = left <= prefixsum
+            prefixsum -= np.where(go_right, left, 0.)
+            idx = 2 * idx + go_right
+        return idx - self._capacity
+
+
+class MinTree(ArraySegmentTree):
+    def __init__(self, capacity):
+        super(MinTree, self).__init__(capacity, np.minimum, float('inf'))
+
+    def min(self, start=0, end=None):
+        return self.reduce(start, end)
 
 
 class ReplayBuffer(object):
@@ -73,9 +141,27 @@ class ReplayBuffer(object):
         idxes = [random.randint(0, len(self._storage) - 1) for _ in range(batch_size)]
         return self._encode_sample(idxes)
 
+    def get_state(self):
+        """Return a copy of the buffer contents (except observation
+        storages, see observation_storages) for a checkpoint.
+        """
+        return {'storage': list(self._storage), 'next_idx': self._next_idx}
+
+    def set_state(self, state):
+        """Restore the buffer contents returned by get_state."""
+        self._storage = list(state['storage'])
+        self._next_idx = state['next_idx']
+
+    def observation_storages(self):
+        """Return (name, ObservationStorage, nb_written) of every
+        observation storage; nb_written counts all rows ever written,
+        the next row to be overwritten is nb_written % len(storage).
+        """
+        return []
+
 
 class PrioritizedReplayBuffer(ReplayBuffer):
-    def __init__(self, size, alpha):
+    def __init__(self, size, alpha, **kwargs):
         """Create Prioritized Replay buffer.
 
         Parameters
@@ -91,7 +177,7 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         --------
         ReplayBuffer.__init__
         """
-        super(PrioritizedReplayBuffer, self).__init__(size)
+        super(PrioritizedReplayBuffer, self).__init__(size, **kwargs)
         assert alpha >= 0
         self._alpha = alpha
 
@@ -99,26 +185,34 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         while it_capacity < size:
             it_capacity *= 2
 
-        self._it_sum = SumSegmentTree(it_capacity)
-        self._it_min = MinSegmentTree(it_capacity)
+        self._it_sum = SumTree(it_capacity)
+        self._it_min = MinTree(it_capacity)
         self._max_priority = 1.0
 
-    def add(self, *args, **kwargs):
-        """See ReplayBuffer.store_effect"""
+    def add(self, *args, priority=None, **kwargs):
+        """See ReplayBuffer.store_effect
+
+        priority: float
+            Initial priority of the transition (e.g. computed by an Ape-X
+            actor). Defaults to the max priority seen so far.
+        """
         idx = self._next_idx
         super().add(*args, **kwargs)
-        self._it_sum[idx] = self._max_priority ** self._alpha
-        self._it_min[idx] = self._max_priority ** self._alpha
+        if priority is None:
+            priority = self._max_priority
+        else:
+            priority = max(priority, .00001)
+            self._max_priority = max(self._max_priority, priority)
+        self._it_sum[idx] = priority ** self._alpha
+        self._it_min[idx] = priority ** self._alpha
 
     def _sample_proportional(self, batch_size):
-        res = []
-        p_total = self._it_sum.sum(0, len(self._storage) - 1)
+        p_total = self._it_sum.sum()
         every_range_len = p_total / batch_size
-        for i in range(batch_size):
-            mass = random.random() * every_range_len + i * every_range_len
-            idx = self._it_sum.find_prefixsum_idx(mass)
-            res.append(idx)
-        return res
+        mass = (np.random.random(batch_size) + np.arange(batch_size)) * every_range_len
+        # Rundungsfehler dürfen nicht hinter das letzte Blatt mit Priorität > 0 führen.
+        mass = np.minimum(mass, np.nextafter(p_total, 0))
+        return self._it_sum.find_prefixsum_idx(mass)
 
     def sample(self, batch_size, beta):
         """Sample a batch of experiences.
@@ -160,15 +254,12 @@ class PrioritizedReplayBuffer(ReplayBuffer):
 
         idxes = self._sample_proportional(batch_size)
 
-        weights = []
-        p_min = self._it_min.min() / self._it_sum.sum()
-        max_weight = (p_min * len(self._storage)) ** (-beta)
+        p_total = self._it_sum.sum()
+        p_min = self._it_min.min() / p_total
+        max_weight = (p_min * len(self)) ** (-beta)
 
-        for idx in idxes:
-            p_sample = self._it_sum[idx] / self._it_sum.sum()
-            weight = (p_sample * len(self._storage)) ** (-beta)
-            weights.append(weight / max_weight)
-        weights = np.array(weights)
+        p_sample = self._it_sum[idxes] / p_total
+        weights = (p_sample * len(self)) ** (-beta) / max_weight
         encoded_sample = self._encode_sample(idxes)
         return tuple(list(encoded_sample) + [weights, idxes])
 
@@ -187,13 +278,544 @@ class PrioritizedReplayBuffer(ReplayBuffer):
             transitions at the sampled idxes denoted by
             variable `idxes`.
         """
-        assert len(idxes) == len(priorities)
-        for idx, priority in zip(idxes, priorities):
-            if priority == 0:
-                priority = .00001
-            assert priority > 0
-            assert 0 <= idx < len(self._storage)
-            self._it_sum[idx] = priority ** self._alpha
-            self._it_min[idx] = priority ** self._alpha
+        idxes = np.asarray(idxes)
+        priorities = np.asarray(priorities, dtype=np.float64)
+        assert idxes.shape == priorities.shape
+        priorities = np.where(priorities == 0, .00001, priorities)
+        assert np.all(priorities > 0)
+        assert np.all((0 <= idxes) & (idxes < self._maxsize))
+        self._it_sum[idxes] = priorities ** self._alpha
+        self._it_min[idxes] = priorities ** self._alpha
+
+        self._max_priority = max(self._max_priority, priorities.max())
+
+    def get_state(self):
+        state = super().get_state()
+        state['it_sum'] = self._it_sum._value.copy()
+        state['it_min'] = self._it_min._value.copy()
+        state['max_priority'] = self._max_priority
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self._it_sum._value[:] = state['it_sum']
+        self._it_min._value[:] = state['it_min']
+        self._max_priority = state['max_priority']
+
+
+# Speicher für Observations der Form (planes, screen, screen) im Replay Memory. Ohne weitere Parameter werden die
+# Observations unverändert (im dtype der ersten Observation) gespeichert und zurückgegeben.
+# Optional kompakte Kodierung: obs_dtype legt den dtype fest, in dem die Feature-Layers gespeichert werden (z.B. uint8
+# für player_relative mit Werten 0-4), die in bit_planes angegebenen Ebenen werden mit np.packbits bitweise gepackt.
+# bit_planes ist entweder eine Liste binärer Ebenen (ein Bit pro Pixel, z.B. (1,) für selected) oder ein dict
+# {Ebene: Anzahl Bits} für kleine ganzzahlige Werte (z.B. {0: 3, 1: 1}: player_relative 0-4 in 3 Bits, selected in
+# einem). Werte, die nicht in die angegebenen Bits passen, werden abgeschnitten. Beim Ziehen wird dann einmal pro Batch
+# nach float32 dekodiert.
+# Bei _SCREEN = 32 braucht eine Observation mit {0: 3, 1: 1} so 4 * 128 = 512 Byte (mit obs_dtype uint8 und (1,):
+# 1024 + 128 Byte) statt 2 * 1024 * 4 (int32) bzw. 2 * 1024 * 8 (int64) Byte.
+# Mit path liegen die Arrays nicht im RAM, sondern als np.memmap in Dateien (path + '.dense' bzw. '.bits'); welche
+# Teile im Speicher bleiben, entscheidet dann der Page Cache des Betriebssystems.
+class ObservationStorage(object):
+    def __init__(self, size, obs, obs_dtype=None, bit_planes=(), path=None):
+        obs = np.asarray(obs)
+        self.shape = obs.shape
+        self.compact = obs_dtype is not None or len(bit_planes) > 0
+
+        depths = dict(bit_planes) if isinstance(bit_planes, dict) else {plane: 1 for plane in bit_planes}
+        self._bit_planes = sorted(depths)
+        self._bit_depths = [depths[plane] for plane in self._bit_planes]
+        self._dense_planes = [i for i in range(obs.shape[0]) if i not in depths]
+        self._plane_size = int(np.prod(obs.shape[1:]))
+        self._size = size
+        self._dtype = np.dtype(obs.dtype if obs_dtype is None else obs_dtype)
+
+        # (ohne Ebenen kein Array, eine memmap der Größe 0 lässt sich nicht anlegen)
+        if self._dense_planes:
+            self._dense = self._allocate(path, '.dense', (size, len(self._dense_planes)) + obs.shape[1:], self._dtype)
+        else:
+            self._dense = None
+        if self._bit_planes:
+            self._bits = self._allocate(path, '.bits', (size, sum(self._bit_depths), (self._plane_size + 7) // 8),
+                                        np.uint8)
+        else:
+            self._bits = None
 
-            self._max_priority = max(self._max_priority, priority)
+    @staticmethod
+    def _allocate(path, suffix, shape, dtype):
+        if path is None:
+            return np.zeros(shape, dtype=dtype)
+        # Neue Datei mit Nullen (sparse), wird erst beim Schreiben tatsächlich belegt.
+        return np.memmap(path + suffix, mode='w+', dtype=dtype, shape=shape)
+
+    def flush(self):
+        # Schreibt memmap-Arrays auf die Platte (ohne path ohne Wirkung).
+        for array in (self._dense, self._bits):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays().values())
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def arrays(self):
+        # Die kodierten Arrays (z.B. für Checkpoints), Zeile i gehört zu Observation i.
+        return {key: array for key, array in (('dense', self._dense), ('bits', self._bits)) if array is not None}
+
+    def __setitem__(self, idx, obs):
+        obs = np.asarray(obs)
+        if self._bits is None:
+            self._dense[idx] = obs
+            return
+
+        if self._dense is not None:
+            self._dense[idx] = obs[self._dense_planes]
+        planes = obs[self._bit_planes].reshape(len(self._bit_planes), self._plane_size)
+        bits = []
+        for plane, depth in zip(planes, self._bit_depths):
+            if depth == 1:
+                bits.append(plane[None] != 0)
+            else:
+                # Bit j des Werts in Zeile j
+                bits.append(np.right_shift(plane.astype(np.int64), np.arange(depth)[:, None]) & 1)
+        self._bits[idx] = np.packbits(np.concatenate(bits).astype(np.uint8), axis=-1)
+
+    def __getitem__(self, idxes):
+        if not self.compact:
+            # asarray: bei memmap ein normales Array statt einer memmap-Instanz zurückgeben
+            return np.asarray(self._dense[idxes])
+
+        batch = np.empty((len(idxes),) + self.shape, dtype=np.float32)
+        if self._bits is None:
+            batch[:] = self._dense[idxes]
+            return batch
+
+        if self._dense is not None:
+            batch[:, self._dense_planes] = self._dense[idxes]
+        bits = np.unpackbits(self._bits[idxes], axis=-1)[:, :, :self._plane_size]
+        row = 0
+        for plane, depth in zip(self._bit_planes, self._bit_depths):
+            values = bits[:, row]
+            for j in range(1, depth):
+                values = values | (bits[:, row + j] << j)
+            batch[:, plane] = values.reshape((len(idxes),) + self.shape[1:])
+            row += depth
+        return batch
+
+
+# Variante des ReplayBuffer, welche die Transitionen nicht als Liste von Tupeln, sondern in vorallokierten numpy Arrays
+# speichert (ein Array pro Feld). Die Observation-Arrays werden beim ersten add() anhand der ersten Observation angelegt,
+# sodass die Klasse ohne weitere Parameter als Ersatz für den ReplayBuffer benutzt werden kann.
+# Die Aktionen (Sc2Action) werden zerlegt in Aktions-Id und Koordinaten in einem strukturierten Array gespeichert und
+# beim Ziehen als numpy recarray mit den Feldern action und coords zurückgegeben; action_batch[i].action und
+# action_batch[i].coords funktionieren also weiterhin, zusätzlich sind action_batch.action und action_batch.coords
+# direkt als Arrays verfügbar. obs_dtype und bit_planes schalten die kompakte Kodierung ein (siehe ObservationStorage),
+# obs_path legt die Observations als np.memmap auf die Platte; Metadaten und Prioritäten bleiben im RAM.
+class ArrayReplayBuffer(ReplayBuffer):
+    action_dtype = np.dtype([('action', np.int32), ('coords', np.int32, (2,))])
+
+    def __init__(self, size, obs_dtype=None, bit_planes=(), obs_path=None):
+        """Create Replay buffer backed by preallocated numpy arrays.
+
+        Parameters
+        ----------
+        size: int
+            Max number of transitions to store in the buffer. When the buffer
+            overflows the old memories are dropped.
+        obs_dtype: np.dtype
+            dtype the observation planes are stored in (None - keep dtype).
+            Sampled observations are decoded to float32 if set.
+        bit_planes: [int] or {int: int}
+            Indices of binary observation planes that are stored bit-packed,
+            or a dict {plane: number of bits} for small integer planes.
+        obs_path: str
+            If set, observations are stored in memory-mapped files with this
+            path prefix instead of RAM (the directory has to exist).
+        """
+        super(ArrayReplayBuffer, self).__init__(size)
+        self._storage = None
+        self._size = 0
+        self._nb_added = 0
+        self._obs_dtype = obs_dtype
+        self._bit_planes = bit_planes
+        self._obs_path = obs_path
+
+        # Observations werden erst beim ersten add() angelegt, da Shape und dtype dann bekannt sind.
+        self._obs_t = None
+        self._obs_tp1 = None
+        self._actions = np.zeros(size, dtype=self.action_dtype)
+        self._rewards = np.zeros(size, dtype=np.float32)
+        self._dones = np.zeros(size, dtype=np.bool_)
+
+    def __len__(self):
+        return self._size
+
+    def _obs_storage_path(self, name):
+        return None if self._obs_path is None else self._obs_path + '_' + name
+
+    def _allocate_observations(self, obs):
+        self._obs_t = ObservationStorage(self._maxsize, obs, self._obs_dtype, self._bit_planes,
+                                         self._obs_storage_path('obs_t'))
+        self._obs_tp1 = ObservationStorage(self._maxsize, obs, self._obs_dtype, self._bit_planes,
+                                           self._obs_storage_path('obs_tp1'))
+
+    def add(self, obs_t, action, reward, obs_tp1, done):
+        if self._obs_t is None:
+            self._allocate_observations(obs_t)
+
+        idx = self._next_idx
+        self._obs_t[idx] = obs_t
+        self._obs_tp1[idx] = obs_tp1
+        self._actions[idx] = (action.action, action.coords)
+        self._rewards[idx] = reward
+        self._dones[idx] = done
+
+        self._size = min(self._size + 1, self._maxsize)
+        self._next_idx = (self._next_idx + 1) % self._maxsize
+        self._nb_added += 1
+
+    def _encode_sample(self, idxes):
+        idxes = np.asarray(idxes)
+        return (self._obs_t[idxes],
+                self._actions[idxes].view(np.recarray),
+                self._rewards[idxes],
+                self._obs_tp1[idxes],
+                self._dones[idxes])
+
+    def sample(self, batch_size):
+        """Sample a batch of experiences.
+
+        See ReplayBuffer.sample, except that act_batch is a np.recarray
+        with the fields `action` and `coords`.
+        """
+        idxes = np.random.randint(0, len(self), size=batch_size)
+        return self._encode_sample(idxes)
+
+    def get_state(self):
+        return {'next_idx': self._next_idx, 'size': self._size, 'nb_added': self._nb_added,
+                'actions': self._actions.copy(), 'rewards': self._rewards.copy(), 'dones': self._dones.copy()}
+
+    def set_state(self, state):
+        self._next_idx = state['next_idx']
+        self._size = state['size']
+        self._nb_added = state['nb_added']
+        self._actions[:] = state['actions']
+        self._rewards[:] = state['rewards']
+        self._dones[:] = state['dones']
+
+    def observation_storages(self):
+        if self._obs_t is None:
+            return []
+        return [('obs_t', self._obs_t, self._nb_added), ('obs_tp1', self._obs_tp1, self._nb_added)]
+
+
+# PrioritizedReplayBuffer mit der Speicherung des ArrayReplayBuffer (über die Methodenauflösung von Python wird
+# super().add() bzw. _encode_sample() des ArrayReplayBuffer verwendet).
+class PrioritizedArrayReplayBuffer(PrioritizedReplayBuffer, ArrayReplayBuffer):
+    def __init__(self, size, alpha, **kwargs):
+        """Create Prioritized Replay buffer backed by preallocated numpy arrays.
+
+        See Also
+        --------
+        PrioritizedReplayBuffer.__init__
+        ArrayReplayBuffer.__init__
+        """
+        super(PrioritizedArrayReplayBuffer, self).__init__(size, alpha, **kwargs)
+
+
+# ReplayBuffer, welcher jede Observation nur einmal speichert. Im ArrayReplayBuffer landet jeder Frame zweimal im
+# Speicher: als obs_t einer Transition und (multi_step_size Schritte früher) als obs_tp1 einer anderen.
+# Hier werden die Frames in einem eigenen Ring abgelegt und jede Transition merkt sich nur die (absoluten) Indizes ihrer
+# beiden Frames; die Paare (s_t, s_t+n) werden erst beim Ziehen aus den Indizes wieder zusammengesetzt.
+# Erkannt wird ein bereits gespeicherter Frame an der Objekt-Identität: der Agent übergibt die Observation, welche er
+# als observation_1 gespeichert hat, n Schritte später als obs_0 wieder (siehe Sc2DqnAgent_v4.backward()). Dafür werden
+# die letzten 2 * (multi_step_size + 1) Frames vorgehalten. Episodengrenzen bleiben dadurch automatisch erhalten, da nie
+# Frames zweier Episoden zu einem Paar kombiniert werden, sondern nur die tatsächlich übergebenen.
+# Der Frame-Ring ist etwas größer als der Transitions-Ring, da am Ende jeder Episode einige Frames nur als obs_tp1
+# vorkommen. Wird ein Frame überschrieben, der noch von den ältesten Transitionen benutzt wird, fallen diese vorzeitig
+# aus dem Buffer.
+class FrameReplayBuffer(ArrayReplayBuffer):
+    def __init__(self, size, multi_step_size=1, frame_size=None, nb_envs=1, **kwargs):
+        """Create Replay buffer that stores every observation only once.
+
+        Parameters
+        ----------
+        size: int
+            Max number of transitions to store in the buffer. When the buffer
+            overflows the old memories are dropped.
+        multi_step_size: int
+            Offset n between obs_t and obs_tp1 of the stored transitions.
+        frame_size: int
+            Max number of observations to store. Defaults to a little more
+            than `size`.
+        nb_envs: int
+            Number of environments whose transitions are added interleaved
+            (see Agent3.fit_vectorized); widens the window in which repeated
+            observations are recognized.
+
+        See Also
+        --------
+        ArrayReplayBuffer.__init__
+        """
+        super(FrameReplayBuffer, self).__init__(size, **kwargs)
+        self._multi_step_size = multi_step_size
+        self._recent_frames = deque(maxlen=2 * (multi_step_size + 1) * nb_envs)
+        if frame_size is None:
+            frame_size = self._maxsize + self._maxsize // 16 + self._recent_frames.maxlen
+        self._frame_maxsize = frame_size
+
+        self._frames = None
+        self._next_frame = 0
+        self._oldest_idx = 0
+        # Absolute Frame-Indizes (Position im Ring ist frame % frame_size).
+        self._frame_t = np.zeros(self._maxsize, dtype=np.int64)
+        self._frame_tp1 = np.zeros(self._maxsize, dtype=np.int64)
+        # Kleinster Frame-Index, den die Transition benutzen kann; wird er überschrieben, ist die Transition ungültig.
+        self._frame_floor = np.zeros(self._maxsize, dtype=np.int64)
+
+    def _allocate_observations(self, obs):
+        self._frames = ObservationStorage(self._frame_maxsize, obs, self._obs_dtype, self._bit_planes,
+                                          self._obs_storage_path('frames'))
+
+    def _frame_index(self, obs):
+        for frame_obs, frame in self._recent_frames:
+            if frame_obs is obs:
+                return frame
+
+        frame = self._next_frame
+        self._frames[frame % self._frame_maxsize] = obs
+        self._next_frame += 1
+        self._recent_frames.append((obs, frame))
+
+        # Transitionen entfernen, deren Frames gerade überschrieben wurden.
+        overwritten = frame - self._frame_maxsize
+        while self._size > 0 and self._frame_floor[self._oldest_idx] <= overwritten:
+            self._remove_oldest()
+        return frame
+
+    def _remove_oldest(self):
+        self._invalidate(self._oldest_idx)
+        self._oldest_idx = (self._oldest_idx + 1) % self._maxsize
+        self._size -= 1
+
+    def _invalidate(self, idx):
+        pass
+
+    def add(self, obs_t, action, reward, obs_tp1, done):
+        if self._frames is None:
+            self._allocate_observations(obs_t)
+
+        frame_t = self._frame_index(obs_t)
+        frame_tp1 = self._frame_index(obs_tp1)
+
+        if self._size == self._maxsize:
+            self._remove_oldest()
+
+        idx = self._next_idx
+        self._frame_t[idx] = frame_t
+        self._frame_tp1[idx] = frame_tp1
+        self._frame_floor[idx] = self._recent_frames[0][1]
+        self._actions[idx] = (action.action, action.coords)
+        self._rewards[idx] = reward
+        self._dones[idx] = done
+
+        self._size += 1
+        self._next_idx = (self._next_idx + 1) % self._maxsize
+
+    def _encode_sample(self, idxes):
+        idxes = np.asarray(idxes)
+        return (self._frames[self._frame_t[idxes] % self._frame_maxsize],
+                self._actions[idxes].view(np.recarray),
+                self._rewards[idxes],
+                self._frames[self._frame_tp1[idxes] % self._frame_maxsize],
+                self._dones[idxes])
+
+    def sample(self, batch_size):
+        """Sample a batch of experiences.
+
+        See ArrayReplayBuffer.sample
+        """
+        idxes = (self._oldest_idx + np.random.randint(0, len(self), size=batch_size)) % self._maxsize
+        return self._encode_sample(idxes)
+
+    def get_state(self):
+        state = super().get_state()
+        state.update({'next_frame': self._next_frame, 'oldest_idx': self._oldest_idx,
+                      'frame_t': self._frame_t.copy(), 'frame_tp1': self._frame_tp1.copy(),
+                      'frame_floor': self._frame_floor.copy()})
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self._next_frame = state['next_frame']
+        self._oldest_idx = state['oldest_idx']
+        self._frame_t[:] = state['frame_t']
+        self._frame_tp1[:] = state['frame_tp1']
+        self._frame_floor[:] = state['frame_floor']
+        # Objekt-Identitäten überleben keinen Checkpoint, die nächsten Frames werden neu gespeichert.
+        self._recent_frames.clear()
+
+    def observation_storages(self):
+        if self._frames is None:
+            return []
+        return [('frames', self._frames, self._next_frame)]
+
+
+# PrioritizedReplayBuffer mit der Speicherung des FrameReplayBuffer. Entfernte Transitionen bekommen Priorität 0.
+class PrioritizedFrameReplayBuffer(PrioritizedReplayBuffer, FrameReplayBuffer):
+    def __init__(self, size, alpha, **kwargs):
+        """Create Prioritized Replay buffer that stores every observation only once.
+
+        See Also
+        --------
+        PrioritizedReplayBuffer.__init__
+        FrameReplayBuffer.__init__
+        """
+        super(PrioritizedFrameReplayBuffer, self).__init__(size, alpha, **kwargs)
+
+    def _invalidate(self, idx):
+        self._it_sum[idx] = 0.
+        self._it_min[idx] = float('inf')
+
+
+# Zieht die Batches in einem Hintergrund-Thread, solange das Netzwerk trainiert: sample(), Dekodieren und
+# process_state_batch() passieren vorab, in einer kleinen Queue liegen fertige float32 Batches. Nach außen gleiche
+# Schnittstelle wie das umhüllte Memory (add/sample/update_priorities), Sc2DqnAgent_v4 merkt davon nichts.
+# Alle Zugriffe auf das Memory laufen über einen Lock, die Prioritäten-Updates des Learners werden also in ihrer
+# Reihenfolge angewendet und sind für den nächsten gezogenen Batch sichtbar. Ein Batch kann dabei höchstens
+# queue_size Lernschritte alte Prioritäten haben. Zwischen Ziehen und Update überschriebene (oder im FrameReplayBuffer
+# ungültig gewordene) Transitionen bekommen kein Update.
+class PrefetchingReplayBuffer(object):
+    def __init__(self, memory, batch_size, processor=None, queue_size=2, dtype=np.float32, poll_interval=1.):
+        """Wrap a replay buffer and prefetch sampled batches in a background thread.
+
+        Parameters
+        ----------
+        memory: ReplayBuffer
+            The replay buffer to sample from (any buffer in this module).
+        batch_size: int
+            Batch size of the agent, only batches of this size are prefetched.
+        processor: Processor
+            If given, process_state_batch() is applied to obs_batch and
+            next_obs_batch in the background thread.
+        queue_size: int
+            Number of batches prepared in advance.
+        dtype: np.dtype
+            Observations are converted to this dtype.
+        poll_interval: float
+            Seconds sample() waits for a batch before it checks whether the
+            background thread has died.
+        """
+        self._memory = memory
+        self._batch_size = batch_size
+        self._processor = processor
+        self._dtype = dtype
+        self._poll_interval = poll_interval
+        self._prioritized = isinstance(memory, PrioritizedReplayBuffer)
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+        # Exception, an welcher der Hintergrund-Thread gestorben ist
+        self._error = None
+        self._sample_args = ()
+        self._nb_added = 0
+        # (idxes, nb_added, next_idx) der ausgegebenen, noch nicht aktualisierten Batches
+        self._pending = deque()
+
+    def __len__(self):
+        return len(self._memory)
+
+    def add(self, *args, **kwargs):
+        with self._lock:
+            self._memory.add(*args, **kwargs)
+            self._nb_added += 1
+
+    def _process(self, obs_batch):
+        obs_batch = np.asarray(obs_batch, dtype=self._dtype)
+        if self._processor is not None:
+            obs_batch = self._processor.process_state_batch(obs_batch)
+        return obs_batch
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                with self._lock:
+                    nb_added = self._nb_added
+                    next_idx = self._memory._next_idx
+                    batch = list(self._memory.sample(self._batch_size, *self._sample_args))
+                # Kopien aus dem Memory, ab hier ohne Lock.
+                batch[0] = self._process(batch[0])
+                batch[3] = self._process(batch[3])
+                if self._prioritized:
+                    batch[6] = np.asarray(batch[6])
+                item = (tuple(batch), nb_added, next_idx)
+
+                while not self._stop.is_set():
+                    try:
+                        self._queue.put(item, timeout=.1)
+                        break
+                    except queue.Full:
+                        pass
+        except BaseException as e:
+            # Nicht in die Queue legen: ist sie voll, würde der Thread hier hängen. sample() prüft _error.
+            self._error = e
+
+    def sample(self, batch_size, *args):
+        """Return a prefetched batch, see the sample() of the wrapped buffer.
+
+        Further arguments (beta) are used for the batches drawn from now on.
+        """
+        assert batch_size == self._batch_size
+        self._sample_args = args
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='PrefetchingReplayBuffer')
+            self._thread.daemon = True
+            self._thread.start()
+
+        while True:
+            try:
+                batch, nb_added, next_idx = self._queue.get(timeout=self._poll_interval)
+                break
+            except queue.Empty:
+                # Bereits vorbereitete Batches werden noch ausgegeben, danach die Exception des Threads.
+                if self._error is not None:
+                    raise self._error
+                if not self._thread.is_alive():
+                    raise RuntimeError('The prefetch thread of PrefetchingReplayBuffer has stopped.')
+        if self._prioritized:
+            self._pending.append((batch[6], nb_added, next_idx))
+        return batch
+
+    def update_priorities(self, idxes, priorities):
+        """See PrioritizedReplayBuffer.update_priorities
+
+        idxes must be the idxes array of a batch returned by sample().
+        """
+        # Zugehörigen Batch suchen; Batches ohne Update (z.B. übersprungen) werden verworfen.
+        while self._pending and self._pending[0][0] is not idxes:
+            self._pending.popleft()
+        assert self._pending, 'update_priorities() expects the idxes of a batch returned by sample().'
+        idxes, nb_added, next_idx = self._pending.popleft()
+        priorities = np.asarray(priorities)
+
+        with self._lock:
+            nb_new = self._nb_added - nb_added
+            keep = (idxes - next_idx) % self._memory._maxsize >= nb_new
+            # im FrameReplayBuffer entfernte Transitionen haben Priorität 0
+            keep &= self._memory._it_sum[idxes] > 0
+            if np.any(keep):
+                self._memory.update_priorities(idxes[keep], priorities[keep])
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -11,7 +11,7 @@ from baselines.common.schedules import LinearSchedule
 
 # eigene Klassen
 from agent2 import Agent2, Agent3
-from noisyNetLayers import NoisyDense, NoisyConv2D
+from noisyNetLayers import NoisyDense, NoisyConv2D, NoiseControl
 
 
 # Repräsentation einer Aktion für den Agent, bestehend aus
@@ -23,6 +23,49 @@ class Sc2Action:
         self.action = act
 
 
+# Zerlegt einen Batch von Aktionen in ein Array der Aktions-Ids (batch_size,) und eines der Koordinaten (batch_size, 2).
+# Der ArrayReplayBuffer liefert die Aktionen bereits als recarray mit diesen Feldern, der ReplayBuffer als Sc2Action
+# Objekte.
+def action_batch_arrays(action_batch):
+    if isinstance(action_batch, np.recarray):
+        return action_batch.action, action_batch.coords
+    action_ids = np.array([action.action for action in action_batch], dtype=np.int32)
+    action_coords = np.array([action.coords for action in action_batch], dtype=np.int32).reshape(-1, 2)
+    return action_ids, action_coords
+
+
+# Dummy-Targets für die Outputs des trainable_model, die nur für Metriken da sind (Loss K.zeros_like). Keras prüft bei
+# eigenen Loss-Funktionen die Form der Targets nicht, nur Batch-Größe und Anzahl der Dimensionen; ein Eintrag pro
+# Dimension genügt also, statt ganze (screen, screen, ...) Arrays zu übertragen.
+def metric_dummy_targets(outputs, batch_size):
+    return [np.zeros((batch_size,) + (1,) * (K.ndim(output) - 1), dtype='float32') for output in outputs]
+
+
+# Projektion der Bellman-Verteilung r + discount * z auf die festen Atome z (C51, Bellemare et al., 2017), vektorisiert
+# für alle Atome, alle Batch-Elemente und beliebig viele Köpfe (bei Sc2DqnAgent_v5 Aktion und Koordinate) auf einmal.
+# rewards und not_terminals haben die Form (batch_size,) (not_terminals 0 für Endzustände, dann bleibt nur der Reward),
+# p_next (batch_size, nb_heads, nb_atoms) ist die Verteilung der gewählten Aktion bzw. Koordinate in s_t+n.
+# Gibt die Ziel-Verteilungen (batch_size, nb_heads, nb_atoms) zurück. Gleiche Ziel-Atome werden per bincount
+# aufsummiert; liegt Tz genau auf einem Atom (l == u), bekommt dieses die ganze Masse.
+def categorical_projection(rewards, not_terminals, p_next, z, discount):
+    z = np.asarray(z, dtype=np.float64)
+    batch_size, nb_heads, nb_atoms = p_next.shape
+
+    tz = np.asarray(rewards)[:, None] + (discount * np.asarray(not_terminals))[:, None] * z
+    b = np.clip((tz - z[0]) / (z[1] - z[0]), 0, nb_atoms - 1)
+    l = np.floor(b).astype(np.int64)
+    u = np.ceil(b).astype(np.int64)
+    weight_l = (u - b) + (l == u)
+    weight_u = b - l
+
+    # flache Indizes in (batch_size, nb_heads, nb_atoms), die Köpfe teilen sich Tz
+    offsets = (np.arange(batch_size * nb_heads) * nb_atoms).reshape(batch_size, nb_heads, 1)
+    size = batch_size * nb_heads * nb_atoms
+    m = np.bincount((offsets + l[:, None, :]).ravel(), weights=(p_next * weight_l[:, None, :]).ravel(), minlength=size)
+    m += np.bincount((offsets + u[:, None, :]).ravel(), weights=(p_next * weight_u[:, None, :]).ravel(), minlength=size)
+    return m.reshape(batch_size, nb_heads, nb_atoms)
+
+
 # Der Klassenstruktur des Keras-rl Frameworks folgend (siehe rl.agents.dqn.py) Kopien der Klasse AbstractDQNAgent,
 # welche kaum modifiziert sind (in den jeweiligen Kommentaren am Klassenanfang beschrieben).
 
@@ -229,7 +272,8 @@ class AbstractSc2DQNAgent3(Agent3):
             self.compiled = False
 
         def process_state_batch(self, batch):
-            batch = np.array(batch)
+            # asarray: Batches aus dem ArrayReplayBuffer sind bereits numpy Arrays und müssen nicht kopiert werden.
+            batch = np.asarray(batch)
             if self.processor is None:
                 return batch
             return self.processor.process_state_batch(batch)
@@ -284,20 +328,34 @@ class Sc2DqnAgent_v4(AbstractSc2DQNAgent3):
         prio_replay__: A boolean which signals the Agent, if the memory is PrioritizedReplayBuffer (true) or ReplayBuffer (false) and if true, enables priority calculation.
         prio_replay_beta__: A 3-tuple which contains (start_value_beta, end_value_beta, number_of_steps) as parameters for prio_replay (ignored if it's inactive).
         multi_step_size__: Positive integer that determines the step-size of the algorithm, see readme.md for reference of multi-step algorithm.
+        fused_td_errors__: A boolean which makes the training step also return the absolute TD error of every sample (computed in the same pass, before the update), which is then used as new priority instead of a second forward pass (ignored if prio_replay is inactive).
+        fused_targets__: A boolean which computes the n-step targets (online argmax, target network gather, discounting) in one compiled graph call instead of two predict_on_batch() calls plus numpy post-processing.
+        noise_hold_steps__: None (default) draws new noise in the noisy layers on every model call. A positive integer N holds the noise of model and target model fixed and resamples it every N agent steps during training. test() uses the mean weights.
+        fast_act__: A boolean which makes forward() and forward_batch() compute the greedy actions and coordinates inside the graph (one compiled function call, for forward() on a preallocated input batch) instead of predict_on_batch() plus numpy argmax; the policy then only gets the greedy actions (see Sc2Policy.select_action).
+        sparse_targets__: A boolean which makes the trainable model take the integer indices (action, y * screen + x) of the chosen action and coordinate, their two scalar targets and the IS weights, and gather the predicted Q-values in the graph, instead of dense target and mask arrays of shape (screen, screen, 1).
 
     # Anmerkung - Übersicht!
         Für die Implementierung interessant sind insbesondere die folgenden Methoden:
         - __init__(): hier wird die Dueling-Modifikation vorgenommen, falls eingeschaltet.
-        - compile(): hier steht die Loss-Funktion, welche als Lambda-Layer implementiert wird.
+        - compile(): hier steht die Loss-Funktion, welche als Lambda-Layer implementiert wird (dicht mit Masken oder
+                mit sparse_targets über Indizes).
         - forward(): Speichert State-Action Paare im RingBuffer
         - backward(): Speichert Rewards im RingBuffer, Speichert (S, A, R_n, S_n, done) Tupel im Replay Memory,
                 zieht Werte aus dem ReplayMemory, berechnet neue Target-Q-Werte, führt einen
                 Lernschritt (train_on_batch() Methode) aus, berechnet ggf. neue Prioritäten.
+        - train_step(): Ein Lernschritt (Sampling, Targets, train_on_batch(), Prioritäten), von backward() aufgerufen.
+        - _train_with_td_errors(): Lernschritt, der zusätzlich die TD-Fehler für neue Prioritäten zurückgibt.
+        - _compile_target_function(): Online-/Target-Netzwerk und Berechnung der Targets als ein gemeinsamer Graph.
+        - _compile_act_function(), _greedy_action(s)(): greedy Aktionen im Graph für forward() und forward_batch().
+        - set_noise_mode(): Zufall der Noisy-Layers steuern (resample, hold, mean), siehe NoiseControl.
+        - reset_env_states(), select_env(), forward_batch(): mehrere Environments mit je eigenem RingBuffer und
+                gemeinsamem Forward-Pass, siehe Agent3.fit_vectorized().
     """
 
     def __init__(self, model, policy=None, test_policy=None, enable_double_dqn=False, enable_dueling_network=False,
                  dueling_type='avg', noisy_nets=True, prio_replay=True, prio_replay_beta=(0.5, 1.0, 200000),
-                 bad_prio_replay=True, multi_step_size=3, *args, **kwargs):
+                 bad_prio_replay=True, multi_step_size=3, fused_td_errors=False,
+                 fused_targets=False, noise_hold_steps=None, fast_act=False, sparse_targets=False, *args, **kwargs):
         super(Sc2DqnAgent_v4, self).__init__(*args, **kwargs)
 
         # Validate (important) input. Falls man sein Model falsch definiert hat (  ^:
@@ -315,6 +373,11 @@ class Sc2DqnAgent_v4(AbstractSc2DQNAgent3):
         self.prio_replay_beta = prio_replay_beta
         self.bad_prio_replay = bad_prio_replay
         self.multi_step_size = multi_step_size
+        self.fused_td_errors = fused_td_errors
+        self.fused_targets = fused_targets
+        self.noise_hold_steps = noise_hold_steps
+        self.fast_act = fast_act
+        self.sparse_targets = sparse_targets
 
         # Wenn Dueling Networks eingeschaltet ist, werden hier die letzten Ebenen des Netzwerks ersetzt
         # durch ein Dueling-Modul. Jeweils für den linearen Output und den zweidimensionalen Output.
@@ -433,6 +496,11 @@ class Sc2DqnAgent_v4(AbstractSc2DQNAgent3):
         self.target_model.compile(optimizer='sgd', loss='mse')
         self.model.compile(optimizer='sgd', loss='mse')
 
+        # Zufall der Noisy-Layers beider Netzwerke, ggf. für noise_hold_steps Schritte gehalten.
+        self.noise_control = NoiseControl([self.model, self.target_model], hold_steps=self.noise_hold_steps or 1)
+        if self.noise_hold_steps:
+            self.noise_control.set_mode('hold')
+
         # Compile model.
         if self.target_model_update < 1.:
             # We use the `AdditionalUpdatesOptimizer` to efficiently soft-update the target model.
@@ -450,6 +518,21 @@ class Sc2DqnAgent_v4(AbstractSc2DQNAgent3):
             sum_loss_b = K.sum(loss[1])
             return K.sum([sum_loss_a, sum_loss_b], axis=-1)
 
+        # Q-Werte der gewählten Aktion (action) und Koordinate (coord = y * screen_size + x) jedes Samples.
+        def chosen_q_values(y_pred_a, y_pred_b, action, coord):
+            batch_idxs = K.tf.range(K.tf.shape(y_pred_a)[0])
+            q_a = K.tf.gather_nd(y_pred_a, K.tf.stack([batch_idxs, action[:, 0]], axis=1))
+            q_b = K.tf.gather_nd(K.batch_flatten(y_pred_b), K.tf.stack([batch_idxs, coord[:, 0]], axis=1))
+            return q_a, q_b
+
+        # Wie clipped_masked_error, aber mit Indizes statt Masken; weight enthält ggf. die IS-Gewichte.
+        def sparse_clipped_error(args):
+            target_a, target_b, y_pred_a, y_pred_b, action, coord, weight = args
+            q_a, q_b = chosen_q_values(y_pred_a, y_pred_b, action, coord)
+            sum_loss_a = K.sum(huber_loss(target_a[:, 0], q_a, self.delta_clip) * weight[:, 0])
+            sum_loss_b = K.sum(huber_loss(target_b[:, 0], q_b, self.delta_clip) * weight[:, 0])
+            return K.sum([sum_loss_a, sum_loss_b], axis=-1)
+
         # Kommentar aus der Keras-rl Implementierung
         # Create trainable model. The problem is that we need to mask the output since we only
         # ever want to update the Q values for a certain action. The way we achieve this is by
@@ -457,21 +540,36 @@ class Sc2DqnAgent_v4(AbstractSc2DQNAgent3):
         # to mask out certain parameters by passing in multiple inputs to the Lambda layer.
 
         y_pred = self.model.output
+        ins = [self.model.input] if type(self.model.input) is not list else self.model.input
 
-        y_true_a = Input(name='y_true_a', shape=(self.nb_actions,))
-        y_true_b = Input(name='y_true_b', shape=(self.screen_size, self.screen_size, 1))
-        mask_a = Input(name='mask_a', shape=(self.nb_actions,))
-        mask_b = Input(name='mask_b', shape=(self.screen_size, self.screen_size, 1))
+        if self.sparse_targets:
+            # Pro Sample nur die Indizes der gewählten Aktion und der flachen Koordinate, die zwei Targets und das
+            # IS-Gewicht: keine (screen, screen, 1) Arrays mehr für Targets und Masken.
+            action = Input(name='action', shape=(1,), dtype='int32')
+            coord = Input(name='coord', shape=(1,), dtype='int32')
+            target_a = Input(name='target_a', shape=(1,))
+            target_b = Input(name='target_b', shape=(1,))
+            weight = Input(name='weight', shape=(1,))
+            loss_inputs = [target_a, target_b, y_pred[0], y_pred[1], action, coord, weight]
+
+            loss_out = Lambda(sparse_clipped_error, output_shape=(1,), name='loss')(loss_inputs)
+            trainable_model = Model(inputs=ins + [action, coord, target_a, target_b, weight],
+                                    outputs=[loss_out, y_pred[0], y_pred[1]])
+        else:
+            y_true_a = Input(name='y_true_a', shape=(self.nb_actions,))
+            y_true_b = Input(name='y_true_b', shape=(self.screen_size, self.screen_size, 1))
+            mask_a = Input(name='mask_a', shape=(self.nb_actions,))
+            mask_b = Input(name='mask_b', shape=(self.screen_size, self.screen_size, 1))
+            loss_inputs = [y_true_a, y_true_b, y_pred[0], y_pred[1], mask_a, mask_b]
 
-        loss_out = Lambda(clipped_masked_error, output_shape=(1,), name='loss')(
-            [y_true_a, y_true_b, y_pred[0], y_pred[1], mask_a, mask_b])
-        ins = [self.model.input] if type(self.model.input) is not list else self.model.input
+            loss_out = Lambda(clipped_masked_error, output_shape=(1,), name='loss')(loss_inputs)
 
-        # Finale Model-Definition, die ermöglicht, eine Observation (ins) sowie zwei Target-Q-Werte (y_true_a linearer
-        # Output, y_true_b zweidimensionaler Output) und zwei Masken (Null-Vektor/Null-Matrix mit einer Eins an der
-        # Position der gewählten Aktion) an das Netzwerk zu übergeben, dessen erster Output dann der Loss ist.
-        trainable_model = Model(inputs=ins + [y_true_a, y_true_b, mask_a, mask_b],
-                                outputs=[loss_out, y_pred[0], y_pred[1]])
+            # Finale Model-Definition, die ermöglicht, eine Observation (ins) sowie zwei Target-Q-Werte (y_true_a
+            # linearer Output, y_true_b zweidimensionaler Output) und zwei Masken (Null-Vektor/Null-Matrix mit einer
+            # Eins an der Position der gewählten Aktion) an das Netzwerk zu übergeben, dessen erster Output dann der
+            # Loss ist.
+            trainable_model = Model(inputs=ins + [y_true_a, y_true_b, mask_a, mask_b],
+                                    outputs=[loss_out, y_pred[0], y_pred[1]])
         print(trainable_model.summary())
 
         losses = [
@@ -482,8 +580,124 @@ class Sc2DqnAgent_v4(AbstractSc2DQNAgent3):
         trainable_model.compile(optimizer=optimizer, loss=losses)  # metrics=combined_metrics
         self.trainable_model = trainable_model
 
+        # Betrag des TD-Fehlers jedes Samples (ohne IS-Gewichte) für neue Prioritäten. Die Masken enthalten ggf. die
+        # IS-Gewichte, deshalb wird nur betrachtet, wo sie ungleich Null sind.
+        def abs_td_error(args):
+            y_true_a, y_true_b, y_pred_a, y_pred_b, mask_a, mask_b = args
+            unit_mask_a = K.cast(K.not_equal(mask_a, 0.), K.floatx())
+            unit_mask_b = K.cast(K.not_equal(mask_b, 0.), K.floatx())
+            td_a = K.sum((y_pred_a - y_true_a) * unit_mask_a, axis=-1)
+            td_b = K.sum((y_pred_b - y_true_b) * unit_mask_b, axis=(1, 2, 3))
+            return K.abs(td_a + td_b)
+
+        def sparse_abs_td_error(args):
+            target_a, target_b, y_pred_a, y_pred_b, action, coord, weight = args
+            q_a, q_b = chosen_q_values(y_pred_a, y_pred_b, action, coord)
+            return K.abs((q_a - target_a[:, 0]) + (q_b - target_b[:, 0]))
+
+        # Eigene Train-Funktion mit dem TD-Fehler als weiterem Output: gleicher Loss (der Lambda-Layer, die beiden
+        # anderen Outputs tragen nichts bei), gleiche Optimizer-Updates wie train_on_batch(), aber ein Forward-Pass
+        # für Update und Prioritäten. Damit entfällt das zweite predict_on_batch() nach dem Lernschritt.
+        # Es wird dann nur noch diese Funktion zum Lernen benutzt, der Optimizer legt seine Variablen also nur einmal an.
+        if self.prio_replay and self.fused_td_errors:
+            td_error_out = Lambda(sparse_abs_td_error if self.sparse_targets else abs_td_error, output_shape=(1,),
+                                  name='td_error')(loss_inputs)
+            total_loss = loss_out
+            for regularization_loss in trainable_model.losses:
+                total_loss += regularization_loss
+            updates = trainable_model.optimizer.get_updates(params=trainable_model.trainable_weights,
+                                                            loss=total_loss)
+            train_td_inputs = trainable_model.inputs
+            self._train_td_learning_phase = not isinstance(K.learning_phase(), int)
+            if self._train_td_learning_phase:
+                train_td_inputs = train_td_inputs + [K.learning_phase()]
+            self.train_td_function = K.function(train_td_inputs, [total_loss, loss_out, td_error_out],
+                                                updates=updates + trainable_model.updates)
+
+        if self.fused_targets:
+            self._compile_target_function()
+
+        if self.fast_act:
+            self._compile_act_function()
+
         self.compiled = True
 
+    def _compile_target_function(self):
+        # Ein Graph für beide Netzwerke: state2 geht einmal in das Online- und das Target-Netzwerk, Argmax (Double DQN)
+        # bzw. Max, Gather und Diskontierung passieren in TF. Ergebnis sind direkt Rs_a und Rs_b (float32).
+        if type(self.model.input) is list:
+            raise ValueError('fused_targets expects a model with exactly one input.')
+
+        state2 = Input(name='state2', shape=K.int_shape(self.model.input)[1:])
+        reward = K.placeholder(name='reward', shape=(None,))
+        # terminal2 = 1 - done, wie in backward()
+        terminal2 = K.placeholder(name='terminal2', shape=(None,))
+
+        target_q2_values = self.target_model(state2)
+        target_q2_b = K.batch_flatten(target_q2_values[1])
+
+        if self.enable_double_dqn:
+            # Online-Netzwerk wählt die Aktion/Koordinate, Target-Netzwerk liefert den Wert dazu.
+            q2_values = self.model(state2)
+            actions_a = K.argmax(q2_values[0], axis=-1)
+            actions_b = K.argmax(K.batch_flatten(q2_values[1]), axis=-1)
+            q_batch_a = K.sum(target_q2_values[0] * K.one_hot(actions_a, self.nb_actions), axis=-1)
+            q_batch_b = K.sum(target_q2_b * K.one_hot(actions_b, self.screen_size * self.screen_size), axis=-1)
+        else:
+            q_batch_a = K.max(target_q2_values[0], axis=-1)
+            q_batch_b = K.max(target_q2_b, axis=-1)
+
+        discount = self.gamma ** self.multi_step_size
+        Rs_a = reward + discount * q_batch_a * terminal2
+        Rs_b = reward + discount * q_batch_b * terminal2
+
+        self.target_function = K.function([state2, reward, terminal2], [Rs_a, Rs_b])
+
+    def _compile_act_function(self):
+        # Greedy-Aktion direkt im Graph: Argmax über den linearen Output und über die Koordinaten (flach, y * screen + x).
+        # Keras' predict_on_batch() (Standardisieren der Inputs, Batch-Schleife, Zusammensetzen der Outputs) und das
+        # Argmax in numpy entfallen, zurück kommen nur zwei Integer.
+        if type(self.model.input) is list:
+            raise ValueError('fast_act expects a model with exactly one input.')
+
+        q_values = self.model.output
+        action = K.argmax(q_values[0], axis=-1)
+        coords = K.argmax(K.batch_flatten(q_values[1]), axis=-1)
+
+        inputs = [self.model.input]
+        self._act_learning_phase = not isinstance(K.learning_phase(), int)
+        if self._act_learning_phase:
+            inputs.append(K.learning_phase())
+        self.act_function = K.function(inputs, [action, coords])
+        # Vorallokierter Batch der Größe 1, forward() kopiert die Observation nur noch hinein.
+        self._act_input = np.zeros((1,) + K.int_shape(self.model.input)[1:], dtype=K.floatx())
+
+    def _greedy_actions(self, state_batch):
+        # Gibt die Aktions-Ids (n,) und Koordinaten (n, 2) als (y, x) der höchsten Q-Werte zurück, wie Sc2Policy im
+        # greedy-Fall. Ohne fast_act aus den Q-Werten von predict_on_batch().
+        batch = self.process_state_batch(state_batch)
+        if self.fast_act:
+            ins = [batch, 0.] if self._act_learning_phase else [batch]
+            actions, coords = self.act_function(ins)
+        else:
+            q_values = self.model.predict_on_batch(batch)
+            actions = np.argmax(q_values[0], axis=-1)
+            coords = np.argmax(q_values[1].reshape(len(batch), -1), axis=-1)
+        return actions, np.stack(np.divmod(coords, self.screen_size), axis=-1)
+
+    def _greedy_action(self, observation):
+        # Eine Observation über den vorallokierten Batch.
+        self._act_input[0] = observation
+        actions, coords = self._greedy_actions(self._act_input)
+        return int(actions[0]), (int(coords[0, 0]), int(coords[0, 1]))
+
+    def _train_with_td_errors(self, ins):
+        # Entspricht trainable_model.train_on_batch(ins, targets), gibt aber zusätzlich die TD-Fehler zurück. Die
+        # Metriken haben dieselbe Form [Gesamt-Loss, Loss der drei Outputs], die beiden Q-Wert-Outputs haben Loss 0.
+        inputs = ins + [1.] if self._train_td_learning_phase else ins
+        total_loss, loss, td_errors = self.train_td_function(inputs)
+        return [total_loss, loss, 0., 0.], td_errors
+
     def load_weights(self, filepath):
         self.model.load_weights(filepath)
         self.update_target_model_hard()
@@ -501,14 +715,46 @@ class Sc2DqnAgent_v4(AbstractSc2DQNAgent3):
     def update_target_model_hard(self):
         self.target_model.set_weights(self.model.get_weights())
 
+    def set_noise_mode(self, mode):
+        return self.noise_control.set_mode(mode)
+
+    def reset_env_states(self, nb_envs):
+        # Eigene RingBuffer (State-Action-Paare und Rewards) für jedes Environment.
+        self.env_states = [(RingBuffer(maxlen=self.multi_step_size), RingBuffer(maxlen=self.multi_step_size))
+                           for _ in range(nb_envs)]
+        self.select_env(0)
+
+    def select_env(self, env_idx):
+        # forward() und backward() arbeiten auf self.recent/self.recent_r, diese zeigen nun auf das Environment.
+        self.recent, self.recent_r = self.env_states[env_idx]
+
+    def forward_batch(self, observations):
+        if self.training:
+            self.noise_control.step()
+
+        # Ein Forward-Pass für die Observations aller Environments, Epsilon-Greedy für alle auf einmal.
+        policy = self.policy if self.training else self.test_policy
+        actions = policy.select_action(greedy_actions=self._greedy_actions(observations))
+
+        # Book-keeping im RingBuffer des jeweiligen Environments.
+        for i, (observation, action) in enumerate(zip(observations, actions)):
+            self.env_states[i][0].append((observation, action))
+
+        return actions
+
     def forward(self, observation):
-        # Select an action.
-        state = [observation]
-        q_values = self.compute_q_values(state)
+        # Im hold-Modus wird der Zufall alle noise_hold_steps Trainingsschritte neu gezogen.
         if self.training:
-            action = self.policy.select_action(q_values=q_values)
+            self.noise_control.step()
+
+        # Select an action.
+        policy = self.policy if self.training else self.test_policy
+        if self.fast_act:
+            action = policy.select_action(greedy_action=self._greedy_action(observation))
         else:
-            action = self.test_policy.select_action(q_values=q_values)
+            state = [observation]
+            q_values = self.compute_q_values(state)
+            action = policy.select_action(q_values=q_values)
 
         # Book-keeping.
         self.recent.append((observation, action))
@@ -545,76 +791,70 @@ class Sc2DqnAgent_v4(AbstractSc2DQNAgent3):
 
         # Train the network on a single stochastic batch.
         if self.step > self.nb_steps_warmup and self.step % self.train_interval == 0:
-            # Ziehen der Erfahrungen aus dem ReplayMemory
-            if self.prio_replay:
-                experiences = self.memory.sample(self.batch_size, self.beta_schedule.value(self.step))
-            else:
-                experiences = self.memory.sample(self.batch_size)
+            metrics = self.train_step()
 
-            assert len(experiences[0]) == self.batch_size
+        # Target-Model updaten nach ca. 10000 Schritten.
+        if self.target_model_update >= 1 and self.step % self.target_model_update == 0:
+            self.update_target_model_hard()
 
-            # Start by extracting the necessary parameters (we use a vectorized implementation).
-            state0_batch = []
-            action_batch = []
-            reward_batch = []
-            state2_batch = []
-            terminal2_batch = []
-            if self.prio_replay:
-                prio_weights_batch = []
-                id_batch = []
+        return metrics
 
-            if self.prio_replay:
-                experiences = zip(experiences[0], experiences[1], experiences[2], experiences[3], experiences[4],
-                                  experiences[5], experiences[6])
-            else:
-                experiences = zip(experiences[0], experiences[1], experiences[2], experiences[3], experiences[4])
+    def train_step(self):
+        """Zieht einen Batch aus dem ReplayMemory, berechnet die Targets, führt einen Lernschritt aus und aktualisiert
+        ggf. die Prioritäten. Wird von backward() alle train_interval Schritte aufgerufen, vom Ape-X Learner direkt.
 
-            for e in experiences:
-                state0_batch.append(e[0])
-                action_batch.append(e[1])
-                reward_batch.append(e[2])
-                state2_batch.append(e[3])
-                terminal2_batch.append(0. if e[4] else 1.)
-                if self.prio_replay:
-                    prio_weights_batch.append(e[5])
-                    id_batch.append(e[6])
+        # Returns
+            List of metrics values
+        """
+        # Ziehen der Erfahrungen aus dem ReplayMemory
+        if self.prio_replay:
+            experiences = self.memory.sample(self.batch_size, self.beta_schedule.value(self.step))
+        else:
+            experiences = self.memory.sample(self.batch_size)
 
-            # Prepare and validate parameters.
-            state0_batch = self.process_state_batch(state0_batch)
-            state2_batch = self.process_state_batch(state2_batch)
-            terminal2_batch = np.array(terminal2_batch)
-            reward_batch = np.array(reward_batch)
-            if self.prio_replay:
-                prio_weights_batch = np.array(prio_weights_batch)
-            else:
-                prio_weights_batch = np.ones(reward_batch.shape)
-            assert reward_batch.shape == (self.batch_size,)
-            assert terminal2_batch.shape == reward_batch.shape
-            assert len(action_batch) == len(reward_batch)
+        assert len(experiences[0]) == self.batch_size
 
-            # Compute Q values for mini-batch update.
+        # Start by extracting the necessary parameters (we use a vectorized implementation).
+        state0_batch = self.process_state_batch(experiences[0])
+        action_ids, action_coords = action_batch_arrays(experiences[1])
+        reward_batch = np.asarray(experiences[2], dtype=np.float64)
+        state2_batch = self.process_state_batch(experiences[3])
+        terminal2_batch = 1. - np.asarray(experiences[4], dtype=np.float64)
+        if self.prio_replay:
+            prio_weights_batch = np.asarray(experiences[5])
+            id_batch = experiences[6]
+        else:
+            prio_weights_batch = np.ones(reward_batch.shape)
+
+        # Prepare and validate parameters.
+        assert reward_batch.shape == (self.batch_size,)
+        assert terminal2_batch.shape == reward_batch.shape
+        assert action_ids.shape == reward_batch.shape
+
+        batch_idxes = np.arange(self.batch_size)
+
+        # Compute Q values for mini-batch update.
+        if self.fused_targets:
+            # Online- und Target-Netzwerk, Argmax, Gather und die n-Step Targets in einem Session-Run,
+            # siehe _compile_target_function().
+            Rs_a, Rs_b = self.target_function([state2_batch, reward_batch, terminal2_batch])
+        else:
             if self.enable_double_dqn:
                 # According to the paper "Deep Reinforcement Learning with Double Q-learning"
                 # (van Hasselt et al., 2015), in Double DQN, the online network predicts the actions
                 # while the target network is used to estimate the Q value.
                 q2_values = self.model.predict_on_batch(state2_batch)
 
+                # Argmax über die flach gemachte Koordinaten-Map (screen * screen * 1) statt unravel_index pro Sample.
                 actions_a = np.argmax(q2_values[0], -1)
-                actions_b = []
-                for ac_b in q2_values[1]:
-                    actions_b.append(np.unravel_index(ac_b.argmax(), ac_b.shape)[0:2])
-                actions_b = np.array(actions_b)
+                actions_b = np.argmax(np.reshape(q2_values[1], (self.batch_size, -1)), -1)
 
                 # Now, estimate Q values using the target network but select the values with the
                 # highest Q value wrt to the online model (as computed above).
                 target_q2_values = self.target_model.predict_on_batch(state2_batch)
 
-                q_batch_a = target_q2_values[0][range(self.batch_size), actions_a]
-                q_batch_b = []
-                for (i, square_q) in enumerate(target_q2_values[1]):
-                    q_batch_b.append(square_q[:, :, 0][actions_b[i][0], actions_b[i][1]])
-
-                q_batch_b = np.array(q_batch_b)
+                q_batch_a = target_q2_values[0][batch_idxes, actions_a]
+                q_batch_b = np.reshape(target_q2_values[1], (self.batch_size, -1))[batch_idxes, actions_b]
             else:
 
                 # Compute the q_values given state1, and extract the maximum for each sample in the batch.
@@ -630,13 +870,6 @@ class Sc2DqnAgent_v4(AbstractSc2DQNAgent3):
                 q_batch_a = np.array(q_batch_a)
                 q_batch_b = np.array(q_batch_b)
 
-            # Sammeln der Werte in für das Netzwerk lesbarem Format, Generieren der Masken für die gewählten Actions.
-            targets_a = np.zeros((self.batch_size, self.nb_actions,))
-            targets_b = np.zeros((self.batch_size, self.screen_size, self.screen_size, 1))
-
-            masks_a = np.zeros((self.batch_size, self.nb_actions,))
-            masks_b = np.zeros((self.batch_size, self.screen_size, self.screen_size, 1))
-
             # Compute r_t+n (included discounting) + gamma^n * max_a Q(s_t+n, a) and update the targets accordingly,
             # but only for the affected output units (as given by action_batch). (Called Rs_a and Rs_b)
 
@@ -648,75 +881,78 @@ class Sc2DqnAgent_v4(AbstractSc2DQNAgent3):
             Rs_a = reward_batch[:] + discounted_reward_batch_a
             Rs_b = reward_batch[:] + discounted_reward_batch_b
 
-            for idx, (target_a, target_b, mask_a, mask_b, R_a, R_b, action, prio_weight) in \
-                    enumerate(zip(targets_a, targets_b, masks_a, masks_b, Rs_a, Rs_b, action_batch, prio_weights_batch)):
-                target_a[action.action] = R_a  # update action with estimated accumulated reward
-                target_b[action.coords] = R_b  # update action with estimated accumulated reward
-                if self.bad_prio_replay:
-                    mask_a[action.action] = 1  # enable loss for this specific action
-                    mask_b[action.coords] = 1  # enable loss for this specific action
-                else:
-                    mask_a[action.action] = prio_weight  # enable loss for this specific action
-                    mask_b[action.coords] = prio_weight  # enable loss for this specific action
-
-            targets_a = np.array(targets_a).astype('float32')
-            targets_b = np.array(targets_b).astype('float32')
-            masks_a = np.array(masks_a).astype('float32')
-            masks_b = np.array(masks_b).astype('float32')
-
-            # Finally, perform a single update on the entire batch. We use a dummy target since
-            # the actual loss is computed in a Lambda layer that needs more complex input. However,
-            # it is still useful to know the actual target to compute metrics properly.
-            ins = [state0_batch] if type(self.model.input) is not list else state0_batch
+        ys, xs = action_coords[:, 0], action_coords[:, 1]
+        if self.bad_prio_replay:
+            mask_values = np.ones(self.batch_size, dtype='float32')  # enable loss for this specific action
+        else:
+            mask_values = prio_weights_batch  # enable loss for this specific action
+
+        # Finally, perform a single update on the entire batch. We use a dummy target since
+        # the actual loss is computed in a Lambda layer that needs more complex input. However,
+        # it is still useful to know the actual target to compute metrics properly.
+        ins = [state0_batch] if type(self.model.input) is not list else state0_batch
+
+        if self.sparse_targets:
+            # Nur Indizes, Targets und Gewichte; die Metrik-Outputs bekommen Dummy-Targets.
+            coord_ids = ys * self.screen_size + xs
+            train_ins = ins + [action_ids[:, None], coord_ids[:, None], np.reshape(Rs_a, (-1, 1)),
+                               np.reshape(Rs_b, (-1, 1)), mask_values[:, None]]
+            train_targets = [np.zeros(self.batch_size)] + metric_dummy_targets(self.model.output, self.batch_size)
+        else:
+            # Sammeln der Werte in für das Netzwerk lesbarem Format, Generieren der Masken für die gewählten Actions.
+            targets_a = np.zeros((self.batch_size, self.nb_actions,), dtype='float32')
+            targets_b = np.zeros((self.batch_size, self.screen_size, self.screen_size, 1), dtype='float32')
 
-            metrics = self.trainable_model.train_on_batch(ins + [targets_a, targets_b, masks_a, masks_b],
-                                                          [np.zeros(self.batch_size), targets_a, targets_b])
+            masks_a = np.zeros((self.batch_size, self.nb_actions,), dtype='float32')
+            masks_b = np.zeros((self.batch_size, self.screen_size, self.screen_size, 1), dtype='float32')
 
-            metrics = [metric for idx, metric in enumerate(metrics) if
-                       idx not in (1, 2)]  # throw away individual losses
+            # Setzen der Targets und Masken für die gewählte Aktion bzw. Koordinate jedes Samples per Index-Arrays.
+            targets_a[batch_idxes, action_ids] = Rs_a  # update action with estimated accumulated reward
+            targets_b[batch_idxes, ys, xs, 0] = Rs_b  # update action with estimated accumulated reward
+            masks_a[batch_idxes, action_ids] = mask_values
+            masks_b[batch_idxes, ys, xs, 0] = mask_values
 
-            # Berechnung neuer Prioritäten nach dem Update.
-            if self.prio_replay:
-                pred = self.trainable_model.predict_on_batch(ins + [targets_a, targets_b, masks_a, masks_b])
+            train_ins = ins + [targets_a, targets_b, masks_a, masks_b]
+            train_targets = [np.zeros(self.batch_size), targets_a, targets_b]
 
-            # update priority batch
-            if self.prio_replay:
-                prios = []
-                if self.bad_prio_replay:
-                    # "Schlechte" Version, die nicht funktionieren dürfte, es aber besser oder gleichgut tut als die
-                    # richtige Implementierung.
-                    for pre in zip(pred[1], pred[2]):
-                        loss = [target_a - pre[0],
-                                target_b - pre[1]]
-                        loss[0] *= mask_a  # apply element-wise mask
-                        loss[1] *= mask_b  # apply element-wise mask
-                        sum_loss_a = np.sum(loss[0])
-                        sum_loss_b = np.sum(loss[1])
-                        prios.append(np.abs(np.sum([sum_loss_a, sum_loss_b])))
+        if self.prio_replay and self.fused_td_errors:
+            # Neue Prioritäten direkt aus dem Lernschritt (TD-Fehler vor dem Update).
+            metrics, prios = self._train_with_td_errors(train_ins)
+        else:
+            metrics = self.trainable_model.train_on_batch(train_ins, train_targets)
+
+        metrics = [metric for idx, metric in enumerate(metrics) if
+                   idx not in (1, 2)]  # throw away individual losses
+
+        # Berechnung neuer Prioritäten nach dem Update.
+        if self.prio_replay and not self.fused_td_errors:
+            pred = self.trainable_model.predict_on_batch(train_ins)
+
+            q_b = np.reshape(pred[2], (self.batch_size, -1))
+            if self.bad_prio_replay:
+                # "Schlechte" Version, die nicht funktionieren dürfte, es aber besser oder gleichgut tut als die
+                # richtige Implementierung. Wie in der früheren Schleifen-Version werden dabei Target und Maske
+                # des letzten Samples im Batch für alle Samples verwendet.
+                if self.sparse_targets:
+                    loss_a = Rs_a[-1] - pred[1][:, action_ids[-1]]
+                    loss_b = Rs_b[-1] - q_b[:, coord_ids[-1]]
                 else:
-                    # Richtige Implementierung.
-                    for (pre_a, pre_b, target_a, target_b, mask_a, mask_b, prio_weight) \
-                            in zip(pred[1], pred[2], targets_a, targets_b, masks_a, masks_b, prio_weights_batch):
-                        # need to remove prio weight from masks
-                        mask_a = mask_a / prio_weight
-                        mask_b = mask_b / prio_weight
-                        loss = [pre_a - target_a,
-                                pre_b - target_b]
-                        loss[0] *= mask_a  # apply element-wise mask
-                        loss[1] *= mask_b  # apply element-wise mask
-                        sum_loss_a = np.sum(loss[0])
-                        sum_loss_b = np.sum(loss[1])
-                        prios.append(np.abs(np.sum([sum_loss_a, sum_loss_b])))
-
-                self.memory.update_priorities(id_batch, prios)
+                    loss_a = np.sum((targets_a[-1] - pred[1]) * masks_a[-1], axis=1)  # apply element-wise mask
+                    loss_b = np.sum((targets_b[-1] - pred[2]) * masks_b[-1], axis=(1, 2, 3))  # apply element-wise mask
+            else:
+                # Richtige Implementierung: TD-Fehler der gewählten Aktion und Koordinate jedes Samples
+                # (ohne IS-Gewichte).
+                loss_a = pred[1][batch_idxes, action_ids] - Rs_a
+                loss_b = q_b[batch_idxes, ys * self.screen_size + xs] - Rs_b
+            prios = np.abs(loss_a + loss_b)
 
-            metrics += self.policy.metrics
-            if self.processor is not None:
-                metrics += self.processor.metrics
+        # update priority batch
+        if self.prio_replay:
+            self.memory.update_priorities(id_batch, prios)
 
-        # Target-Model updaten nach ca. 10000 Schritten.
-        if self.target_model_update >= 1 and self.step % self.target_model_update == 0:
-            self.update_target_model_hard()
+        metrics += self.policy.metrics
+        if self.processor is not None:
+            metrics += self.processor.metrics
 
         return metrics
 
@@ -770,12 +1006,13 @@ class Sc2DqnAgent_v5(AbstractSc2DQNAgent3):
             `avg`: Q(s,a;theta) = V(s;theta) + (A(s,a;theta)-Avg_a(A(s,a;theta)))
             `max`: Q(s,a;theta) = V(s;theta) + (A(s,a;theta)-max_a(A(s,a;theta)))
             `naive`: Q(s,a;theta) = V(s;theta) + A(s,a;theta)
+        sparse_targets__: A boolean which makes the distributional trainable model take the projected target distributions of the chosen action and coordinate and their integer indices (action, y * screen + x), and gather the predicted distributions in the graph, instead of dense target and mask arrays of shape (screen, screen, len(z)).
 
     """
 
     def __init__(self, model, policy=None, test_policy=None, enable_double_dqn=False, enable_dueling_network=False,
                  dueling_type='avg', noisy_nets=True, prio_replay=True, prio_replay_beta=(0.5, 1.0, 200000),
-                 multi_step_size=3, distributed=True, z=[], *args, **kwargs):
+                 multi_step_size=3, distributed=True, z=[], sparse_targets=False, *args, **kwargs):
         super(Sc2DqnAgent_v5, self).__init__(*args, **kwargs)
 
         # Validate (important) input.
@@ -800,6 +1037,7 @@ class Sc2DqnAgent_v5(AbstractSc2DQNAgent3):
         self.multi_step_size = multi_step_size
         self.distributed = distributed
         self.z = z
+        self.sparse_targets = sparse_targets
 
         if self.distributed:
             assert len(z) > 0
@@ -922,6 +1160,17 @@ class Sc2DqnAgent_v5(AbstractSc2DQNAgent3):
             updates = get_soft_target_model_updates(self.target_model, self.model, self.target_model_update)
             optimizer = AdditionalUpdatesOptimizer(optimizer, updates)
 
+        def gather_chosen(args):
+            # Verteilungen der gewählten Aktion (action) und Koordinate (coord = y * screen_size + x) jedes Samples,
+            # jeweils (batch_size, len(z)).
+            y_pred_a, y_pred_b, action, coord = args
+            p_a = K.tf.reshape(y_pred_a, [-1, self.nb_actions, len(self.z)])
+            p_b = K.tf.reshape(y_pred_b, [-1, self.screen_size * self.screen_size, len(self.z)])
+            batch_idxs = K.tf.range(K.tf.shape(p_a)[0])
+            p_a = K.tf.gather_nd(p_a, K.tf.stack([batch_idxs, action[:, 0]], axis=1))
+            p_b = K.tf.gather_nd(p_b, K.tf.stack([batch_idxs, coord[:, 0]], axis=1))
+            return p_a, p_b
+
         def clipped_masked_kl_error(args):
             y_true_a, y_true_b, y_pred_a, y_pred_b, mask_a, mask_b = args
             # y_true_a shape is [self.nb_actions * len(self.z)] np.reshape(z_values[0], [self.nb_actions, len(self.z)])
@@ -940,6 +1189,19 @@ class Sc2DqnAgent_v5(AbstractSc2DQNAgent3):
             sum_loss_b = K.sum(loss_b)
             return K.sum([sum_loss_a, sum_loss_b], axis=-1)
 
+        def sparse_kl_error(args):
+            # Wie clipped_masked_kl_error: Cross-Entropy zwischen projizierter Ziel-Verteilung (m_a, m_b) und der
+            # vorhergesagten Verteilung der gewählten Aktion bzw. Koordinate, aber mit Gather statt Masken.
+            m_a, m_b, y_pred_a, y_pred_b, action, coord = args
+            p_a, p_b = gather_chosen([y_pred_a, y_pred_b, action, coord])
+
+            loss_a = -K.tf.reduce_sum(K.tf.multiply(m_a, K.tf.log(p_a + 1e-8)), axis=-1)
+            loss_b = -K.tf.reduce_sum(K.tf.multiply(m_b, K.tf.log(p_b + 1e-8)), axis=-1)
+
+            sum_loss_a = K.sum(loss_a)
+            sum_loss_b = K.sum(loss_b)
+            return K.sum([sum_loss_a, sum_loss_b], axis=-1)
+
         def clipped_masked_error(args):
             y_true_a, y_true_b, y_pred_a, y_pred_b, mask_a, mask_b = args
             loss = [huber_loss(y_true_a, y_pred_a, self.delta_clip),
@@ -968,7 +1230,21 @@ class Sc2DqnAgent_v5(AbstractSc2DQNAgent3):
 
         y_pred = self.model.output
 
-        if self.distributed:
+        if self.distributed and self.sparse_targets:
+            # Pro Sample nur die Ziel-Verteilungen (len(z) Werte je Kopf) und die Indizes der gewählten Aktion bzw.
+            # der flachen Koordinate y * screen_size + x.
+            m_a = Input(name='m_a', shape=(len(self.z),))
+            m_b = Input(name='m_b', shape=(len(self.z),))
+            action = Input(name='action', shape=(1,), dtype='int32')
+            coord = Input(name='coord', shape=(1,), dtype='int32')
+
+            loss_out = Lambda(sparse_kl_error, output_shape=(1,), name='loss')(
+                [m_a, m_b, y_pred[0], y_pred[1], action, coord])
+            ins = [self.model.input] if type(self.model.input) is not list else self.model.input
+
+            trainable_model = Model(inputs=ins + [m_a, m_b, action, coord],
+                                    outputs=[loss_out, y_pred[0], y_pred[1]])
+        elif self.distributed:
             y_true_a = Input(name='y_true_a', shape=(self.nb_actions, len(self.z),))
             y_true_b = Input(name='y_true_b', shape=(self.screen_size, self.screen_size, len(self.z)))
             mask_a = Input(name='mask_a', shape=(self.nb_actions,))
@@ -1113,12 +1389,6 @@ class Sc2DqnAgent_v5(AbstractSc2DQNAgent3):
             assert terminal2_batch.shape == reward_batch.shape
             assert len(action_batch) == len(reward_batch)
 
-            targets_a = np.zeros((self.batch_size, self.nb_actions, len(self.z)))
-            targets_b = np.zeros((self.batch_size, self.screen_size, self.screen_size, len(self.z)))
-
-            masks_a = np.zeros((self.batch_size, self.nb_actions,))
-            masks_b = np.zeros((self.batch_size, self.screen_size, self.screen_size,))
-
             # Compute Q values for mini-batch update.
             if self.enable_double_dqn:
                 # According to the paper "Deep Reinforcement Learning with Double Q-learning"
@@ -1158,65 +1428,63 @@ class Sc2DqnAgent_v5(AbstractSc2DQNAgent3):
                     best2_coord.append(np.unravel_index(square_q.argmax(), square_q.shape)[0:2])  # verify
                 best2_coord = np.array(best2_coord)
 
-            m_batch_a = np.zeros([self.batch_size, len(self.z)])
-            for j in range(len(self.z)):
-                Tz = reward_batch + (self.gamma ** self.multi_step_size) * self.z[j]
-
-                # Bounding Tz
-                Tz[Tz >= self.z[-1]] = self.z[-1]
-                Tz[Tz <= self.z[0]] = self.z[0]
-
-                b = (Tz - self.z[0]) / (self.z[1] - self.z[0])
-                l = np.int32(np.floor(b))
-                u = np.int32(np.ceil(b))
-
-                m_batch_a[:, l] += p2_act[np.arange(len(p2_act)), best2_act, j] * (u - b)
-                m_batch_a[:, u] += p2_act[np.arange(len(p2_act)), best2_act, j] * (b - l)
-
-            # normalize
-            sum_m_batch_a = np.reshape(np.sum(m_batch_a, axis=1), [self.batch_size, 1])
-            m_batch_a = m_batch_a / sum_m_batch_a
-
-            m_batch_b = np.zeros([self.batch_size, len(self.z)])
-            for j in range(len(self.z)):
-                Tz = reward_batch + (self.gamma ** self.multi_step_size) * self.z[j]
+            # Verteilungen der besten Aktion und Koordinate in s_t+n, beide Köpfe in einer Projektion.
+            # Die Masse bleibt dabei erhalten, eine Normalisierung ist nicht nötig.
+            batch_idxs = np.arange(self.batch_size)
+            p2_best = np.stack([p2_act[batch_idxs, best2_act],
+                                p2_coord[batch_idxs, best2_coord[:, 0], best2_coord[:, 1]]], axis=1)
+            m_batch = categorical_projection(reward_batch, terminal2_batch, p2_best, self.z,
+                                             self.gamma ** self.multi_step_size)
+            m_batch_a = m_batch[:, 0]
+            m_batch_b = m_batch[:, 1]
 
-                # Bounding Tz
-                Tz[Tz >= self.z[-1]] = self.z[-1]
-                Tz[Tz <= self.z[0]] = self.z[0]
-
-                b = (Tz - self.z[0]) / (self.z[1] - self.z[0])
-                l = np.int32(np.floor(b))
-                u = np.int32(np.ceil(b))
-
-                m_batch_b[:, l] += p2_coord[np.arange(len(p2_coord)), best2_coord[:, 0], best2_coord[:, 1], j] * (u - b)
-                m_batch_b[:, u] += p2_coord[np.arange(len(p2_coord)), best2_coord[:, 0], best2_coord[:, 1], j] * (b - l)
-
-            # normalize
-            sum_m_batch_b = np.reshape(np.sum(m_batch_b, axis=1), [self.batch_size, 1])
-            m_batch_b = m_batch_b / sum_m_batch_b
-
-            for idx, (target_a, target_b, mask_a, mask_b, m_a, m_b, action) in \
-                    enumerate(zip(targets_a, targets_b, masks_a, masks_b, m_batch_a, m_batch_b, action_batch)):
-                target_a[action.action] = m_a  # updated distribution
-                target_b[action.coords] = m_b  # updated distribution
-
-                mask_a[action.action] = 1.  # enable loss for this specific action
-                mask_b[action.coords] = 1.  # enable loss for this specific action
-            targets_a = np.array(targets_a).astype('float32')
-            targets_b = np.array(targets_b).astype('float32')
-            masks_a = np.array(masks_a).astype('float32')
-            masks_b = np.array(masks_b).astype('float32')
+            ins = [state0_batch] if type(self.model.input) is not list else state0_batch
+            if self.sparse_targets:
+                # Nur die Ziel-Verteilungen und die Indizes der gewählten Aktion und der flachen Koordinate, das
+                # Gather passiert im Graph.
+                action_ids, action_coords = action_batch_arrays(action_batch)
+                action_ids = action_ids[:, None]
+                coord_ids = (action_coords[:, 0] * self.screen_size + action_coords[:, 1])[:, None]
+                train_ins = ins + [m_batch_a.astype('float32'), m_batch_b.astype('float32'), action_ids, coord_ids]
+                train_targets = [np.zeros(self.batch_size)] + metric_dummy_targets(self.model.output, self.batch_size)
+
+                # Die Prioritäten unten verwenden wie im dichten Fall Target und Maske des letzten Samples.
+                if self.prio_replay:
+                    target_a = np.zeros((self.nb_actions, len(self.z)))
+                    target_b = np.zeros((self.screen_size, self.screen_size, len(self.z)))
+                    mask_a = np.zeros((self.nb_actions,))
+                    mask_b = np.zeros((self.screen_size, self.screen_size,))
+                    target_a[action_batch[-1].action] = m_batch_a[-1]
+                    target_b[tuple(action_batch[-1].coords)] = m_batch_b[-1]
+                    mask_a[action_batch[-1].action] = 1.
+                    mask_b[tuple(action_batch[-1].coords)] = 1.
+            else:
+                targets_a = np.zeros((self.batch_size, self.nb_actions, len(self.z)))
+                targets_b = np.zeros((self.batch_size, self.screen_size, self.screen_size, len(self.z)))
+
+                masks_a = np.zeros((self.batch_size, self.nb_actions,))
+                masks_b = np.zeros((self.batch_size, self.screen_size, self.screen_size,))
+
+                for idx, (target_a, target_b, mask_a, mask_b, m_a, m_b, action) in \
+                        enumerate(zip(targets_a, targets_b, masks_a, masks_b, m_batch_a, m_batch_b, action_batch)):
+                    target_a[action.action] = m_a  # updated distribution
+                    target_b[tuple(action.coords)] = m_b  # updated distribution
+
+                    mask_a[action.action] = 1.  # enable loss for this specific action
+                    mask_b[tuple(action.coords)] = 1.  # enable loss for this specific action
+                targets_a = np.array(targets_a).astype('float32')
+                targets_b = np.array(targets_b).astype('float32')
+                masks_a = np.array(masks_a).astype('float32')
+                masks_b = np.array(masks_b).astype('float32')
+                train_ins = ins + [targets_a, targets_b, masks_a, masks_b]
+                train_targets = [np.zeros(self.batch_size), targets_a, targets_b]
 
             # Finally, perform a single update on the entire batch. We use a dummy target since
             # the actual loss is computed in a Lambda layer that needs more complex input. However,
             # it is still useful to know the actual target to compute metrics properly.
-            ins = [state0_batch] if type(self.model.input) is not list else state0_batch
-
-            metrics = self.trainable_model.train_on_batch(ins + [targets_a, targets_b, masks_a, masks_b],
-                                                          [np.zeros(self.batch_size), targets_a, targets_b])
+            metrics = self.trainable_model.train_on_batch(train_ins, train_targets)
             if self.prio_replay:
-                pred = self.trainable_model.predict_on_batch(ins + [targets_a, targets_b, masks_a, masks_b])
+                pred = self.trainable_model.predict_on_batch(train_ins)
 
             metrics = [metric for idx, metric in enumerate(metrics) if
                        idx not in (1, 2)]  # throw away individual losses
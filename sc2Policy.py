@@ -4,6 +4,9 @@ from sc2DqnAgent import Sc2Action
 
 
 # Policy zur Verarbeitung der zwei Outputs der FullyConv Architektur.
+# Statt der Q-Werte kann der Agent auch direkt die greedy Aktion(en) übergeben (im Graph berechnet, siehe
+# Sc2DqnAgent_v4 mit fast_act), dann geht nur noch Epsilon-Greedy über ein paar Integer. Der Zufall für Exploration,
+# Aktion und Koordinate kommt aus einem einzigen np.random.random() Aufruf, auch für einen ganzen Batch.
 class Sc2Policy(Policy):
 
     def __init__(self, env, nb_actions=3, eps=0.1, testing=False):
@@ -13,25 +16,36 @@ class Sc2Policy(Policy):
         self.nb_actions = nb_actions
         self.testing = testing
 
-    def select_action(self, q_values):
+    def select_action(self, q_values=None, greedy_action=None, greedy_actions=None):
         """Return the selected action
 
         # Arguments
             q_values (numpy array of shape (2, ?)):
             one List of q-estimates for action-selection
             one array of shape (screensize, screensize) for position selection
+            greedy_action (tuple (action, (y, x))):
+            greedy action already computed by the agent (e.g. Sc2DqnAgent_v4 with fast_act), used instead of q_values
+            greedy_actions (tuple of arrays (actions, coords) of shape (n,) and (n, 2)):
+            greedy actions of a batch of observations, see select_actions
 
         # Returns
-            Selection action (understandable by pysc2)
+            Selection action (understandable by pysc2), a list of them for greedy_actions
         """
+        if greedy_actions is not None:
+            return self.select_actions(*greedy_actions)
 
         action = Sc2Action()
 
-        # Epsilon-Greedy
-        if np.random.uniform() < self.eps and not self.testing:
+        # Epsilon-Greedy, ein Zufallsaufruf für [Exploration, Aktion, y, x]
+        rand = np.random.random(4)
+        if rand[0] < self.eps and not self.testing:
             # Aktion zufällig wählen.
-            action.action = np.random.random_integers(0, self.nb_actions-1)
-            action.coords = (np.random.random_integers(0, self.nb_pixels-1),  np.random.random_integers(0, self.nb_pixels-1))
+            action.action = int(rand[1] * self.nb_actions)
+            action.coords = (int(rand[2] * self.nb_pixels), int(rand[3] * self.nb_pixels))
+
+        elif greedy_action is not None:
+            # Greedy-Aktion wurde schon im Graph bestimmt.
+            action.action, action.coords = greedy_action
 
         else:
             # Aktion "greedy" nach den höchsten Q-Werten auswählen.
@@ -45,6 +59,26 @@ class Sc2Policy(Policy):
 
         return action
 
+    def select_actions(self, actions, coords):
+        """Epsilon-greedy for a batch, e.g. one observation per environment.
+
+        # Arguments
+            actions (int array of shape (n,)): greedy action ids
+            coords (int array of shape (n, 2)): greedy coordinates (y, x)
+
+        # Returns
+            List of n selected actions
+        """
+        actions = np.asarray(actions)
+        coords = np.asarray(coords)
+        if not self.testing:
+            rand = np.random.random((len(actions), 4))
+            explore = rand[:, 0] < self.eps
+            actions = np.where(explore, (rand[:, 1] * self.nb_actions).astype(actions.dtype), actions)
+            coords = np.where(explore[:, None], (rand[:, 2:] * self.nb_pixels).astype(coords.dtype), coords)
+
+        return [Sc2Action(int(action), int(y), int(x)) for action, (y, x) in zip(actions, coords)]
+
     def get_config(self):
         """Return configurations of EpsGreedyPolicy
 
@@ -81,11 +115,11 @@ class Sc2PolicyD(Policy):
 
         action = Sc2Action()
 
-        if np.random.uniform() < self.eps and not self.testing:
+        rand = np.random.random(4)
+        if rand[0] < self.eps and not self.testing:
 
-            action.action = np.random.random_integers(0, self.nb_actions-1)
-            action.coords = (np.random.random_integers(0, self.nb_pixels-1),
-                             np.random.random_integers(0, self.nb_pixels-1))
+            action.action = int(rand[1] * self.nb_actions)
+            action.coords = (int(rand[2] * self.nb_pixels), int(rand[3] * self.nb_pixels))
 
         else:
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Die Module des Projekts liegen direkt im Wurzelverzeichnis.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
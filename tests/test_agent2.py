@@ -0,0 +1,175 @@
+from functools import partial
+
+import numpy as np
+from keras.layers import Conv2D, Dense, Flatten, Input, Permute
+from keras.models import Model
+from keras.optimizers import Adam
+from rl.callbacks import Callback
+
+from fakeEnv import FakeSc2Env2Outputs
+from sc2DqnAgent import Sc2DqnAgent_v4
+from sc2Policy import Sc2Policy
+from sc2Processor import Sc2Processor
+from vecEnv import SerialVecEnv
+
+NB_ACTIONS = 3
+SCREEN = 6
+EPISODE_LENGTH = 7
+MULTI_STEP_SIZE = 3
+SEEDS = (3, 8)
+
+
+# Speichert die Transitionen getrennt nach Environment: fit_vectorized() ruft backward() nach select_env(i) auf, der
+# aktuelle RingBuffer des Agenten verrät also das Environment.
+class RecordingMemory(object):
+    def __init__(self):
+        self.agent = None
+        self.transitions = {}
+
+    def add(self, observation_0, action, reward, observation_1, terminal):
+        env_states = getattr(self.agent, 'env_states', [(self.agent.recent, None)])
+        env_idx = [i for i, (recent, _) in enumerate(env_states) if recent is self.agent.recent][0]
+        self.transitions.setdefault(env_idx, []).append((observation_0, action, reward, observation_1, terminal))
+
+
+class EpisodeRecorder(Callback):
+    def __init__(self):
+        super(EpisodeRecorder, self).__init__()
+        self.begun = []
+        self.ended = []
+
+    def on_episode_begin(self, episode, logs={}):
+        self.begun.append(episode)
+
+    def on_episode_end(self, episode, logs={}):
+        self.ended.append((episode, logs))
+
+
+def make_agent():
+    # Kleines Netzwerk ohne Noisy Layers, Epsilon 0 und kein Training: die Actions hängen nur von der Observation ab.
+    main_input = Input(shape=(2, SCREEN, SCREEN), name='main_input')
+    x = Permute((2, 3, 1))(main_input)
+    x = Conv2D(4, (3, 3), padding='same', activation='relu')(x)
+    coord_out = Conv2D(1, (1, 1), padding='same', activation='linear')(x)
+    act_out = Dense(NB_ACTIONS, activation='linear')(Flatten()(x))
+    model = Model(main_input, [act_out, coord_out])
+    random = np.random.RandomState(0)
+    model.set_weights([random.normal(0, .3, w.shape) for w in model.get_weights()])
+
+    memory = RecordingMemory()
+    policy = Sc2Policy(FakeSc2Env2Outputs(screen=SCREEN), nb_actions=NB_ACTIONS, eps=0.)
+    agent = Sc2DqnAgent_v4(model=model, nb_actions=NB_ACTIONS, screen_size=SCREEN, memory=memory,
+                           processor=Sc2Processor(screen=SCREEN), noisy_nets=False, prio_replay=False,
+                           multi_step_size=MULTI_STEP_SIZE, policy=policy, test_policy=policy, nb_steps_warmup=10 ** 6, target_model_update=10 ** 6)
+    agent.compile(Adam(lr=.01))
+    memory.agent = agent
+    return agent
+
+
+def make_env(seed, episode_length=EPISODE_LENGTH):
+    return FakeSc2Env2Outputs(screen=SCREEN, episode_length=episode_length, seed=seed)
+
+
+def assert_same_transitions(transitions, reference):
+    assert len(transitions) == len(reference)
+    for (obs_0, action, reward, obs_1, terminal), (ref_0, ref_action, ref_reward, ref_1, ref_terminal) in \
+            zip(transitions, reference):
+        np.testing.assert_array_equal(obs_0, ref_0)
+        np.testing.assert_array_equal(obs_1, ref_1)
+        assert (action.action, tuple(action.coords)) == (ref_action.action, tuple(ref_action.coords))
+        assert reward == ref_reward
+        assert terminal == ref_terminal
+
+
+def test_fit_vectorized_matches_fit_per_env():
+    agent = make_agent()
+    nb_steps = 3 * EPISODE_LENGTH + 2
+
+    # Referenz: jedes Environment für sich mit fit().
+    reference = []
+    for seed in SEEDS:
+        agent.memory.transitions = {}
+        # fit() leert den RingBuffer nur am Episodenende, die angefangene Episode des vorigen Laufs muss weg.
+        agent.reset_env_states(1)
+        episodes = EpisodeRecorder()
+        agent.fit(make_env(seed), nb_steps=nb_steps, callbacks=[episodes], verbose=0)
+        reference.append(agent.memory.transitions[0])
+        # self.episode ist die Anzahl der begonnenen Episoden, auch wenn die letzte nicht zu Ende lief.
+        assert agent.episode == len(episodes.begun) == 4
+
+    agent.memory.transitions = {}
+    episodes = EpisodeRecorder()
+    vec_env = SerialVecEnv([partial(make_env, seed) for seed in SEEDS])
+    agent.fit_vectorized(vec_env, nb_steps=len(SEEDS) * nb_steps, callbacks=[episodes], verbose=0)
+
+    for env_idx in range(len(SEEDS)):
+        assert_same_transitions(agent.memory.transitions[env_idx], reference[env_idx])
+    assert agent.episode == len(episodes.begun) == 8
+    assert sorted(episodes.begun) == list(range(8))
+    assert [logs['nb_episode_steps'] for _, logs in episodes.ended] == [EPISODE_LENGTH] * 6
+
+
+# SerialVecEnv, das für Environment 0 einmal einen abgestürzten und neu gestarteten Worker meldet (wie SubprocVecEnv).
+class RestartingVecEnv(SerialVecEnv):
+    def __init__(self, env_fns, restart_at):
+        super(RestartingVecEnv, self).__init__(env_fns)
+        self.restart_at = restart_at
+        self.nb_steps = 0
+        self.before_restart = []
+        self.after_restart = []
+
+    def step(self, actions):
+        observations, rewards, dones, infos = super(RestartingVecEnv, self).step(actions)
+        self.nb_steps += 1
+        if self.nb_steps == self.restart_at:
+            infos[0] = {'worker_restarted': True, 'terminal_observation': observations[0]}
+            observations[0] = self.envs[0].reset()
+            rewards[0], dones[0] = 0., True
+        (self.before_restart if self.nb_steps < self.restart_at else self.after_restart).append(observations[0])
+        return observations, rewards, dones, infos
+
+    def reset(self):
+        observations = super(RestartingVecEnv, self).reset()
+        self.before_restart.append(observations[0])
+        return observations
+
+
+def test_fit_vectorized_drops_restarted_worker_transitions():
+    agent = make_agent()
+    vec_env = RestartingVecEnv([partial(make_env, seed, episode_length=50) for seed in SEEDS], restart_at=5)
+    episodes = EpisodeRecorder()
+    agent.fit_vectorized(vec_env, nb_steps=2 * 12, callbacks=[episodes], verbose=0)
+
+    transitions = agent.memory.transitions[0]
+    # Kein Endzustand mit Reward 0 für den Absturz, keine Transition über den Neustart hinweg.
+    assert not any(terminal for *_, terminal in transitions)
+    before = [id(observation) for observation in vec_env.before_restart]
+    after = [id(observation) for observation in vec_env.after_restart]
+    before_restart = [t for t in transitions if id(t[0]) in before]
+    after_restart = [t for t in transitions if id(t[0]) in after]
+    assert len(before_restart) + len(after_restart) == len(transitions)
+    assert all(id(t[3]) in before for t in before_restart)
+    assert all(id(t[3]) in after for t in after_restart)
+    # Vor dem Absturz 4 Schritte, danach beginnt der RingBuffer von vorn. Der Absturz zählt nicht als Schritt, daher
+    # 13 Durchläufe für 24 Schritte: 8 Schritte nach dem Neustart, jeweils n - 1 davon ohne Transition.
+    assert len(before_restart) == 4 - (MULTI_STEP_SIZE - 1)
+    assert after_restart[0][0] is vec_env.after_restart[0]
+    assert len(after_restart) == 8 - (MULTI_STEP_SIZE - 1)
+
+    # Die abgebrochene Episode endet (ohne den Absturz als Schritt), Environment 0 beginnt eine neue.
+    assert episodes.ended == [(0, {'episode_reward': 0., 'nb_episode_steps': 4, 'nb_steps': 8})]
+    assert agent.episode == len(episodes.begun) == 3
+
+
+def test_test_vectorized_counts_episodes():
+    agent = make_agent()
+    episodes = EpisodeRecorder()
+    vec_env = SerialVecEnv([partial(make_env, seed, episode_length=4) for seed in SEEDS])
+    agent.test_vectorized(vec_env, nb_episodes=5, callbacks=[episodes], verbose=0)
+
+    assert episodes.begun == [0, 1, 2, 3, 4]
+    assert sorted(episode for episode, _ in episodes.ended) == [0, 1, 2, 3, 4]
+    assert all(logs['nb_steps'] == 4 for _, logs in episodes.ended)
+    assert agent.step == 5 * 4
+    # test_vectorized() ruft backward() nicht auf.
+    assert agent.memory.transitions == {}
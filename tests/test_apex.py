@@ -0,0 +1,131 @@
+import multiprocessing
+import os
+import queue
+import threading
+from functools import partial
+
+import numpy as np
+import pytest
+from keras.layers import Conv2D, Dense, Flatten, Input, Permute
+from keras.models import Model
+from keras.optimizers import Adam
+
+from apex import ApeXTrainer, _actor
+from fakeEnv import FakeSc2Env2Outputs
+from prioReplayBuffer import PrioritizedFrameReplayBuffer
+from sc2DqnAgent import Sc2DqnAgent_v4
+from sc2Policy import Sc2Policy
+from sc2Processor import Sc2Processor
+
+NB_ACTIONS = 3
+SCREEN = 6
+GAMMA = .9
+MULTI_STEP_SIZE = 3
+
+
+def make_agent():
+    main_input = Input(shape=(2, SCREEN, SCREEN), name='main_input')
+    x = Permute((2, 3, 1))(main_input)
+    x = Conv2D(4, (3, 3), padding='same', activation='relu')(x)
+    coord_out = Conv2D(1, (1, 1), padding='same', activation='linear')(x)
+    act_out = Dense(NB_ACTIONS, activation='linear')(Flatten()(x))
+    model = Model(main_input, [act_out, coord_out])
+    random = np.random.RandomState(0)
+    model.set_weights([random.normal(0, .3, w.shape) for w in model.get_weights()])
+
+    memory = PrioritizedFrameReplayBuffer(1000, .6, multi_step_size=MULTI_STEP_SIZE, nb_envs=2)
+    policy = Sc2Policy(FakeSc2Env2Outputs(screen=SCREEN), nb_actions=NB_ACTIONS)
+    agent = Sc2DqnAgent_v4(model=model, nb_actions=NB_ACTIONS, screen_size=SCREEN, memory=memory,
+                           processor=Sc2Processor(screen=SCREEN), noisy_nets=False, prio_replay=True,
+                           multi_step_size=MULTI_STEP_SIZE, policy=policy, gamma=GAMMA, batch_size=8,
+                           nb_steps_warmup=50, target_model_update=100)
+    agent.compile(Adam(lr=.001))
+    return agent
+
+
+# FakeSc2Env2Outputs mit Reward 1, 2, 3, ... pro Episode, damit die n-Step Rewards nachrechenbar sind. Hält das
+# Training nach nb_steps Schritten an und merkt sich Observations und Rewards jeder Episode.
+class RecordingEnv(FakeSc2Env2Outputs):
+    def __init__(self, episode_length, nb_steps, stop_event):
+        super(RecordingEnv, self).__init__(screen=SCREEN, episode_length=episode_length, seed=3)
+        self.nb_steps = nb_steps
+        self.stop_event = stop_event
+        self.episodes = []
+
+    def reset(self):
+        observation = super(RecordingEnv, self).reset()
+        self.episodes.append(([observation], []))
+        return observation
+
+    def step(self, action):
+        observation, _, done, info = super(RecordingEnv, self).step(action)
+        reward = float(self.episode_step)
+        self.episodes[-1][0].append(observation)
+        self.episodes[-1][1].append(reward)
+        self.nb_steps -= 1
+        if self.nb_steps == 0:
+            self.stop_event.set()
+        return observation, reward, done, info
+
+
+@pytest.mark.parametrize('episode_length', [2, 7])
+def test_actor_stores_every_step_of_an_episode(episode_length):
+    agent = make_agent()
+    trainer = ApeXTrainer(agent, None, nb_actors=1, send_interval=1)
+    transition_queue, weight_queue, stop_event = queue.Queue(), queue.Queue(), threading.Event()
+    weight_queue.put(agent.model.get_weights())
+    env = RecordingEnv(episode_length, nb_steps=3 * episode_length, stop_event=stop_event)
+    _actor(0, trainer.actor_config, lambda: env, .5, 1, transition_queue, weight_queue, stop_event)
+
+    transitions = []
+    nb_episodes = 0
+    while not transition_queue.empty():
+        message = transition_queue.get()
+        if message[0] == 'transitions':
+            transitions += message[2]
+        else:
+            nb_episodes += 1
+            assert message[3] == episode_length
+
+    # Drei volle Episoden, jeder Schritt als Transition: n-Step, am Ende mit den restlichen Rewards.
+    assert nb_episodes == 3
+    assert len(transitions) == 3 * episode_length
+    for episode, (observations, rewards) in enumerate(env.episodes[:3]):
+        for t, (obs_t, action, reward, obs_tp1, done, priority) in \
+                enumerate(transitions[episode * episode_length:(episode + 1) * episode_length]):
+            end = min(t + MULTI_STEP_SIZE, episode_length)
+            np.testing.assert_array_equal(obs_t, observations[t])
+            np.testing.assert_array_equal(obs_tp1, observations[end])
+            assert done == (end == episode_length)
+            assert reward == pytest.approx(sum(r * GAMMA ** i for i, r in enumerate(rewards[t:end])))
+            assert priority >= 0.
+
+
+def make_env_recording_devices(directory):
+    # Läuft im Actor-Prozess: merkt sich CUDA_VISIBLE_DEVICES, wie Keras es beim Import gesehen hat.
+    with open(os.path.join(directory, 'actor_{}'.format(os.getpid())), 'w') as f:
+        f.write(repr(os.environ.get('CUDA_VISIBLE_DEVICES')))
+    return FakeSc2Env2Outputs(screen=SCREEN, episode_length=10)
+
+
+def test_apex_trainer_fit(tmp_path):
+    np.random.seed(0)
+    agent = make_agent()
+    weights = agent.model.get_weights()
+    trainer = ApeXTrainer(agent, partial(make_env_recording_devices, str(tmp_path)), nb_actors=2, seed=1,
+                          send_interval=10, weight_sync_interval=10, weight_poll_interval=20)
+    cuda_visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES')
+    # Wenige Lernschritte, die Actors spielen dabei schon einige hundert Episoden.
+    history = trainer.fit(nb_steps=20, verbose=0)
+
+    # Beide Actors spielen volle Episoden, der Learner hat gelernt und die Actors sind beendet.
+    assert set(history['actor']) == {0, 1}
+    assert set(history['nb_episode_steps']) == {10}
+    assert len(agent.memory) > agent.nb_steps_warmup
+    assert any(np.any(w != ref) for w, ref in zip(agent.model.get_weights(), weights))
+    assert multiprocessing.active_children() == []
+
+    # Die Actors starten ohne GPU, der Learner-Prozess behält seine Einstellung.
+    devices = [(tmp_path / name).read_text() for name in os.listdir(str(tmp_path))]
+    assert devices == ["''", "''"]
+    assert os.environ.get('CUDA_VISIBLE_DEVICES') == cuda_visible_devices
@@ -0,0 +1,137 @@
+import os
+from functools import partial
+
+import keras.backend as K
+import numpy as np
+import pytest
+from keras.layers import Conv2D, Dense, Flatten, Input, Permute
+from keras.models import Model
+from keras.optimizers import Adam
+
+from checkpoint import TrainingCheckpoint, _memory_of, _optimizer, checkpoint_path, load_training_state
+from fakeEnv import FakeSc2Env2Outputs
+from prioReplayBuffer import PrioritizedFrameReplayBuffer
+from sc2DqnAgent import Sc2DqnAgent_v4
+from sc2Policy import Sc2Policy
+from sc2Processor import Sc2Processor
+from vecEnv import SerialVecEnv
+
+NB_ACTIONS = 3
+SCREEN = 6
+EPISODE_LENGTH = 10
+MULTI_STEP_SIZE = 3
+
+
+def make_agent(fused_td_errors):
+    main_input = Input(shape=(2, SCREEN, SCREEN), name='main_input')
+    x = Permute((2, 3, 1))(main_input)
+    x = Conv2D(4, (3, 3), padding='same', activation='relu')(x)
+    coord_out = Conv2D(1, (1, 1), padding='same', activation='linear')(x)
+    act_out = Dense(NB_ACTIONS, activation='linear')(Flatten()(x))
+    model = Model(main_input, [act_out, coord_out])
+
+    memory = PrioritizedFrameReplayBuffer(200, .6, multi_step_size=MULTI_STEP_SIZE)
+    policy = Sc2Policy(FakeSc2Env2Outputs(screen=SCREEN), nb_actions=NB_ACTIONS, eps=.3)
+    agent = Sc2DqnAgent_v4(model=model, nb_actions=NB_ACTIONS, screen_size=SCREEN, memory=memory,
+                           processor=Sc2Processor(screen=SCREEN), noisy_nets=False, prio_replay=True,
+                           multi_step_size=MULTI_STEP_SIZE, fused_td_errors=fused_td_errors, policy=policy,
+                           batch_size=8, nb_steps_warmup=20, target_model_update=50)
+    agent.compile(Adam(lr=.001))
+    return agent
+
+
+def make_env(seed):
+    return FakeSc2Env2Outputs(screen=SCREEN, episode_length=EPISODE_LENGTH, seed=seed)
+
+
+# Hält den Trainingszustand zu Beginn jedes Checkpoints fest und prüft beim Schreiben, dass der vorige, vollständige
+# Checkpoint erhalten bleibt, bis der neue in path + '.tmp' fertig ist.
+class RecordingCheckpoint(TrainingCheckpoint):
+    def __init__(self, *args, **kwargs):
+        super(RecordingCheckpoint, self).__init__(*args, **kwargs)
+        self.expected = None
+        self.nb_steps_writing = 0
+        self.nb_steps_writing_with_previous = 0
+
+    def _begin(self, episode):
+        agent = self.model
+        memory = _memory_of(agent)
+        self.expected = {
+            'step': agent.step,
+            'episode': episode,
+            'memory': memory.get_state(),
+            'storages': {name: {key: array.copy() for key, array in storage.arrays().items()}
+                         for name, storage, _ in memory.observation_storages()},
+            'optimizer': K.batch_get_value(_optimizer(agent).weights),
+            'model': agent.model.get_weights(),
+            'target_model': agent.target_model.get_weights(),
+            'np_random': np.random.get_state(),
+        }
+        super(RecordingCheckpoint, self)._begin(episode)
+
+    def on_step_end(self, step, logs=None):
+        if self.writing:
+            self.nb_steps_writing += 1
+            assert os.path.isdir(self.path + '.tmp')
+            assert not os.path.exists(os.path.join(self.path + '.tmp', 'state.pkl'))
+            if checkpoint_path(self.path) == self.path:
+                self.nb_steps_writing_with_previous += 1
+        super(RecordingCheckpoint, self).on_step_end(step, logs)
+
+
+def assert_same_arrays(values, expected):
+    assert len(values) == len(expected)
+    for value, ref in zip(values, expected):
+        np.testing.assert_array_equal(value, ref)
+
+
+@pytest.mark.parametrize('fused_td_errors', [False, True])
+def test_checkpoint_round_trip(tmp_path, fused_td_errors):
+    path = str(tmp_path / 'training_state')
+    np.random.seed(0)
+    agent = make_agent(fused_td_errors)
+    # 220 Frames im Ring, 16 pro Schritt: jeder Checkpoint wird über mehrere Episoden hinweg geschrieben.
+    checkpoint = RecordingCheckpoint(path, interval=60, chunk_size=16)
+    agent.fit(make_env(1), nb_steps=200, callbacks=[checkpoint], verbose=0)
+
+    # Mehrere Checkpoints, der alte blieb während des Schreibens des neuen erhalten; danach kein .tmp/.old mehr.
+    assert checkpoint.nb_steps_writing_with_previous > 0
+    assert checkpoint.nb_steps_writing > checkpoint.nb_steps_writing_with_previous
+    assert checkpoint_path(path) == path
+    assert not os.path.exists(path + '.tmp')
+    assert not os.path.exists(path + '.old')
+
+    expected = checkpoint.expected
+    restored = make_agent(fused_td_errors)
+    assert load_training_state(restored, path) == {'step': expected['step'], 'episode': expected['episode']}
+    assert (restored.step, restored.episode) == (expected['step'], expected['episode'])
+
+    memory = _memory_of(restored)
+    state = memory.get_state()
+    assert state.keys() == expected['memory'].keys()
+    for key, value in expected['memory'].items():
+        np.testing.assert_array_equal(state[key], value, err_msg=key)
+    # Prioritäten stecken in it_sum/it_min, die Observations in den Storages.
+    assert np.any(state['it_sum'] != state['it_sum'][0])
+    for name, storage, _ in memory.observation_storages():
+        for key, array in storage.arrays().items():
+            np.testing.assert_array_equal(array, expected['storages'][name][key])
+
+    # Optimizer-Zustand (Adam Iterationen und Momente) in den Variablen, die der Lernschritt tatsächlich benutzt.
+    assert_same_arrays(K.batch_get_value(_optimizer(restored).weights), expected['optimizer'])
+    assert int(expected['optimizer'][0]) > 0
+    assert_same_arrays(restored.model.get_weights(), expected['model'])
+    assert_same_arrays(restored.target_model.get_weights(), expected['target_model'])
+    np.testing.assert_array_equal(np.random.get_state()[1], expected['np_random'][1])
+
+    iterations = int(expected['optimizer'][0])
+    restored.fit(make_env(2), nb_steps=restored.step + 5, verbose=0, resume=True)
+    assert int(K.batch_get_value(_optimizer(restored).weights)[0]) == iterations + 5
+
+
+def test_checkpoint_refuses_several_envs(tmp_path):
+    agent = make_agent(fused_td_errors=False)
+    vec_env = SerialVecEnv([partial(make_env, seed) for seed in (1, 2)])
+    with pytest.raises(ValueError, match='one environment'):
+        agent.fit_vectorized(vec_env, nb_steps=10, callbacks=[TrainingCheckpoint(str(tmp_path / 'state'))],
+                             verbose=0)
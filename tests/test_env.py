@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from env import FUNCTIONS, Sc2Env2Outputs, _action_table, available_actions_mask
+from sc2DqnAgent import Sc2Action
+
+SCREEN = 5
+
+
+def make_env(available_actions):
+    # Ohne StarCraft II: nur der Teil von Sc2Env2Outputs, den action_to_sc2() braucht.
+    env = Sc2Env2Outputs.__new__(Sc2Env2Outputs)
+    env.env = None
+    env._SCREEN = SCREEN
+    env._action_table = _action_table(SCREEN)
+    env.available_actions = available_actions_mask(
+        SimpleNamespace(observation=SimpleNamespace(available_actions=np.asarray(available_actions))))
+    return env
+
+
+def reference_action(act, available_actions):
+    # Die FunctionCalls, wie action_to_sc2() sie vor der Tabelle für jeden Schritt neu gebaut hat.
+    if act.action == 1 and FUNCTIONS.Move_screen.id in available_actions:
+        return FUNCTIONS.Move_screen("now", (act.coords[1], act.coords[0]))
+    elif act.action == 2:
+        return FUNCTIONS.select_point("toggle", (act.coords[1], act.coords[0]))
+    return FUNCTIONS.no_op()
+
+
+def test_available_actions_mask():
+    available_actions = [0, 2, FUNCTIONS.Move_screen.id]
+    mask = make_env(available_actions).available_actions
+    assert mask.shape == (len(FUNCTIONS),)
+    assert np.flatnonzero(mask).tolist() == available_actions
+
+
+@pytest.mark.parametrize('can_move', [True, False])
+def test_action_table_matches_function_calls(can_move):
+    available_actions = [0, 1, 2, 3, 7] + ([FUNCTIONS.Move_screen.id] if can_move else [])
+    env = make_env(available_actions)
+
+    for action in range(3):
+        for y in range(SCREEN):
+            for x in range(SCREEN):
+                act = Sc2Action(action, y, x)
+                assert env.action_to_sc2(act) == reference_action(act, available_actions)
+
+    # Ohne Move_screen wird aus Aktion 1 ein no_op, sonst ein Move_screen an (x, y).
+    real_action = env.action_to_sc2(Sc2Action(1, 1, 3))
+    if can_move:
+        assert (real_action.function, real_action.arguments) == (FUNCTIONS.Move_screen.id, [[0], [3, 1]])
+    else:
+        assert real_action.function == FUNCTIONS.no_op.id
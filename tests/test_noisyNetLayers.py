@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+from keras import backend as K
+from keras.layers import Input
+from keras.models import Model
+
+from noisyNetLayers import NoiseControl, NoisyConv2D, NoisyDense
+
+FAN_IN = 12
+FAN_OUT = 5
+
+
+def noisy_dense(factorized):
+    layer = NoisyDense(FAN_OUT, factorized=factorized)
+    layer(Input(shape=(FAN_IN,)))
+    return layer, FAN_IN, (FAN_IN, FAN_OUT)
+
+
+def noisy_conv(factorized):
+    # 3x3 Kernel über 4 Channels: fan_in = 3 * 3 * 4
+    layer = NoisyConv2D(FAN_OUT, (3, 3), padding='same', factorized=factorized)
+    layer(Input(shape=(6, 6, 4)))
+    return layer, 3 * 3 * 4, (3, 3, 4, FAN_OUT)
+
+
+@pytest.mark.parametrize('make_layer', [noisy_dense, noisy_conv])
+def test_factorized_epsilon_shapes(make_layer):
+    layer, fan_in, kernel_shape = make_layer(True)
+
+    # Gehalten werden nur die beiden Vektoren, der Kernel-Zufall ist deren äußeres Produkt in Kernel-Form.
+    assert [K.int_shape(held) for held in layer.held_epsilon] == [(fan_in, 1), (1, FAN_OUT)]
+    assert K.int_shape(layer.kernel_epsilon) == kernel_shape
+    assert K.int_shape(layer.bias_epsilon) == (FAN_OUT,)
+
+    kernel_epsilon, bias_epsilon = K.batch_get_value([layer.kernel_epsilon, layer.bias_epsilon])
+    kernel_epsilon = kernel_epsilon.reshape(fan_in, FAN_OUT)
+    assert np.linalg.matrix_rank(kernel_epsilon) == 1
+    # Spalte j ist f(epsilon_in) * f(epsilon_out)[j], der Bias-Zufall ist f(epsilon_out).
+    input_epsilon = kernel_epsilon[:, 0] / bias_epsilon[0]
+    np.testing.assert_allclose(kernel_epsilon, np.outer(input_epsilon, bias_epsilon), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('make_layer', [noisy_dense, noisy_conv])
+def test_independent_epsilon_shapes(make_layer):
+    layer, _, kernel_shape = make_layer(False)
+
+    assert [K.int_shape(held) for held in layer.held_epsilon] == [kernel_shape, (FAN_OUT,)]
+    assert K.int_shape(layer.kernel_epsilon) == kernel_shape
+    kernel_epsilon = K.get_value(layer.kernel_epsilon).reshape(-1, FAN_OUT)
+    assert np.linalg.matrix_rank(kernel_epsilon) == FAN_OUT
+
+
+@pytest.mark.parametrize('make_layer', [noisy_dense, noisy_conv])
+@pytest.mark.parametrize('factorized', [False, True])
+def test_sigma_initialization(make_layer, factorized):
+    layer, fan_in, kernel_shape = make_layer(factorized)
+    # Werte aus dem Noisy Nets Paper: 0.5 / sqrt(fan_in) faktorisiert, sonst 0.017.
+    sigma = 0.5 / np.sqrt(fan_in) if factorized else 0.017
+
+    kernel_sigma, bias_sigma = K.batch_get_value([layer.kernel_sigma, layer.bias_sigma])
+    assert kernel_sigma.shape == kernel_shape
+    np.testing.assert_allclose(kernel_sigma, sigma, rtol=1e-6)
+    np.testing.assert_allclose(bias_sigma, np.full(FAN_OUT, sigma), rtol=1e-6)
+
+
+def noisy_model(factorized=False):
+    inputs = Input(shape=(FAN_IN,))
+    layer = NoisyDense(FAN_OUT, factorized=factorized)
+    return Model(inputs, layer(inputs)), layer
+
+
+def mean_output(layer, x):
+    # Forward-Pass nur mit den Mittelwert-Gewichten (mu), ohne sigma und Zufall.
+    kernel, bias = K.batch_get_value([layer.kernel, layer.bias])
+    return x.dot(kernel) + bias
+
+
+@pytest.mark.parametrize('factorized', [False, True])
+def test_noise_control_modes(factorized):
+    model, layer = noisy_model(factorized)
+    x = np.random.RandomState(0).randn(4, FAN_IN).astype(np.float32)
+    control = NoiseControl([model], hold_steps=3)
+    assert control.layers == [layer]
+
+    # resample (Standard): neuer Zufall bei jedem Aufruf.
+    assert not np.allclose(model.predict_on_batch(x), model.predict_on_batch(x))
+
+    # hold: gleicher Output für hold_steps Aufrufe von step(), danach neuer Zufall.
+    assert control.set_mode('hold') == 'resample'
+    held = model.predict_on_batch(x)
+    for _ in range(2):
+        control.step()
+        np.testing.assert_array_equal(model.predict_on_batch(x), held)
+    control.step()
+    next_held = model.predict_on_batch(x)
+    assert not np.allclose(next_held, held)
+    np.testing.assert_array_equal(model.predict_on_batch(x), next_held)
+
+    # resample() zieht sofort neuen Zufall, der dann wieder gehalten wird.
+    control.resample()
+    resampled = model.predict_on_batch(x)
+    assert not np.allclose(resampled, next_held)
+    np.testing.assert_array_equal(model.predict_on_batch(x), resampled)
+
+    # mean: nur die Mittelwert-Gewichte, step() und resample() ändern daran nichts.
+    assert control.set_mode('mean') == 'hold'
+    expected = mean_output(layer, x)
+    np.testing.assert_allclose(model.predict_on_batch(x), expected, rtol=1e-5, atol=1e-6)
+    control.step()
+    control.resample()
+    np.testing.assert_allclose(model.predict_on_batch(x), expected, rtol=1e-5, atol=1e-6)
+    assert not np.allclose(held, expected)
+
+    control.set_mode('resample')
+    assert not np.allclose(model.predict_on_batch(x), model.predict_on_batch(x))
+
+
+def test_noise_control_rejects_unknown_mode():
+    model, _ = noisy_model()
+    control = NoiseControl([model])
+    with pytest.raises(ValueError):
+        control.set_mode('frozen')
+    with pytest.raises(ValueError):
+        NoiseControl([model], hold_steps=0)
@@ -0,0 +1,322 @@
+import numpy as np
+import pytest
+from baselines.common.segment_tree import MinSegmentTree, SumSegmentTree
+
+from prioReplayBuffer import ArrayReplayBuffer, FrameReplayBuffer, MinTree, ObservationStorage, \
+    PrefetchingReplayBuffer, PrioritizedFrameReplayBuffer, PrioritizedReplayBuffer, SumTree
+from sc2DqnAgent import Sc2Action
+
+SCREEN = 4
+MULTI_STEP_SIZE = 3
+
+
+# Zufällige Updates (mit doppelten Indizes und Prioritäten 0) auf SumTree/MinTree und den baselines SegmentTrees, die
+# Bäume müssen danach in allen Abfragen übereinstimmen.
+@pytest.mark.parametrize('capacity', [1, 2, 16, 64])
+def test_segment_trees_match_baselines(capacity):
+    random = np.random.RandomState(capacity)
+    sum_tree, min_tree = SumTree(capacity), MinTree(capacity)
+    reference_sum, reference_min = SumSegmentTree(capacity), MinSegmentTree(capacity)
+
+    for _ in range(50):
+        idxes = random.randint(0, capacity, random.randint(1, 2 * capacity + 1))
+        values = random.uniform(0, 2, len(idxes)) * (random.random_sample(len(idxes)) > .2)
+        sum_tree[idxes] = values
+        min_tree[idxes] = values
+        # baselines setzt nacheinander, bei doppelten Indizes gilt der letzte Wert wie bei numpy
+        for idx, value in zip(idxes, values):
+            reference_sum[idx] = value
+            reference_min[idx] = value
+
+        np.testing.assert_allclose(sum_tree._value[1:], reference_sum._value[1:], rtol=1e-12, atol=1e-12)
+        np.testing.assert_array_equal(min_tree._value[1:], reference_min._value[1:])
+        np.testing.assert_array_equal(sum_tree[np.arange(capacity)], [reference_sum[i] for i in range(capacity)])
+        start = random.randint(0, capacity)
+        end = random.randint(start + 1, capacity + 1)
+        assert sum_tree.sum(start, end) == pytest.approx(reference_sum.sum(start, end), abs=1e-12)
+        assert min_tree.min(start, end) == reference_min.min(start, end)
+        assert sum_tree.sum() == pytest.approx(reference_sum.sum(), abs=1e-12)
+        assert min_tree.min() == reference_min.min()
+
+        if sum_tree.sum() > 0:
+            prefixsums = random.uniform(0, sum_tree.sum(), 32)
+            found = sum_tree.find_prefixsum_idx(prefixsums)
+            np.testing.assert_array_equal(found, [reference_sum.find_prefixsum_idx(p) for p in prefixsums])
+            # Blätter mit Priorität 0 werden nie gefunden.
+            assert np.all(sum_tree[found] > 0)
+
+
+def test_find_prefixsum_idx_skips_zero_leaves():
+    tree = SumTree(16)
+    priorities = np.zeros(16)
+    priorities[[1, 2, 6, 7, 11]] = [.5, 1., .25, 2., .75]
+    tree[np.arange(16)] = priorities
+    bounds = np.cumsum(priorities)
+
+    # Genau auf den Grenzen zwischen zwei Blättern, knapp davor und knapp danach.
+    mass = np.concatenate([bounds[:-1], np.nextafter(bounds, 0), np.nextafter(bounds[:-1], np.inf), [0.]])
+    mass = mass[mass < tree.sum()]
+    found = tree.find_prefixsum_idx(mass)
+    assert set(found) <= {1, 2, 6, 7, 11}
+    np.testing.assert_array_equal(found, np.searchsorted(bounds, mass, side='right'))
+
+
+def test_sample_proportional_clamps_mass_below_p_total():
+    # Nur 5 von 8 Blättern belegt, dahinter Priorität 0.
+    memory = PrioritizedReplayBuffer(5, 1.)
+    for priority in [.1, .2, .3, .7, 1e-5]:
+        memory.add(None, None, 0., None, False, priority=priority)
+    p_total = memory._it_sum.sum()
+    batch_size = 7
+    # Mit dem größten Zufallswert liegt die Masse des letzten Teilintervalls durch Rundung nicht mehr unter p_total.
+    assert (np.nextafter(1., 0) + batch_size - 1) * (p_total / batch_size) >= p_total
+    # Ohne Begrenzung würde die Masse p_total auf einem leeren Blatt landen.
+    assert memory._it_sum[memory._it_sum.find_prefixsum_idx(p_total)] == 0
+
+    original_random = np.random.random
+    try:
+        # Größtmöglicher Zufallswert in jedem Teilintervall.
+        np.random.random = lambda size: np.full(size, np.nextafter(1., 0))
+        idxes = memory._sample_proportional(batch_size)
+    finally:
+        np.random.random = original_random
+    assert np.all(idxes < 5)
+    assert idxes[-1] == 4
+
+    np.random.seed(0)
+    idxes = memory._sample_proportional(100000)
+    assert np.all(idxes < 5)
+    counts = np.bincount(idxes, minlength=5) / 100000.
+    np.testing.assert_allclose(counts, memory._it_sum[np.arange(5)] / p_total, atol=1e-3)
+
+
+# Environment, dessen Observations nur einen Zähler enthalten. Jeder Schritt liefert ein neues Array, wie
+# Sc2Env2Outputs; der Reward ist der Zähler von obs_t, so lässt sich jede gezogene Transition zuordnen.
+def counter_transitions(nb_steps, episode_lengths, multi_step_size=MULTI_STEP_SIZE):
+    # n-Step Transitionen wie Sc2DqnAgent_v4.backward(): obs_0 ist dasselbe Objekt, das n Schritte vorher als
+    # observation_1 übergeben wurde; am Episodenende wird der RingBuffer ohne weitere Transitionen geleert.
+    counter = 0
+    step = 0
+    episode = 0
+    while True:
+        observation = np.full((2, SCREEN, SCREEN), counter, dtype=np.int32)
+        recent = []
+        for t in range(episode_lengths[episode % len(episode_lengths)]):
+            if step == nb_steps:
+                return
+            counter += 1
+            recent.append(observation)
+            observation_1 = np.full((2, SCREEN, SCREEN), counter, dtype=np.int32)
+            done = t == episode_lengths[episode % len(episode_lengths)] - 1
+            if len(recent) == multi_step_size:
+                obs_0 = recent.pop(0)
+                yield obs_0, Sc2Action(counter % 3, counter % SCREEN, counter // 2 % SCREEN), \
+                    float(obs_0[0, 0, 0]), observation_1, done
+                step += 1
+            observation = observation_1
+        episode += 1
+
+
+def fill(memories, nb_steps, episode_lengths=(7, 2, 11, 5)):
+    for transition in counter_transitions(nb_steps, episode_lengths):
+        for memory in memories:
+            memory.add(*transition)
+
+
+def stored_transitions(memory, idxes):
+    obs_t, actions, rewards, obs_tp1, dones = memory._encode_sample(idxes)
+    return {reward: (o_t, (a.action, tuple(a.coords)), o_tp1, d)
+            for o_t, a, reward, o_tp1, d in zip(obs_t, actions, rewards, obs_tp1, dones)}
+
+
+# frame_size None: bei den kurzen Episoden hier reicht der Frame-Ring nicht für alle 16 Transitionen, die ältesten
+# fallen heraus; die übrigen müssen trotzdem den neuesten des ArrayReplayBuffer entsprechen.
+@pytest.mark.parametrize('frame_size', [None, 40])
+@pytest.mark.parametrize('nb_steps', [10, 16, 100])
+def test_frame_buffer_matches_array_buffer(nb_steps, frame_size):
+    np.random.seed(0)
+    array_memory = ArrayReplayBuffer(16)
+    frame_memory = FrameReplayBuffer(16, multi_step_size=MULTI_STEP_SIZE, frame_size=frame_size)
+    fill([array_memory, frame_memory], nb_steps)
+
+    assert len(array_memory) == min(nb_steps, 16)
+    if frame_size is not None:
+        assert len(frame_memory) == len(array_memory)
+    assert 0 < len(frame_memory) <= len(array_memory)
+    newest = (array_memory._next_idx - len(frame_memory) + np.arange(len(frame_memory))) % 16
+    reference = stored_transitions(array_memory, newest)
+    assert len(reference) == len(frame_memory)
+    # Bei 100 Schritten sind Transitions- und Frame-Ring mehrfach übergelaufen.
+    assert nb_steps < 100 or frame_memory._next_frame > 2 * frame_memory._frame_maxsize
+
+    batch = frame_memory.sample(256)
+    assert set(batch[2]) == set(reference)
+    for reward, (o_t, action, o_tp1, done) in stored_transitions(frame_memory, np.asarray(
+            (frame_memory._oldest_idx + np.arange(len(frame_memory))) % 16)).items():
+        ref_o_t, ref_action, ref_o_tp1, ref_done = reference[reward]
+        np.testing.assert_array_equal(o_t, ref_o_t)
+        np.testing.assert_array_equal(o_tp1, ref_o_tp1)
+        assert action == ref_action
+        assert done == ref_done
+    for o_t, reward, o_tp1, done in zip(batch[0], batch[2], batch[3], batch[4]):
+        np.testing.assert_array_equal(o_t, reference[reward][0])
+        np.testing.assert_array_equal(o_tp1, reference[reward][2])
+        assert done == reference[reward][3]
+
+    # Endzustände: obs_tp1 ist der letzte Frame der Episode, nicht der erste der nächsten.
+    assert any(done for _, _, _, done in reference.values())
+    for reward, (o_t, _, o_tp1, done) in reference.items():
+        if not done:
+            assert o_tp1[0, 0, 0] == reward + MULTI_STEP_SIZE
+        else:
+            assert reward < o_tp1[0, 0, 0] <= reward + MULTI_STEP_SIZE
+
+
+def test_prioritized_frame_buffer_invalidates_overwritten_transitions():
+    np.random.seed(1)
+    # Frame-Ring kleiner als der Transitions-Ring: alte Transitionen fallen heraus, bevor der Transitions-Ring voll ist.
+    memory = PrioritizedFrameReplayBuffer(32, .6, multi_step_size=MULTI_STEP_SIZE, frame_size=20)
+    array_memory = ArrayReplayBuffer(32)
+    fill([memory, array_memory], 60)
+
+    assert 0 < len(memory) < len(array_memory)
+    valid = (memory._oldest_idx + np.arange(len(memory))) % 32
+    invalid = np.setdiff1d(np.arange(32), valid)
+    np.testing.assert_array_equal(memory._it_sum[invalid], 0.)
+    assert np.all(memory._it_min[invalid] == float('inf'))
+    assert np.all(memory._it_sum[valid] > 0)
+
+    batch = memory.sample(512, .4)
+    assert set(batch[-1]) <= set(valid)
+    reference = stored_transitions(array_memory, np.arange(len(array_memory)))
+    for o_t, reward, o_tp1 in zip(batch[0], batch[2], batch[3]):
+        np.testing.assert_array_equal(o_t, reference[reward][0])
+        np.testing.assert_array_equal(o_tp1, reference[reward][2])
+
+
+# Observations wie Sc2Env2Outputs: player_relative (0-4) und selected (0/1). Jede Kombination der beiden Werte kommt
+# vor; bei screen 3, 7 und 13 ist die Anzahl Pixel pro Ebene kein Vielfaches von 8 (letztes Byte nur teilweise belegt).
+def screen_observations(random, nb_obs, screen, dtype=np.int32):
+    obs = np.stack([random.randint(0, 5, (nb_obs, screen, screen)),
+                    random.randint(0, 2, (nb_obs, screen, screen))], axis=1).astype(dtype)
+    combinations = np.array([(p, s) for p in range(5) for s in range(2)])
+    flat = obs.reshape(nb_obs, 2, -1)
+    for i in range(nb_obs):
+        # Die ersten Pixel jeder Observation belegen alle Kombinationen (soweit Platz ist).
+        n = min(len(combinations), flat.shape[-1])
+        flat[i, :, :n] = combinations[(i + np.arange(n)) % len(combinations)].T
+    return obs
+
+
+@pytest.mark.parametrize('screen', [3, 7, 13, 16, 32])
+@pytest.mark.parametrize('encoding', [{'bit_planes': {0: 3, 1: 1}},
+                                      {'obs_dtype': np.uint8, 'bit_planes': (1,)},
+                                      {'obs_dtype': np.uint8}])
+def test_observation_storage_round_trip(screen, encoding):
+    random = np.random.RandomState(screen)
+    observations = screen_observations(random, 12, screen)
+    assert {0, 1, 2, 3, 4} <= set(np.unique(observations[:, 0]))
+
+    storage = ObservationStorage(16, observations[0], **encoding)
+    assert storage.compact
+    for i, obs in enumerate(observations):
+        storage[i] = obs
+    decoded = storage[np.arange(len(observations))]
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded, observations)
+    # Ungeordnete und doppelte Indizes wie beim Ziehen eines Batches.
+    idxes = np.array([11, 0, 5, 5, 3])
+    np.testing.assert_array_equal(storage[idxes], observations[idxes])
+    if encoding.get('bit_planes') == {0: 3, 1: 1}:
+        assert storage.nbytes == 16 * 4 * ((screen * screen + 7) // 8)
+
+
+@pytest.mark.parametrize('screen', [7, 16, 32])
+def test_compact_replay_buffer_samples_original_observations(screen, tmp_path):
+    random = np.random.RandomState(0)
+    # Liste statt Array: der FrameReplayBuffer erkennt wiederholte Observations an der Identität.
+    observations = list(screen_observations(random, 20, screen))
+    plain = ArrayReplayBuffer(8)
+    compact = ArrayReplayBuffer(8, bit_planes={0: 3, 1: 1})
+    on_disk = FrameReplayBuffer(8, bit_planes={0: 3, 1: 1}, obs_path=str(tmp_path / 'replay'))
+    for t in range(len(observations) - 1):
+        for memory in (plain, compact, on_disk):
+            memory.add(observations[t], Sc2Action(0, 0, 0), float(t), observations[t + 1], False)
+
+    idxes = np.arange(8)
+    expected = plain._encode_sample(idxes)
+    for memory in (compact, on_disk):
+        batch = memory._encode_sample(idxes)
+        np.testing.assert_array_equal(batch[0], expected[0])
+        np.testing.assert_array_equal(batch[3], expected[3])
+        np.testing.assert_array_equal(batch[2], expected[2])
+
+
+def add_transitions(memories, start, nb_transitions):
+    for counter in range(start, start + nb_transitions):
+        for memory in memories:
+            memory.add(np.full((2, 2), counter), Sc2Action(0, 0, 0), float(counter), np.full((2, 2), counter + 1),
+                       False)
+
+
+def assert_same_priorities(memory, reference):
+    capacity = reference._it_sum._capacity
+    np.testing.assert_array_equal([memory._it_sum[i] for i in range(capacity)],
+                                  [reference._it_sum[i] for i in range(capacity)])
+    np.testing.assert_array_equal([memory._it_min[i] for i in range(capacity)],
+                                  [reference._it_min[i] for i in range(capacity)])
+    assert memory._max_priority == reference._max_priority
+
+
+# PrefetchingReplayBuffer.update_priorities() muss dieselben Prioritäten setzen wie update_priorities() direkt auf dem
+# Memory, nur ohne die Transitionen, die seit dem Ziehen des Batches überschrieben wurden.
+@pytest.mark.parametrize('nb_new', [0, 3, 16, 20])
+def test_prefetching_update_priorities_skips_overwritten(nb_new):
+    size, batch_size = 16, 8
+    random = np.random.RandomState(nb_new)
+    reference = PrioritizedReplayBuffer(size, .6)
+    prefetching = PrefetchingReplayBuffer(PrioritizedReplayBuffer(size, .6), batch_size, queue_size=1)
+    try:
+        add_transitions([reference, prefetching], 0, 21)
+        assert_same_priorities(prefetching._memory, reference)
+
+        batch = prefetching.sample(batch_size, .4)
+        idxes = batch[6]
+        next_idx = reference._next_idx
+        # Beim Ziehen gespeicherte Transitionen stimmen noch mit dem Batch überein.
+        np.testing.assert_array_equal(batch[2], [reference._storage[idx][2] for idx in idxes])
+
+        add_transitions([reference, prefetching], 21, nb_new)
+        priorities = random.uniform(.1, 3., batch_size)
+        prefetching.update_priorities(idxes, priorities)
+
+        overwritten = {(next_idx + k) % size for k in range(nb_new)}
+        keep = np.array([idx not in overwritten for idx in idxes], dtype=bool)
+        if np.any(keep):
+            reference.update_priorities(idxes[keep], priorities[keep])
+        assert_same_priorities(prefetching._memory, reference)
+    finally:
+        prefetching.close()
+
+
+def test_prefetching_update_priorities_matches_batch_by_identity():
+    prefetching = PrefetchingReplayBuffer(PrioritizedReplayBuffer(16, .6), 4, queue_size=1)
+    try:
+        add_transitions([prefetching], 0, 16)
+        prefetching.sample(4, .4)
+        second = prefetching.sample(4, .4)
+
+        # Gleiche Werte reichen nicht, es muss das idxes Array des Batches sein.
+        with pytest.raises(AssertionError):
+            prefetching.update_priorities(np.array(second[6]), np.ones(4))
+        second = prefetching.sample(4, .4)
+        third = prefetching.sample(4, .4)
+
+        # Ein Update für einen späteren Batch verwirft die älteren ohne Update.
+        prefetching.update_priorities(third[6], np.full(4, 2.))
+        assert not prefetching._pending
+        with pytest.raises(AssertionError):
+            prefetching.update_priorities(second[6], np.ones(4))
+        assert prefetching._memory._max_priority == 2.
+    finally:
+        prefetching.close()
@@ -0,0 +1,460 @@
+import numpy as np
+import pytest
+from keras.layers import Activation, Conv2D, Dense, Flatten, Input, Permute, Reshape
+from keras.models import Model
+from keras.optimizers import Adam
+
+from fakeEnv import FakeSc2Env2Outputs
+from sc2DqnAgent import Sc2Action, Sc2DqnAgent_v4, Sc2DqnAgent_v5, categorical_projection
+from sc2Policy import Sc2Policy
+from sc2Processor import Sc2Processor
+
+BATCH_SIZE = 8
+NB_ACTIONS = 3
+SCREEN = 4
+GAMMA = .99
+MULTI_STEP_SIZE = 3
+
+
+# Netzwerke, Memory und Policy mit festen Werten statt Keras-Modellen: train_step() wird nur auf die numpy-Seite
+# (Targets, Masken, Prioritäten) getestet.
+class FakeModel(object):
+    input = None
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def predict_on_batch(self, batch):
+        return self.outputs
+
+
+class FakeTrainableModel(FakeModel):
+    def train_on_batch(self, ins, targets):
+        self.ins = ins
+        self.targets = targets
+        return [0., 0., 0., 0.]
+
+
+class FakeMemory(object):
+    def __init__(self, experiences):
+        self.experiences = experiences
+        self.priorities = None
+
+    def sample(self, batch_size, beta=None):
+        return self.experiences
+
+    def update_priorities(self, idxes, priorities):
+        self.priorities = np.asarray(priorities)
+
+
+class FakePolicy(object):
+    metrics = []
+    metrics_names = []
+
+    def _set_agent(self, agent):
+        pass
+
+
+class FakeSchedule(object):
+    def value(self, t):
+        return .5
+
+
+def q_values(random):
+    return [random.randn(BATCH_SIZE, NB_ACTIONS), random.randn(BATCH_SIZE, SCREEN, SCREEN, 1)]
+
+
+def make_batch(random, prio_replay):
+    states = random.randint(0, 5, (BATCH_SIZE, 2, SCREEN, SCREEN)).astype(np.float32)
+    actions = [Sc2Action(random.randint(NB_ACTIONS), random.randint(SCREEN), random.randint(SCREEN))
+               for _ in range(BATCH_SIZE)]
+    rewards = random.randn(BATCH_SIZE)
+    dones = random.random_sample(BATCH_SIZE) < .3
+    experiences = [states, actions, rewards, states[::-1], dones]
+    if prio_replay:
+        experiences += [random.uniform(.1, 1., BATCH_SIZE), np.arange(BATCH_SIZE)]
+    return experiences
+
+
+def make_agent(experiences, q2, target_q2, pred, double_dqn, prio_replay, bad_prio_replay):
+    agent = Sc2DqnAgent_v4.__new__(Sc2DqnAgent_v4)
+    agent.memory = FakeMemory(experiences)
+    agent.model = FakeModel(q2)
+    agent.target_model = FakeModel(target_q2)
+    agent.trainable_model = FakeTrainableModel([np.zeros(BATCH_SIZE)] + pred)
+    agent.policy = FakePolicy()
+    agent.processor = None
+    agent.beta_schedule = FakeSchedule()
+    agent.step = 0
+    agent.batch_size = BATCH_SIZE
+    agent.nb_actions = NB_ACTIONS
+    agent.screen_size = SCREEN
+    agent.gamma = GAMMA
+    agent.multi_step_size = MULTI_STEP_SIZE
+    agent.enable_double_dqn = double_dqn
+    agent.prio_replay = prio_replay
+    agent.bad_prio_replay = bad_prio_replay
+    agent.fused_targets = False
+    agent.fused_td_errors = False
+    agent.sparse_targets = False
+    return agent
+
+
+# Die frühere Schleifen-Version aus Sc2DqnAgent_v4.backward(), nur ohne Netzwerke (q2, target_q2 und pred fest).
+def reference_train_step(experiences, q2, target_q2, pred, double_dqn, prio_replay, bad_prio_replay):
+    action_batch = experiences[1]
+    reward_batch = np.array(experiences[2])
+    terminal2_batch = np.array([0. if done else 1. for done in experiences[4]])
+    prio_weights_batch = np.array(experiences[5]) if prio_replay else np.ones(reward_batch.shape)
+
+    if double_dqn:
+        actions_a = np.argmax(q2[0], -1)
+        actions_b = np.array([np.unravel_index(ac_b.argmax(), ac_b.shape)[0:2] for ac_b in q2[1]])
+        q_batch_a = target_q2[0][range(BATCH_SIZE), actions_a]
+        q_batch_b = np.array([square_q[:, :, 0][actions_b[i][0], actions_b[i][1]]
+                              for (i, square_q) in enumerate(target_q2[1])])
+    else:
+        q_batch_a = np.max(target_q2[0], axis=-1)
+        q_batch_b = np.max(target_q2[1], axis=(1, 2))[:, 0]
+
+    targets_a = np.zeros((BATCH_SIZE, NB_ACTIONS,))
+    targets_b = np.zeros((BATCH_SIZE, SCREEN, SCREEN, 1))
+    masks_a = np.zeros((BATCH_SIZE, NB_ACTIONS,))
+    masks_b = np.zeros((BATCH_SIZE, SCREEN, SCREEN, 1))
+
+    Rs_a = reward_batch + (GAMMA ** MULTI_STEP_SIZE) * q_batch_a * terminal2_batch
+    Rs_b = reward_batch + (GAMMA ** MULTI_STEP_SIZE) * q_batch_b * terminal2_batch
+
+    for target_a, target_b, mask_a, mask_b, R_a, R_b, action, prio_weight in \
+            zip(targets_a, targets_b, masks_a, masks_b, Rs_a, Rs_b, action_batch, prio_weights_batch):
+        target_a[action.action] = R_a
+        target_b[action.coords] = R_b
+        if bad_prio_replay:
+            mask_a[action.action] = 1
+            mask_b[action.coords] = 1
+        else:
+            mask_a[action.action] = prio_weight
+            mask_b[action.coords] = prio_weight
+
+    prios = None
+    if prio_replay:
+        prios = []
+        if bad_prio_replay:
+            # target_a, mask_a, ... sind hier noch die Werte des letzten Samples aus der Schleife oben.
+            for pre in zip(pred[0], pred[1]):
+                loss = [(target_a - pre[0]) * mask_a, (target_b - pre[1]) * mask_b]
+                prios.append(np.abs(np.sum(loss[0]) + np.sum(loss[1])))
+        else:
+            for pre_a, pre_b, target_a, target_b, mask_a, mask_b, prio_weight \
+                    in zip(pred[0], pred[1], targets_a, targets_b, masks_a, masks_b, prio_weights_batch):
+                loss = [(pre_a - target_a) * (mask_a / prio_weight), (pre_b - target_b) * (mask_b / prio_weight)]
+                prios.append(np.abs(np.sum(loss[0]) + np.sum(loss[1])))
+        prios = np.array(prios)
+
+    return [targets_a, targets_b, masks_a, masks_b], prios
+
+
+@pytest.mark.parametrize('double_dqn', [False, True])
+@pytest.mark.parametrize('prio_replay, bad_prio_replay', [(False, False), (True, True), (True, False)])
+def test_train_step_matches_loop(double_dqn, prio_replay, bad_prio_replay):
+    random = np.random.RandomState(3)
+    experiences = make_batch(random, prio_replay)
+    q2, target_q2, pred = q_values(random), q_values(random), q_values(random)
+
+    agent = make_agent(experiences, q2, target_q2, pred, double_dqn, prio_replay, bad_prio_replay)
+    agent.train_step()
+    expected, expected_prios = reference_train_step(experiences, q2, target_q2, pred, double_dqn, prio_replay,
+                                                    bad_prio_replay)
+
+    ins = agent.trainable_model.ins
+    np.testing.assert_array_equal(ins[0], experiences[0])
+    for actual, reference in zip(ins[1:], expected):
+        np.testing.assert_allclose(actual, reference, rtol=1e-6)
+    np.testing.assert_allclose(agent.trainable_model.targets[1], expected[0], rtol=1e-6)
+    np.testing.assert_allclose(agent.trainable_model.targets[2], expected[1], rtol=1e-6)
+
+    if prio_replay:
+        np.testing.assert_allclose(agent.memory.priorities, expected_prios, rtol=1e-5)
+    else:
+        assert agent.memory.priorities is None
+
+
+# Kleines FullyConv-Netzwerk wie in fully_conf_v_10 (ohne Noisy-Layers, damit zwei Agents mit gleichen Gewichten
+# auch gleich rechnen), für die Tests der im Graph berechneten Varianten gegen train_on_batch()/predict_on_batch().
+def keras_agent(experiences, double_dqn=True, prio_replay=True, bad_prio_replay=True, weights=None, **flags):
+    main_input = Input(shape=(2, SCREEN, SCREEN), name='main_input')
+    x = Permute((2, 3, 1))(main_input)
+    x = Conv2D(4, (3, 3), padding='same', activation='relu')(x)
+    branch = Conv2D(4, (3, 3), padding='same', activation='relu')(x)
+    coord_out = Conv2D(1, (1, 1), padding='same', activation='linear')(branch)
+    act_out = Flatten()(branch)
+    act_out = Dense(8, activation='relu')(act_out)
+    act_out = Dense(NB_ACTIONS, activation='linear')(act_out)
+    model = Model(main_input, [act_out, coord_out])
+
+    agent = Sc2DqnAgent_v4(model=model, nb_actions=NB_ACTIONS, screen_size=SCREEN, memory=FakeMemory(experiences),
+                           enable_double_dqn=double_dqn, noisy_nets=False, prio_replay=prio_replay,
+                           bad_prio_replay=bad_prio_replay, multi_step_size=MULTI_STEP_SIZE, policy=FakePolicy(),
+                           gamma=GAMMA, batch_size=BATCH_SIZE, nb_steps_warmup=0, target_model_update=10000,
+                           delta_clip=1., **flags)
+    agent.compile(Adam(lr=.01))
+    agent.training = True
+    if weights is None:
+        # Feste Gewichte statt der zufälligen Initialisierung, damit die Tests nicht vom Zufall abhängen. Das
+        # Target-Netzwerk bekommt andere Gewichte als das Online-Netzwerk, damit Verwechslungen auffallen.
+        random = np.random.RandomState(4)
+        agent.model.set_weights([random.normal(0, .3, w.shape) for w in agent.model.get_weights()])
+        agent.target_model.set_weights([w + random.normal(0, .3, w.shape) for w in agent.model.get_weights()])
+    else:
+        agent.model.set_weights(weights[0])
+        agent.target_model.set_weights(weights[1])
+    return agent
+
+
+def agent_weights(agent):
+    return agent.model.get_weights(), agent.target_model.get_weights()
+
+
+def assert_weights_close(weights, reference):
+    for w, ref in zip(weights, reference):
+        np.testing.assert_allclose(w, ref, rtol=1e-4, atol=1e-6)
+
+
+def make_keras_batch(random, prio_replay):
+    # Rewards in der Größenordnung der Q-Werte, sonst liegen alle Fehler im linearen Teil des Huber-Loss.
+    experiences = make_batch(random, prio_replay)
+    experiences[2] = random.uniform(-.5, .5, BATCH_SIZE)
+    return experiences
+
+
+@pytest.mark.parametrize('sparse_targets', [False, True])
+@pytest.mark.parametrize('bad_prio_replay', [False, True])
+def test_fused_td_errors_match_train_on_batch(bad_prio_replay, sparse_targets):
+    experiences = make_keras_batch(np.random.RandomState(5), prio_replay=True)
+    reference = keras_agent(experiences, bad_prio_replay=bad_prio_replay, sparse_targets=sparse_targets)
+    fused = keras_agent(experiences, bad_prio_replay=bad_prio_replay, sparse_targets=sparse_targets,
+                        fused_td_errors=True, weights=agent_weights(reference))
+
+    state0, state2 = experiences[0], experiences[3]
+    q2, target_q2 = fused.model.predict_on_batch(state2), fused.target_model.predict_on_batch(state2)
+    pred_before = fused.model.predict_on_batch(state0)
+
+    metrics = reference.train_step()
+    fused_metrics = fused.train_step()
+
+    # Gleicher Lernschritt und gleiche Metriken wie mit train_on_batch().
+    assert_weights_close(fused.model.get_weights(), reference.model.get_weights())
+    np.testing.assert_allclose(fused_metrics, metrics, rtol=1e-5)
+    assert fused_metrics[0] > 0
+
+    # Prioritäten: TD-Fehler jedes Samples vor dem Update (auch mit bad_prio_replay).
+    _, expected_prios = reference_train_step(experiences, q2, target_q2, list(pred_before), True, True, False)
+    np.testing.assert_allclose(fused.memory.priorities, expected_prios, rtol=1e-4, atol=1e-6)
+    # Ohne fused_td_errors nach dem Update, wie bisher.
+    pred_after = reference.model.predict_on_batch(state0)
+    _, expected_prios = reference_train_step(experiences, q2, target_q2, list(pred_after), True, True,
+                                             bad_prio_replay)
+    np.testing.assert_allclose(reference.memory.priorities, expected_prios, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('prio_replay, bad_prio_replay', [(False, False), (True, True), (True, False)])
+def test_sparse_targets_match_dense(prio_replay, bad_prio_replay):
+    experiences = make_keras_batch(np.random.RandomState(9), prio_replay=prio_replay)
+    dense = keras_agent(experiences, prio_replay=prio_replay, bad_prio_replay=bad_prio_replay)
+    sparse = keras_agent(experiences, prio_replay=prio_replay, bad_prio_replay=bad_prio_replay, sparse_targets=True,
+                         weights=agent_weights(dense))
+
+    metrics = dense.train_step()
+    sparse_metrics = sparse.train_step()
+
+    # Gleicher Lernschritt, gleiche Metriken und gleiche Prioritäten wie mit dichten Targets und Masken.
+    assert_weights_close(sparse.model.get_weights(), dense.model.get_weights())
+    np.testing.assert_allclose(sparse_metrics, metrics, rtol=1e-5, atol=1e-7)
+    assert sparse_metrics[0] > 0
+    if prio_replay:
+        np.testing.assert_allclose(sparse.memory.priorities, dense.memory.priorities, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('double_dqn', [False, True])
+def test_fused_targets_match_predict_on_batch(double_dqn):
+    random = np.random.RandomState(6)
+    experiences = make_keras_batch(random, prio_replay=True)
+    reference = keras_agent(experiences, double_dqn=double_dqn, bad_prio_replay=False)
+    fused = keras_agent(experiences, double_dqn=double_dqn, bad_prio_replay=False, fused_targets=True,
+                        weights=agent_weights(reference))
+
+    state2, rewards = experiences[3], experiences[2]
+    terminal2 = 1. - experiences[4]
+    q2, target_q2 = reference.model.predict_on_batch(state2), reference.target_model.predict_on_batch(state2)
+    if double_dqn:
+        q_a = target_q2[0][np.arange(BATCH_SIZE), np.argmax(q2[0], -1)]
+        q_b = target_q2[1].reshape(BATCH_SIZE, -1)[np.arange(BATCH_SIZE),
+                                                   np.argmax(q2[1].reshape(BATCH_SIZE, -1), -1)]
+        # Online- und Target-Netzwerk wählen verschiedene Aktionen, sonst wäre Double DQN hier nicht geprüft.
+        assert np.any(np.argmax(q2[0], -1) != np.argmax(target_q2[0], -1))
+    else:
+        q_a = target_q2[0].max(axis=-1)
+        q_b = target_q2[1].reshape(BATCH_SIZE, -1).max(axis=-1)
+    discount = GAMMA ** MULTI_STEP_SIZE
+
+    Rs_a, Rs_b = fused.target_function([state2, rewards, terminal2])
+    np.testing.assert_allclose(Rs_a, rewards + discount * q_a * terminal2, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(Rs_b, rewards + discount * q_b * terminal2, rtol=1e-5, atol=1e-6)
+
+    # Ganzer Lernschritt: gleiche Gewichte und Prioritäten.
+    reference.train_step()
+    fused.train_step()
+    assert_weights_close(fused.model.get_weights(), reference.model.get_weights())
+    np.testing.assert_allclose(fused.memory.priorities, reference.memory.priorities, rtol=1e-4, atol=1e-6)
+
+
+def test_fast_act_matches_predict_on_batch():
+    random = np.random.RandomState(7)
+    observations = random.randint(0, 5, (16, 2, SCREEN, SCREEN))
+    agents = [keras_agent(None, processor=Sc2Processor(screen=SCREEN))]
+    agents.append(keras_agent(None, processor=Sc2Processor(screen=SCREEN), fast_act=True,
+                              weights=agent_weights(agents[0])))
+
+    # Greedy-Aktion und Koordinate (y, x) aus den Q-Werten von predict_on_batch().
+    q_values = agents[0].model.predict_on_batch(observations.astype(np.float32))
+    expected_actions = np.argmax(q_values[0], axis=-1)
+    expected_coords = [np.unravel_index(q.argmax(), q.shape)[:2] for q in q_values[1]]
+    # Verschiedene Argmaxe, sonst fiele eine vertauschte Achse nicht auf.
+    assert len(set(expected_actions)) > 1 and len(set(expected_coords)) > 1
+
+    for agent in agents:
+        # Epsilon 0: die Policy gibt die greedy Aktion zurück.
+        agent.policy = Sc2Policy(FakeSc2Env2Outputs(screen=SCREEN), nb_actions=NB_ACTIONS, eps=0.)
+        agent.reset_env_states(len(observations))
+        for observation, action, coords in zip(observations, expected_actions, expected_coords):
+            selected = agent.forward(observation)
+            assert (selected.action, tuple(selected.coords)) == (action, coords)
+
+        selected = agent.forward_batch(observations)
+        assert [(a.action, tuple(a.coords)) for a in selected] == list(zip(expected_actions, expected_coords))
+
+
+# Projektion Atom für Atom und Sample für Sample (C51, Algorithmus 1 in Bellemare et al., 2017).
+def reference_projection(rewards, not_terminals, p_next, z, discount):
+    batch_size, nb_heads, nb_atoms = p_next.shape
+    m = np.zeros(p_next.shape)
+    for i in range(batch_size):
+        for h in range(nb_heads):
+            for j in range(nb_atoms):
+                tz = min(max(rewards[i] + discount * not_terminals[i] * z[j], z[0]), z[-1])
+                # Durch Rundung kann b für tz = z[-1] knapp über nb_atoms - 1 liegen, ceil(b) wäre dann kein Atom mehr.
+                b = min((tz - z[0]) / (z[1] - z[0]), nb_atoms - 1)
+                l, u = int(np.floor(b)), int(np.ceil(b))
+                if l == u:
+                    m[i, h, l] += p_next[i, h, j]
+                else:
+                    m[i, h, l] += p_next[i, h, j] * (u - b)
+                    m[i, h, u] += p_next[i, h, j] * (b - l)
+    return m
+
+
+def distributions(random, batch_size, nb_atoms):
+    return random.dirichlet(np.ones(nb_atoms), (batch_size, 2))
+
+
+def test_categorical_projection_matches_loop():
+    random = np.random.RandomState(0)
+    z = np.linspace(-10, 10, 51)
+    rewards = random.uniform(-15, 15, 16)
+    not_terminals = (random.random_sample(16) > .25).astype(np.float64)
+    p_next = distributions(random, 16, len(z))
+
+    m = categorical_projection(rewards, not_terminals, p_next, z, .99 ** 3)
+    np.testing.assert_allclose(m, reference_projection(rewards, not_terminals, p_next, z, .99 ** 3), atol=1e-12)
+    np.testing.assert_allclose(m.sum(axis=-1), 1.)
+
+
+def test_categorical_projection_terminal_and_exact_atoms():
+    # Abstand der Atome 1, ganzzahlige Rewards und discount 1: jedes Tz liegt genau auf einem Atom (l == u).
+    random = np.random.RandomState(1)
+    z = np.linspace(0, 10, 11)
+    rewards = np.array([0., 3., -2., 4., 7.])
+    not_terminals = np.array([1., 1., 1., 0., 0.])
+    p_next = distributions(random, 5, len(z))
+
+    m = categorical_projection(rewards, not_terminals, p_next, z, 1.)
+    np.testing.assert_allclose(m, reference_projection(rewards, not_terminals, p_next, z, 1.), atol=1e-12)
+    # Reward 0, kein Endzustand: Verteilung bleibt unverändert.
+    np.testing.assert_allclose(m[0], p_next[0])
+    # Endzustände: die ganze Masse auf dem Atom des Rewards.
+    np.testing.assert_allclose(m[3], np.eye(len(z))[[4, 4]])
+    np.testing.assert_allclose(m[4], np.eye(len(z))[[7, 7]])
+
+
+def test_categorical_projection_clips_to_v_min_v_max():
+    # Bei linspace(-1, 1, 11) ist (v_max - v_min) / delta_z durch Rundung größer als nb_atoms - 1; eine Projektion
+    # ohne Begrenzung von b würde für Tz = v_max ein Atom hinter dem letzten treffen.
+    z = np.linspace(-1, 1, 11)
+    assert np.ceil((z[-1] - z[0]) / (z[1] - z[0])) > len(z) - 1
+
+    random = np.random.RandomState(2)
+    rewards = np.array([5., -5., 5., -5., .95])
+    not_terminals = np.array([1., 1., 0., 0., 1.])
+    p_next = distributions(random, 5, len(z))
+
+    m = categorical_projection(rewards, not_terminals, p_next, z, .9)
+    np.testing.assert_allclose(m, reference_projection(rewards, not_terminals, p_next, z, .9), atol=1e-12)
+    np.testing.assert_allclose(m[[0, 2]], np.broadcast_to(np.eye(len(z))[-1], (2, 2, len(z))), atol=1e-12)
+    np.testing.assert_allclose(m[[1, 3]], np.broadcast_to(np.eye(len(z))[0], (2, 2, len(z))), atol=1e-12)
+    np.testing.assert_allclose(m.sum(axis=-1), 1.)
+
+
+# Die alte Prioritätsberechnung von Sc2DqnAgent_v5 (Differenz von Ziel- und vorhergesagter Verteilung unter den Masken)
+# geht nur auf, wenn Aktions-Output (nb_actions, atoms) ist und atoms == nb_actions == screen.
+DIST_SIZE = 3
+
+
+def distributional_agent(experiences, prio_replay, sparse_targets, weights=None):
+    main_input = Input(shape=(2, DIST_SIZE, DIST_SIZE), name='main_input')
+    x = Permute((2, 3, 1))(main_input)
+    branch = Conv2D(4, (3, 3), padding='same', activation='relu')(x)
+    coord_out = Conv2D(DIST_SIZE, (1, 1), padding='same', activation='softmax')(branch)
+    act_out = Dense(DIST_SIZE * DIST_SIZE, activation='linear')(Flatten()(branch))
+    act_out = Activation('softmax')(Reshape((DIST_SIZE, DIST_SIZE))(act_out))
+    model = Model(main_input, [act_out, coord_out])
+
+    agent = Sc2DqnAgent_v5(model=model, nb_actions=DIST_SIZE, screen_size=DIST_SIZE,
+                           memory=FakeMemory(experiences), noisy_nets=False, prio_replay=prio_replay,
+                           multi_step_size=MULTI_STEP_SIZE, z=np.linspace(-1., 1., DIST_SIZE), policy=FakePolicy(),
+                           gamma=GAMMA, batch_size=BATCH_SIZE, nb_steps_warmup=0, target_model_update=10000,
+                           sparse_targets=sparse_targets)
+    agent.compile(Adam(lr=.01))
+    agent.training = True
+    agent.step = 1
+    if weights is None:
+        random = np.random.RandomState(7)
+        agent.model.set_weights([random.normal(0, .3, w.shape) for w in agent.model.get_weights()])
+        agent.target_model.set_weights([w + random.normal(0, .3, w.shape) for w in agent.model.get_weights()])
+    else:
+        agent.model.set_weights(weights[0])
+        agent.target_model.set_weights(weights[1])
+    return agent
+
+
+@pytest.mark.parametrize('prio_replay', [False, True])
+def test_distributional_sparse_targets_match_dense(prio_replay):
+    random = np.random.RandomState(8)
+    states = random.randint(0, 5, (BATCH_SIZE, 2, DIST_SIZE, DIST_SIZE)).astype(np.float32)
+    actions = [Sc2Action(random.randint(DIST_SIZE), random.randint(DIST_SIZE), random.randint(DIST_SIZE))
+               for _ in range(BATCH_SIZE)]
+    experiences = [states, actions, random.uniform(-1., 1., BATCH_SIZE), states[::-1],
+                   random.random_sample(BATCH_SIZE) < .3]
+    if prio_replay:
+        experiences += [random.uniform(.1, 1., BATCH_SIZE), np.arange(BATCH_SIZE)]
+    dense = distributional_agent(experiences, prio_replay, sparse_targets=False)
+    sparse = distributional_agent(experiences, prio_replay, sparse_targets=True, weights=agent_weights(dense))
+
+    observation = states[0]
+    metrics = dense.backward(0., terminal=False, observation_1=observation)
+    sparse_metrics = sparse.backward(0., terminal=False, observation_1=observation)
+
+    # Gleicher Lernschritt, gleiche Metriken und gleiche Prioritäten wie mit dichten Targets und Masken.
+    assert_weights_close(sparse.model.get_weights(), dense.model.get_weights())
+    np.testing.assert_allclose(sparse_metrics, metrics, rtol=1e-4, atol=1e-6)
+    if prio_replay:
+        np.testing.assert_allclose(sparse.memory.priorities, dense.memory.priorities, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,108 @@
+import os
+import signal
+from functools import partial
+
+import numpy as np
+import pytest
+
+from fakeEnv import FakeSc2Env2Outputs
+from sc2DqnAgent import Sc2Action
+from vecEnv import SerialVecEnv, SubprocVecEnv
+
+SCREEN = 6
+EPISODE_LENGTH = 3
+SEED = 5
+NO_OP = Sc2Action(0, 0, 0)
+
+
+def make_env(episode_length=EPISODE_LENGTH):
+    return FakeSc2Env2Outputs(screen=SCREEN, episode_length=episode_length)
+
+
+def make_vec_env(kind, nb_envs=2, episode_length=EPISODE_LENGTH, timeout=None):
+    env_fns = [partial(make_env, episode_length) for _ in range(nb_envs)]
+    if kind == 'serial':
+        vec_env = SerialVecEnv(env_fns)
+    else:
+        vec_env = SubprocVecEnv(env_fns, (2, SCREEN, SCREEN), timeout=timeout)
+    vec_env.seed(SEED)
+    return vec_env
+
+
+def reference_env(env_idx, episode_length=EPISODE_LENGTH):
+    # Dasselbe Environment wie env_idx im VecEnv, aber ohne VecEnv.
+    env = make_env(episode_length)
+    env.seed(SEED + env_idx)
+    return env
+
+
+@pytest.mark.parametrize('kind', ['serial', 'subproc'])
+def test_terminal_observation_at_episode_end(kind):
+    vec_env = make_vec_env(kind)
+    try:
+        references = [reference_env(i) for i in range(2)]
+        observations = vec_env.reset()
+        for observation, env in zip(observations, references):
+            np.testing.assert_array_equal(observation, env.reset())
+
+        for step in range(2 * EPISODE_LENGTH):
+            observations, rewards, dones, infos = vec_env.step([NO_OP, NO_OP])
+            for observation, reward, done, info, env in zip(observations, rewards, dones, infos, references):
+                ref_observation, ref_reward, ref_done, _ = env.step(NO_OP)
+                assert done == ref_done
+                assert reward == ref_reward
+                if done:
+                    # Letzte Observation der Episode im info, observation ist schon die erste der nächsten.
+                    np.testing.assert_array_equal(info['terminal_observation'], ref_observation)
+                    ref_observation = env.reset()
+                else:
+                    assert 'terminal_observation' not in info
+                np.testing.assert_array_equal(observation, ref_observation)
+    finally:
+        vec_env.close()
+
+
+def test_subproc_restarts_killed_worker():
+    vec_env = make_vec_env('subproc', episode_length=50, timeout=10)
+    try:
+        vec_env.reset()
+        observations, _, _, _ = vec_env.step([NO_OP, NO_OP])
+
+        os.kill(vec_env.processes[0].pid, signal.SIGKILL)
+        vec_env.processes[0].join()
+        with pytest.warns(UserWarning, match='restarting'):
+            next_observations, rewards, dones, infos = vec_env.step([NO_OP, NO_OP])
+
+        # Für den Learner ein Episodenende ohne Reward, mit der letzten bekannten Observation als Endzustand.
+        assert vec_env.nb_restarts == 1
+        assert dones.tolist() == [True, False]
+        assert rewards[0] == 0.
+        assert infos[0]['worker_restarted']
+        np.testing.assert_array_equal(infos[0]['terminal_observation'], observations[0])
+        # Der neue Worker bekommt denselben Seed und ist schon zurückgesetzt.
+        np.testing.assert_array_equal(next_observations[0], reference_env(0, episode_length=50).reset())
+
+        observations, _, dones, infos = vec_env.step([NO_OP, NO_OP])
+        assert vec_env.processes[0].is_alive()
+        assert not dones.any()
+        assert 'worker_restarted' not in infos[0]
+    finally:
+        vec_env.close()
+
+
+def test_subproc_reset_restarts_hanging_worker():
+    vec_env = make_vec_env('subproc', timeout=2)
+    try:
+        vec_env.reset()
+        # Angehaltener Worker: reset() darf nicht ewig warten.
+        os.kill(vec_env.processes[1].pid, signal.SIGSTOP)
+        with pytest.warns(UserWarning, match='restarting'):
+            observations = vec_env.reset()
+
+        assert vec_env.nb_restarts == 1
+        np.testing.assert_array_equal(observations[1], reference_env(1).reset())
+        assert vec_env.processes[1].is_alive()
+        _, _, dones, _ = vec_env.step([NO_OP, NO_OP])
+        assert not dones.any()
+    finally:
+        vec_env.close()
@@ -0,0 +1,299 @@
+import multiprocessing
+import os
+import signal
+import warnings
+import numpy as np
+
+
+# Mehrere Environments hinter einer gemeinsamen Schnittstelle, damit Agent3.fit_vectorized() die Observations aller
+# Environments in einem einzigen Forward-Pass verarbeiten kann.
+# - reset() gibt eine Liste mit je einer Observation pro Environment zurück.
+# - step(actions) nimmt je eine Action pro Environment und gibt Listen (observations, rewards, dones, infos) zurück.
+#   Beendete Environments werden automatisch zurückgesetzt: observations[i] ist dann bereits die erste Observation
+#   der neuen Episode, die letzte Observation der alten Episode steht in infos[i]['terminal_observation'].
+# - reset_at(i) setzt ein einzelnes Environment zurück (z.B. bei nb_max_episode_steps).
+# SerialVecEnv läuft im aktuellen Prozess, SubprocVecEnv verteilt die Environments auf eigene Prozesse.
+class SerialVecEnv(object):
+    """Steps all environments one after another in the current process.
+
+    # Arguments
+        env_fns: A list of functions without arguments, each creating one environment.
+    """
+
+    def __init__(self, env_fns):
+        self.envs = [env_fn() for env_fn in env_fns]
+        self.nb_envs = len(self.envs)
+        self._SCREEN = self.envs[0]._SCREEN
+
+    def __len__(self):
+        return self.nb_envs
+
+    def reset(self):
+        return [env.reset() for env in self.envs]
+
+    def reset_at(self, env_idx):
+        return self.envs[env_idx].reset()
+
+    def step(self, actions):
+        assert len(actions) == self.nb_envs
+
+        observations, rewards, dones, infos = [], [], [], []
+        for env, action in zip(self.envs, actions):
+            observation, reward, done, info = env.step(action)
+            if done:
+                info = dict(info)
+                info['terminal_observation'] = observation
+                observation = env.reset()
+            observations.append(observation)
+            rewards.append(reward)
+            dones.append(done)
+            infos.append(info)
+
+        return observations, np.asarray(rewards, dtype=np.float32), np.asarray(dones, dtype=bool), infos
+
+    def seed(self, seed=None):
+        # Jedes Environment bekommt einen eigenen Seed.
+        for i, env in enumerate(self.envs):
+            env.seed(seed + i if seed else seed)
+
+    def render(self, mode='human', close=False):
+        pass
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+    @property
+    def screen(self):
+        return self._SCREEN
+
+
+def _mark_flags_parsed():
+    # Ein neu gestarteter (spawn) Worker hat die Kommandozeile nicht über absl.app geparst, pysc2 liest aber
+    # Flags (z.B. sc2_run_config); ohne geparste Flags wirft absl beim Zugriff einen Fehler. Es gelten die Defaults.
+    try:
+        from absl import flags
+    except ImportError:
+        return
+    if not flags.FLAGS.is_parsed():
+        flags.FLAGS.mark_as_parsed()
+
+
+def _worker(remote, parent_remote, env_fn, buffers, observation_shape, observation_dtype):
+    # Läuft im Worker-Prozess: besitzt genau ein Environment und schreibt dessen Observations direkt in die
+    # Shared-Memory Blöcke. Über die Pipe gehen nur Kommandos, Actions, Rewards, dones und infos.
+    parent_remote.close()
+    _mark_flags_parsed()
+    observation, terminal_observation = [np.frombuffer(buffer, dtype=observation_dtype).reshape(observation_shape)
+                                         for buffer in buffers]
+    env = env_fn()
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                obs, reward, done, info = env.step(data)
+                if done:
+                    terminal_observation[...] = obs
+                    obs = env.reset()
+                observation[...] = obs
+                remote.send((reward, done, info))
+            elif cmd == 'reset':
+                observation[...] = env.reset()
+                remote.send(True)
+            elif cmd == 'seed':
+                env.seed(data)
+                np.random.seed(data)
+                remote.send(True)
+            elif cmd == 'close':
+                remote.send(True)
+                break
+            else:
+                raise ValueError('Unknown command "{}".'.format(cmd))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+
+
+class SubprocVecEnv(object):
+    """Runs every environment in its own worker process.
+
+    Observations are not pickled: every worker writes them into its own shared-memory block, the learner only
+    copies them out (one memcpy per environment and step). A worker that dies or does not answer within
+    `timeout` seconds (also in `reset()`) is restarted; for the learner this looks like the end of an episode
+    (reward 0, `info['worker_restarted'] = True`), which `Agent3.fit_vectorized()` does not store in the replay
+    memory.
+
+    Workers are started with `spawn` by default, not `fork`: the learner usually already has a TensorFlow session,
+    which must not be copied into the workers. The env_fns are therefore pickled and must be picklable, e.g.
+    `functools.partial(Sc2Env2Outputs, ...)` instead of a closure; per-environment seeds go through `seed()`.
+
+    # Arguments
+        env_fns: A list of picklable functions without arguments, each creating one environment (called in the
+            worker).
+        observation_shape: Shape of a single observation, e.g. (2, screen, screen) for Sc2Env2Outputs.
+        observation_dtype: Dtype of the observations.
+        timeout: Seconds to wait for a step of a worker before it counts as crashed (`None` waits forever).
+        start_timeout: The same for the first answer of a newly started worker, which includes creating the
+            environment (`None` waits forever).
+        context: The multiprocessing context the workers are started with, defaults to
+            `multiprocessing.get_context('spawn')`.
+    """
+
+    def __init__(self, env_fns, observation_shape, observation_dtype=np.int32, timeout=None, start_timeout=None,
+                 context=None):
+        self.context = multiprocessing.get_context('spawn') if context is None else context
+        self.env_fns = env_fns
+        self.nb_envs = len(env_fns)
+        self.observation_shape = tuple(observation_shape)
+        self.observation_dtype = np.dtype(observation_dtype)
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self._SCREEN = self.observation_shape[-1]
+        self.nb_restarts = 0
+
+        # Je Environment ein Block für die aktuelle und einer für die letzte Observation einer Episode.
+        nbytes = int(np.prod(self.observation_shape)) * self.observation_dtype.itemsize
+        self._buffers = [(self.context.RawArray('b', nbytes), self.context.RawArray('b', nbytes))
+                         for _ in range(self.nb_envs)]
+        self._observations = [self._as_array(buffer) for buffer, _ in self._buffers]
+        self._terminal_observations = [self._as_array(buffer) for _, buffer in self._buffers]
+        self._last_observations = [None] * self.nb_envs
+        self._seeds = [None] * self.nb_envs
+
+        self.remotes = [None] * self.nb_envs
+        self.processes = [None] * self.nb_envs
+        self._starting = [True] * self.nb_envs
+        for i in range(self.nb_envs):
+            self._start_worker(i)
+
+    def __len__(self):
+        return self.nb_envs
+
+    def _as_array(self, buffer):
+        return np.frombuffer(buffer, dtype=self.observation_dtype).reshape(self.observation_shape)
+
+    def _start_worker(self, env_idx):
+        remote, worker_remote = self.context.Pipe()
+        process = self.context.Process(target=_worker, args=(worker_remote, remote, self.env_fns[env_idx],
+                                                              self._buffers[env_idx], self.observation_shape,
+                                                              self.observation_dtype))
+        process.daemon = True
+        process.start()
+        worker_remote.close()
+        self.remotes[env_idx] = remote
+        self.processes[env_idx] = process
+        self._starting[env_idx] = True
+
+    def _stop_worker(self, env_idx):
+        process = self.processes[env_idx]
+        if process.is_alive():
+            process.terminate()
+            process.join(1)
+            if process.is_alive():
+                # hängt der Worker (z.B. angehalten), reagiert er nicht auf SIGTERM
+                os.kill(process.pid, signal.SIGKILL)
+        process.join()
+        self.remotes[env_idx].close()
+
+    def _send(self, env_idx, cmd, data=None):
+        try:
+            self.remotes[env_idx].send((cmd, data))
+            return True
+        except (BrokenPipeError, EOFError, OSError):
+            return False
+
+    def _recv(self, env_idx, timeout=None):
+        # None heißt: Worker abgestürzt oder zu langsam. Ein neuer Worker erzeugt vor der ersten Antwort noch das
+        # Environment, dafür gilt start_timeout.
+        remote = self.remotes[env_idx]
+        if self._starting[env_idx]:
+            timeout = self.start_timeout
+        try:
+            if timeout is not None and not remote.poll(timeout):
+                return None
+            result = remote.recv()
+        except (EOFError, OSError):
+            return None
+        self._starting[env_idx] = False
+        return result
+
+    def _call(self, env_idx, cmd, data=None, timeout=None):
+        if not self._send(env_idx, cmd, data):
+            return None
+        return self._recv(env_idx, timeout)
+
+    def _restart_worker(self, env_idx):
+        warnings.warn('Environment worker {} crashed or timed out, restarting it.'.format(env_idx))
+        self._stop_worker(env_idx)
+        self._start_worker(env_idx)
+        self.nb_restarts += 1
+        if self._seeds[env_idx] is not None and self._call(env_idx, 'seed', self._seeds[env_idx],
+                                                           timeout=self.timeout) is None:
+            raise RuntimeError('Environment worker {} could not be restarted.'.format(env_idx))
+        if self._call(env_idx, 'reset', timeout=self.timeout) is None:
+            raise RuntimeError('Environment worker {} could not be restarted.'.format(env_idx))
+
+    def reset(self):
+        sent = [self._send(i, 'reset') for i in range(self.nb_envs)]
+        for i in range(self.nb_envs):
+            if not sent[i] or self._recv(i, self.timeout) is None:
+                self._restart_worker(i)
+        self._last_observations = [observation.copy() for observation in self._observations]
+        return list(self._last_observations)
+
+    def reset_at(self, env_idx):
+        if self._call(env_idx, 'reset', timeout=self.timeout) is None:
+            self._restart_worker(env_idx)
+        self._last_observations[env_idx] = self._observations[env_idx].copy()
+        return self._last_observations[env_idx]
+
+    def step(self, actions):
+        assert len(actions) == self.nb_envs
+
+        sent = [self._send(i, 'step', action) for i, action in enumerate(actions)]
+        results = [self._recv(i, self.timeout) if sent[i] else None for i in range(self.nb_envs)]
+
+        observations, rewards, dones, infos = [], [], [], []
+        for i, result in enumerate(results):
+            if result is None:
+                # Absturz wie ein Episodenende behandeln; letzte bekannte Observation als Endzustand.
+                self._restart_worker(i)
+                reward, done, info = 0., True, {'worker_restarted': True}
+                terminal_observation = self._last_observations[i]
+            else:
+                reward, done, info = result
+                terminal_observation = self._terminal_observations[i].copy() if done else None
+
+            if done:
+                info = dict(info)
+                info['terminal_observation'] = terminal_observation
+            observation = self._observations[i].copy()
+            self._last_observations[i] = observation
+
+            observations.append(observation)
+            rewards.append(reward)
+            dones.append(done)
+            infos.append(info)
+
+        return observations, np.asarray(rewards, dtype=np.float32), np.asarray(dones, dtype=bool), infos
+
+    def seed(self, seed=None):
+        for i in range(self.nb_envs):
+            self._seeds[i] = seed + i if seed else seed
+            # Eine verspätete Antwort würde sonst beim nächsten Kommando gelesen.
+            if self._call(i, 'seed', self._seeds[i], timeout=self.timeout) is None:
+                self._restart_worker(i)
+
+    def render(self, mode='human', close=False):
+        pass
+
+    def close(self):
+        for i in range(self.nb_envs):
+            if self.processes[i].is_alive():
+                self._call(i, 'close', timeout=self.timeout)
+            self._stop_worker(i)
+
+    @property
+    def screen(self):
+        return self._SCREEN